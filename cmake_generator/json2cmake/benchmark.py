@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks of the hot spots of json2cmake.
+usage: python -m cmake_generator.json2cmake.benchmark [compile_commands.json]
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import timeit
+import logging
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from .reader import read_entries
+from .tokenizer import split_command
+from .database import CompilationDatabase
+from .converter import CmakeConverter
+from .scanner import IncludeScanner
+
+__all__ = ['sample_commands', 'benchmark_tokenizer', 'sample_project', 'benchmark_logging']
+
+SAMPLE_COMMANDS = [
+    '/usr/bin/g++ -g -O2 -I. -I./config -I../include -DLOCALEDIR="\\"/usr/local/share/locale\\"" -DHAVE_CONFIG_H '
+    '-Wall -Wpointer-arith -Wno-unused -c -o ada-lang.o -MT ada-lang.o -MMD -MP -MF ./.deps/ada-lang.Tpo ada-lang.c',
+    "/usr/bin/gcc -DNAME='\"[gdb], {x}\"' -I/usr/include/glib-2.0 -fPIC -c -o dict.o dict.c",
+    '/usr/bin/ar cru libgdb.a ada-lang.o dict.o ' + ' '.join('file%d.o' % i for i in range(40)),
+    '/usr/bin/g++ -shared -Wl,-soname=libx.so.1 -o libx.so.1.0 x.o y.o -lpthread -lm',
+]
+
+
+def sample_commands(filename=None):
+    """The command lines of the compilation database in filename, or SAMPLE_COMMANDS"""
+    if not filename:
+        return list(SAMPLE_COMMANDS)
+    commands = []
+    with open(filename, 'r') as infile:
+        for entry in read_entries(infile):
+            if 'command' in entry:
+                commands.append(entry['command'])
+            elif 'arguments' in entry:
+                commands.append(' '.join(shlex.quote(arg) for arg in entry['arguments']))
+    return commands
+
+
+def benchmark_tokenizer(commands, repeat=5):
+    """returns the best seconds of shlex.split() and split_command() splitting all commands"""
+    for command in commands:
+        if split_command(command) != shlex.split(command):
+            raise ValueError('split_command() differs from shlex.split() on %r' % command)
+    number = max(1, 20000 // max(1, len(commands)))
+    results = {}
+    for name, split in (('shlex.split', shlex.split), ('split_command', split_command)):
+        timer = timeit.Timer(lambda: [split(command) for command in commands])
+        results[name] = min(timer.repeat(repeat, number)) / number
+    return results
+
+
+def sample_project(directory, dirs=8, files=40):
+    """
+    Write the sources of a project of dirs executables of files sources each,
+    returns its compilation database as a list of entries"""
+    os.makedirs(os.path.join(directory, 'include'))
+    with open(os.path.join(directory, 'include', 'common.h'), 'w') as f:
+        f.write('#include <stdio.h>\n')
+    entries = []
+    for d in range(dirs):
+        sub_dir = os.path.join(directory, 'app%d' % d)
+        os.makedirs(sub_dir)
+        objects = []
+        for i in range(files):
+            with open(os.path.join(sub_dir, 'file%d.c' % i), 'w') as f:
+                f.write('#include "common.h"\nint f%d_%d;\n' % (d, i))
+            objects.append('file%d.o' % i)
+            entries.append({'directory': sub_dir, 'file': 'file%d.c' % i, 'arguments': [
+                '/usr/bin/gcc', '-g', '-O2', '-I../include', '-DLIB=%d' % d, '-c', '-o', objects[-1], 'file%d.c' % i]})
+        entries.append({'directory': sub_dir, 'file': objects[0],
+                        'arguments': ['/usr/bin/gcc', '-o', 'app%d' % d] + objects})
+    return entries
+
+
+def benchmark_logging(levels=(logging.INFO, logging.DEBUG), repeat=3, dirs=8, files=40):
+    """
+    returns the best seconds of reading and converting sample_project() with the loggers of json2cmake at each of levels,
+    their messages formatted into a handler writing to os.devnull, like what is printed"""
+    package_logger = logging.getLogger(__package__)
+    saved = package_logger.level, package_logger.propagate
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        text = json.dumps(sample_project(directory, dirs, files))
+        handler = logging.StreamHandler(devnull)
+        package_logger.addHandler(handler)
+        package_logger.propagate = False
+        # shared, so that the system include dirs are queried once
+        dep_scanner = IncludeScanner()
+        try:
+            for level in levels:
+                package_logger.setLevel(level)
+                best = None
+                for run in range(repeat + 1):
+                    CmakeConverter.generators.clear()
+                    start = time.perf_counter()
+                    db = CompilationDatabase(StringIO(text), directory + '/compile_commands.json', directory,
+                                             dep_scanner=dep_scanner)
+                    db.read()
+                    CmakeConverter(db, 'sample', directory).convert()
+                    seconds = time.perf_counter() - start
+                    # the first run warms up the scanner
+                    if run and (best is None or seconds < best):
+                        best = seconds
+                results[logging.getLevelName(level)] = best
+        finally:
+            CmakeConverter.generators.clear()
+            package_logger.removeHandler(handler)
+            package_logger.setLevel(saved[0])
+            package_logger.propagate = saved[1]
+    return results
+
+
+def main():
+    commands = sample_commands(sys.argv[1] if len(sys.argv) > 1 else None)
+    results = benchmark_tokenizer(commands)
+    baseline = results['shlex.split']
+    print('tokenize %d commands' % len(commands))
+    for name, seconds in results.items():
+        print('%-15s %10.3f ms %6.1fx' % (name, seconds * 1000, baseline / seconds))
+    results = benchmark_logging()
+    baseline = results['INFO']
+    print('convert a sample project logging at')
+    for name, seconds in results.items():
+        print('%-15s %10.3f ms %6.1fx' % (name, seconds * 1000, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 #! /usr/bin/env python3
 import os
 from os.path import abspath, dirname, basename, isfile
-import subprocess
 import re
 import tempfile
 import shutil
+from .runner import run_commands, run_command
 
 __all__ = ['generate_cmake_vars_file', 'CMAKE_VARS_PATH']
 CWD = os.getcwd()
@@ -27,14 +27,15 @@ endforeach()
 def generate_cmake_vars_file(cmake_vars_path):
 	packages = set()
 	regex = re.compile(r'^.*/Find([^/]*)\.cmake$')
-	lines = subprocess.getoutput('locate /Find').splitlines(False)
+	find_modules, config_files = run_commands([(['locate', '/Find'], {}), (['locate', 'Config.cmake'], {})])
+	lines = find_modules.output.splitlines(False)
 	for line in lines:
 		matched = regex.match(line)
 		if matched:
 			packages.add(matched.group(1))
 
 	regex = re.compile(r'^.*/([^/]*)Config.cmake')
-	lines = subprocess.getoutput('locate Config.cmake').splitlines(False)
+	lines = config_files.output.splitlines(False)
 	for line in lines:
 		matched = regex.match(line)
 		if matched:
@@ -46,11 +47,9 @@ def generate_cmake_vars_file(cmake_vars_path):
 	cmake_lists_file = open(os.path.join(tmpdir, 'CMakeLists.txt'), 'w')
 	cmake_lists_file.write(CMAKE_FILE_HEADER + cmake_lists_content + CMAKE_FILE_BOTTOM)
 	print(cmake_lists_content)
-	os.chdir(tmpdir)
-	output = subprocess.getoutput("cmake -G 'Unix Makefiles' .")
+	output = run_command(['cmake', '-G', 'Unix Makefiles', '.'], tmpdir, merge_stderr=True).output
 	print(output)
 	open(cmake_vars_path, 'w').write(output)
-	os.chdir(CWD)
 	shutil.rmtree(tmpdir)
 
 
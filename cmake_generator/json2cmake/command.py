@@ -1,17 +1,21 @@
 import os
-import shlex
-from .utils import freeze, basestring, resolve, relpath, get_loggers
+from .utils import CompactObject, OrderedSet, fingerprint, intern_string, intern_tuple, basestring, resolve, relpath, \
+    get_loggers, Lazy, lazy_join, stat_cache
 from .denpendency import find_dependencies
+from .tokenizer import split_command
 
 
-__all__ = ['Command', 'resolve_destination', 'C_COMPILERS']
+__all__ = ['Command', 'ParseCache', 'resolve_destination', 'C_COMPILERS']
 logger, info, debug, warn, error = get_loggers(__name__)
 C_COMPILERS = ('gcc', 'g++', 'clang', 'clang++')
+MASKED_OPTIONS = ('-o', '-MT', '-MF')
+# max number of commands kept by a ParseCache before dropping the least recently used ones
+PARSE_CACHE_SIZE = 4096
 
 
 def resolve_destination(path, cwd, source):
     target = resolve(path, cwd)
-    if os.path.isdir(target):
+    if stat_cache.isdir(target):
         destination = target
         target = os.path.join(target, os.path.basename(source))
     else:
@@ -22,13 +26,13 @@ def resolve_destination(path, cwd, source):
     return target, destination
 
 
-class Command(object):
-    id = None
-    destination = None
-    compile_c_as_cxx = False
-    use_thread = False
-    include_binary_dir = False
-    type = ''
+class Command(CompactObject):
+    __slots__ = ('compiler', 'cwd', 'options', 'link_options', 'definitions',
+                 'includes', 'system_includes', 'iquote_includes', 'libs',
+                 'referenced_libs', 'missing_depends', 'linkage', 'id', 'destination',
+                 'compile_c_as_cxx', 'use_thread', 'include_binary_dir', 'type', '_fingerprint')
+    LIST_FIELDS = ('options', 'link_options', 'definitions',
+                   'includes', 'system_includes', 'iquote_includes', 'libs')
 
     def __init__(self, compiler, cwd):
         self.compiler = compiler
@@ -36,61 +40,113 @@ class Command(object):
         self.options = []
         self.link_options = []
         self.definitions = []
-        self.includes = []
-        self.system_includes = []
-        self.iquote_includes = []
+        self.includes = OrderedSet()
+        self.system_includes = OrderedSet()
+        self.iquote_includes = OrderedSet()
         self.libs = []
         self.referenced_libs = {}
         self.missing_depends = {}
         self.linkage = 'SOURCE'
+        self.id = None
+        self.destination = None
+        self.compile_c_as_cxx = False
+        self.use_thread = False
+        self.include_binary_dir = False
+        self.type = ''
+        self._fingerprint = None
 
     def __repr__(self):
-        children = ', '.join('%s=%s' % it for it in sorted(filter(lambda it: it[1], self.__dict__.items())))
+        children = ', '.join('%s=%s' % it for it in sorted(
+            filter(lambda it: it[1] and it[0][:1] != '_', self.__dict__.items())))
         return "%s{%s}" % (self.__class__.__name__, children)
 
+    def fingerprint(self):
+        """
+        Digest identifying commands equal in freeze(), used to deduplicate commands.
+        It is computed once and cached, commands changed by migrate() compute it again."""
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self)
+        return self._fingerprint
+
+    def changed(self):
+        self._fingerprint = None
+
+    def compact(self, interned=None):
+        """
+        Share the option lists as tuples interned in interned, see intern_tuple(), with interned strings.
+        migrate() turns them into lists again before changing them."""
+        if interned is None:
+            interned = {}
+        self.compiler = intern_string(self.compiler)
+        self.cwd = intern_string(self.cwd)
+        for name in Command.LIST_FIELDS:
+            setattr(self, name, intern_tuple(getattr(self, name), interned))
+
     def copy(self):
         other = Command(self.compiler, self.cwd)
         other.migrate(self)
         return other
 
+    def clone(self):
+        other = Command.__new__(Command)
+        for name in Command.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, (list, set, dict)):
+                value = value.copy()
+            setattr(other, name, value)
+        return other
+
     def migrate(self, command):
         if isinstance(command, dict):
             items = command.items()
         else:
             items = command.__dict__.items()
+        self.changed()
         for k, v in items:
+            if k[:1] == '_': continue
             value = getattr(self, k, v)
-            if isinstance(value, tuple):
-                value = list(value)
+            if isinstance(value, (tuple, list)) and not isinstance(value, OrderedSet):
+                value = OrderedSet(value)
                 setattr(self, k, value)
             elif isinstance(value, frozenset):
                 value = set(value)
                 setattr(self, k, value)
             if isinstance(value, list):
-                for part in v:
-                    if part not in value:
-                        value.append(part)
+                value.update(v)
             elif isinstance(value, set):
                 value.update(v)
             elif v and not getattr(self, k, None):
                 setattr(self, k, v)
 
     @staticmethod
-    def parse(command_line, source, cwd, root_dir):
+    def parse(command_line, source, cwd, root_dir, cache=None):
         if isinstance(command_line, basestring):
-            command_line = shlex.split(command_line)
+            command_line = split_command(command_line)
         words = iter(command_line)
         compiler = os.path.basename(next(words))  # remove the initial 'cc' / 'c++'
         if compiler.startswith('python'):
             compiler = os.path.basename(next(words))
 
-        command = Command(compiler, cwd)
-        target = command.parse_command(words, source, root_dir)
+        if cache is not None and Command.parser_name(compiler) == 'cxx':
+            command, target = cache.parse(compiler, cwd, list(words), source, root_dir)
+        else:
+            command = Command(compiler, cwd)
+            target = command.parse_command(words, source, root_dir)
         target = resolve(target, cwd)
         for key in list(command.missing_depends):
             command.missing_depends[target] = command.missing_depends.pop(key)
         return command, target
 
+    @staticmethod
+    def parser_name(compiler):
+        if compiler == 'ccache':
+            compiler = 'clang'
+        if compiler.endswith("ar"):
+            return 'ar'
+        if hasattr(Command, 'parse_' + compiler.replace('-', '_')):
+            return compiler.replace('-', '_')
+        return 'cxx'
+
     def parse_command(self, words, source, root_dir):
         if self.compiler == 'ccache':
             self.compiler = 'clang'
@@ -105,9 +161,13 @@ class Command(object):
         else:
             target = self.parse_cxx(words, root_dir)
 
+        self.check_source_language(source)
+        return target
+
+    def check_source_language(self, source):
         if self.compiler in ('g++', 'clang++') and source.endswith('.c'):
             self.compile_c_as_cxx = True
-        return target
+            self.changed()
 
     def parse_cxx(self, words, root_dir, target=''):
         if self.compiler in C_COMPILERS:
@@ -117,18 +177,15 @@ class Command(object):
                 target = next(words)
             elif word.startswith('-I'):
                 include = resolve(word[2:], self.cwd)
-                if include not in self.includes:
-                    self.includes.append(include)
+                self.includes.add(include)
             elif word == '-isystem':
                 include = next(words)
                 include = resolve(include, self.cwd)
-                if include not in self.system_includes:
-                    self.system_includes.append(include)
+                self.system_includes.add(include)
             elif word == '-iquote':
                 include = next(words)
                 include = resolve(include, self.cwd)
-                if include not in self.iquote_includes:
-                    self.iquote_includes.append(include)
+                self.iquote_includes.add(include)
             elif word.startswith('-D'):
                 define = next(words) if word == '-D' else word[2:]
                 define = self.process_arg_define(define)
@@ -356,10 +413,98 @@ class Command(object):
         return target
 
     def update_object_command(self, source, target, root_dir):
-        missing_depends = find_dependencies(source, self, root_dir)
+        self.add_missing_depends(target, find_dependencies(source, self, root_dir), root_dir)
+
+    def add_missing_depends(self, target, missing_depends, root_dir):
         if missing_depends:
-            info("cmd #%s created OBJECT %-25s depends on missing %s"
-                 % (self.id, relpath(target, root_dir),
-                    ' '.join([relpath(f, root_dir) for f in missing_depends])))
+            info("cmd #%s created OBJECT %-25s depends on missing %s", self.id, Lazy(relpath, target, root_dir),
+                 lazy_join(missing_depends, ' ', lambda f: relpath(f, root_dir)))
             self.missing_depends.setdefault(target, set()).update(missing_depends)
             self.include_binary_dir = True
+
+
+class ParseCache(object):
+    """
+    Commands parsed by Command.parse_cxx, keyed on (compiler, cwd, root_dir, arguments)
+    with the output and source file arguments masked.
+    Entries differing only in those files reuse the parsed option lists,
+    so the parsing cost scales with the number of distinct flag sets.
+    Only the compile commands, with '-c', are cached: the link commands list their own objects, and are seldom repeated.
+    At most max_size commands are kept, the least recently used ones dropped first."""
+    def __init__(self, max_size=PARSE_CACHE_SIZE):
+        self.commands = {}
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "%s{hits=%s, misses=%s, size=%s}" % (
+            self.__class__.__name__, self.hits, self.misses, len(self.commands))
+
+    @staticmethod
+    def mask(words, source, cwd):
+        """Replace the output and source file arguments with placeholders, which never appear in real words"""
+        masked = list(words)
+        source_name = os.path.basename(source)
+        for i, word in enumerate(words):
+            if not word or word.startswith('-'): continue
+            if (i > 0 and words[i - 1] in MASKED_OPTIONS) \
+                    or (source_name and word.endswith(source_name) and resolve(word, cwd) == source):
+                masked[i] = '\0%d\0' % i
+        return masked
+
+    def parse(self, compiler, cwd, words, source, root_dir):
+        if '-c' not in words:
+            command = Command(compiler, cwd)
+            return command, command.parse_command(iter(words), source, root_dir)
+        masked = self.mask(words, source, cwd)
+        key = (compiler, cwd, root_dir, tuple(masked))
+        cached = self.commands.pop(key, None)
+        if cached is None:
+            self.misses += 1
+            template = Command(compiler, cwd)
+            target = template.parse_command(iter(masked), '', root_dir)
+            cached = self.verify(template, target)
+            if cached:
+                # cloned commands share the option tuples and inherit the fingerprint
+                template.compact()
+                template.fingerprint()
+            if len(self.commands) >= self.max_size:
+                del self.commands[next(iter(self.commands))]
+        else:
+            self.hits += 1
+        # kept last, as the most recently used
+        self.commands[key] = cached
+        if not cached:
+            command = Command(compiler, cwd)
+            return command, command.parse_command(iter(words), source, root_dir)
+        template, target_index, target = cached
+        command = template.clone()
+        command.check_source_language(source)
+        return command, words[target_index] if target_index is not None else target
+
+    @staticmethod
+    def verify(template, target):
+        """
+        Placeholders consumed as values of other options would leak into the parsed command,
+        which is then not reusable for different files.
+        A placeholder parsed as a plain word is ignored just as a real file name is."""
+        for name, value in template.__dict__.items():
+            if name[:1] == '_':
+                continue
+            elif isinstance(value, basestring):
+                values = (value, )
+            elif isinstance(value, (list, set, tuple)):
+                values = value
+            elif isinstance(value, dict):
+                values = list(value.keys()) + list(value.values())
+            else:
+                continue
+            for v in values:
+                if isinstance(v, basestring) and '\0' in v:
+                    return False
+        if '\0' not in target:
+            return template, None, target
+        if target[:1] != '\0' or target[-1:] != '\0':
+            return False
+        return template, int(target[1:-1]), None
@@ -1,6 +1,7 @@
 import os
 import re
 import logging
+import multiprocessing
 
 from .utils import *
 from .command import C_COMPILERS
@@ -11,13 +12,27 @@ from .target import InstallTarget
 
 # FORMAT = '%(asctime)-15s %(levelname)-8s %(module)s %(message)s'
 logger, info, debug, warn, error = get_loggers(__name__)
+# generators rendered by the worker processes, which inherit them when forked
+RENDERED_GENERATORS = []
+
+
+def render_generator(index):
+    """
+    Render the CMakeLists.txt of RENDERED_GENERATORS[index], run in worker processes.
+    returns None if it refers to a target not named beforehand, for the main process to render it"""
+    CmakeGenerator.names_frozen = True
+    try:
+        return RENDERED_GENERATORS[index].render()
+    except KeyError as e:
+        warn("Leave %s to the main process: %s" % (RENDERED_GENERATORS[index].directory, e))
+        return None
 
 
 class CmakeConverter(PathUtils):
 
     generators = {}
 
-    def __init__(self, database, name, cwd, single_file=False):
+    def __init__(self, database, name, cwd, single_file=False, jobs=1):
         PathUtils.__init__(self, cwd, database.root_dir)
         self.db = database
         self.binary_dir = self.db.binary_dir()
@@ -25,6 +40,8 @@ class CmakeConverter(PathUtils):
         self.name = name
         self.single_file = single_file
         self.common_configs = {}
+        # rendering in worker processes needs fork() for them to inherit the generators
+        self.jobs = jobs if 'fork' in multiprocessing.get_all_start_methods() else 1
 
     def convert(self):
         generators = CmakeConverter.generators
@@ -54,6 +71,8 @@ class CmakeConverter(PathUtils):
         external_dests = tuple(filter(lambda d: not d.startswith(self.directory), destinations))
         cmake_install_prefix = os.path.commonpath(external_dests) if external_dests else "/usr/local"
         key_generators = sorted(generators.items(), key=lambda x: x[1].directory.count('/'), reverse=True)
+        parallel = self.jobs > 1 and len(key_generators) > 1
+        rendered = []
         for key, _ in key_generators:
             generator = generators[key]
             if not generator.targets and len(generator.other_installs) == 1:
@@ -66,14 +85,43 @@ class CmakeConverter(PathUtils):
                             break
             if generator.generated: continue
             generator.set_install_prefix(cmake_install_prefix)
-            directory = generator.setup_output()
+            directory = generator.setup_directory() if parallel else generator.setup_output()
             name = self.get_name_for_generator(directory)
             if name != key:
                 generator.name = name
                 generators[name] = generator
-            generator.write_to_file()
+            if parallel:
+                generator.name_targets()
+            else:
+                generator.write_to_file()
             if root_generator != generator:
+                if parallel:
+                    rendered.append(generator)
                 root_generator.output_subdirectory(directory)
+        if parallel:
+            self.render_generators(rendered, root_generator)
+
+    def render_generators(self, rendered, root_generator):
+        """
+        Render the CMakeLists.txt of the rendered generators in worker processes,
+        forked once all the targets are named, then the root one, with the subdirectories added in their order.
+        A generator referring to a target name_targets() missed is rendered again in this process, which names it.
+        The package variables the workers register in CmakeGenerator.used_names stay in their process,
+        they only serve to warn about the variables already used by other directories."""
+        global RENDERED_GENERATORS
+        if rendered:
+            RENDERED_GENERATORS = rendered
+            try:
+                with multiprocessing.get_context('fork').Pool(min(self.jobs, len(rendered))) as pool:
+                    for generator, content in zip(rendered, pool.imap(render_generator, range(len(rendered)))):
+                        if content is None:
+                            content = generator.render()
+                        generator.save(content)
+            finally:
+                RENDERED_GENERATORS = []
+            info("Rendered %d CMakeLists.txt with %d jobs", len(rendered), self.jobs)
+        if not root_generator.generated:
+            root_generator.save(root_generator.render())
 
     def generate_linked_target(self, target, command_source):
         commands = command_source.keys()
@@ -92,7 +140,7 @@ class CmakeConverter(PathUtils):
         files.extend(missing_depends)
         files.sort()
         linkage = command.linkage
-        info("Process %s target %s" % (linkage, relpath(target, directory)))
+        info("Process %s target %s", linkage, Lazy(relpath, target, directory))
         if linkage == 'SOURCE':
             generator = self.get_generator_for_sources(files)
             if command.compiler in C_COMPILERS:
@@ -100,9 +148,8 @@ class CmakeConverter(PathUtils):
                 return generator.output_linked_target(command, files, target, 'OBJECT', name, set())
             return generator.output_custom_command(target, command, files)
 
-        debug("%s %s linked by cmd #%s from %s"
-              % (linkage, relpath(target, directory), command.id,
-                 ' '.join([relpath(f, directory) for f in files])))
+        debug("%s %s linked by cmd #%s from %s", linkage, Lazy(relpath, target, directory), command.id,
+              lazy_join(files, ' ', lambda f: relpath(f, directory)))
         sources, libs, compilations, depends = CmakeConverter.classify_source_files(files, target, db, directory)
         self.write_command_for_qt_generated_sources(target, sources, db, depends)
 
@@ -156,7 +203,7 @@ class CmakeConverter(PathUtils):
         for f in files:
             if f in db.linkings:
                 dependencies.add(f)
-                info('%s refer linked target %s' % (relpath(target, directory), relpath(f, directory)))
+                info('%s refer linked target %s', Lazy(relpath, target, directory), Lazy(relpath, f, directory))
                 linkage = db.target_linkage(f)
                 if linkage in ('STATIC', 'SHARED', 'SOURCE'):
                     libs[f] = linkage
@@ -171,8 +218,8 @@ class CmakeConverter(PathUtils):
                     libs[f] = 'SHARED'
                 else:
                     if ext not in ('.c', '.cpp', '.cc', '.java', '.qm', '.qch', '.ts', '.po'):
-                        info('%s referenced %s not in linked objects as bellow\n\t%s'
-                             % (relpath(target, directory), f, '\n\t'.join(db.linkings.keys())))
+                        info('%s referenced %s not in linked objects as bellow\n\t%s',
+                             Lazy(relpath, target, directory), f, lazy_join(db.linkings.keys(), '\n\t'))
                     sources.add(f)
                 continue
             CmakeConverter.collect_depends(db, f, compilations, sources, dependencies)
@@ -181,25 +228,7 @@ class CmakeConverter(PathUtils):
 
     @staticmethod
     def collect_depends(db, target, compilations, source_files, dependencies):
-        source_map = db.objects.get(target, {})
-        for source, cmd_id in source_map.items():
-            command = db.command[cmd_id]
-            extra_sources = command.missing_depends.get(target, set())
-            if extra_sources:
-                for f in extra_sources:
-                    source_files.add(f)
-                    dependencies.add(f)
-                    compilations.setdefault(cmd_id, {})[f] = target
-                    CmakeConverter.collect_depends(db, f, compilations, source_files, dependencies)
-            source_compiler = command.compiler
-            if source_compiler in ('rcc', 'uic'): continue
-            source_files.add(source)
-            linkage = db.command_linkage(cmd_id)
-            if linkage == 'INSTALL': continue
-            compilations.setdefault(cmd_id, {})[source] = target
-            if source not in db.objects: continue
-            dependencies.add(source)
-            CmakeConverter.collect_depends(db, source, {}, set(), dependencies)
+        db.merge_object_closure(target, compilations, source_files, dependencies)
 
     @staticmethod
     def update_referenced_libs(config, referenced_libs):
@@ -218,26 +247,11 @@ class CmakeConverter(PathUtils):
             config.migrate(db.command[cmd_id])
         for cmd_id, source_product in compilations.items():
             for source, product in source_product.items():
-                if CmakeConverter.reduce_target(cmd_id, product, source, db.targets):
-                    debug("Target %s use source %-20s instead of %s" % (name, source, product))
+                if db.reduce_target(cmd_id, product, source):
+                    debug("Target %s use source %-20s instead of %s", name, source, product)
                 if db.is_generated(source):
                     config.include_binary_dir = True
 
-    @staticmethod
-    def reduce_target(cmd_id, product, source, targets):
-        target_sources = targets.get(cmd_id, {})
-        sources = target_sources.get(product, set())
-        if source in sources:
-            sources.remove(source)
-            if not sources:
-                target_sources.pop(product)
-                debug("cmd #%s pop its targets %s" % (cmd_id, product))
-            return True
-        else:
-            info("file %s not in source list of target %s\n\t%s\n%s %s" % (
-                source, product, '\n\t'.join(sources), cmd_id, '' if sources else target_sources))
-        return False
-
     def generate_unlinked_target(self, cmd_id, target_sources):
         command = self.db.command[cmd_id]
         linkage = command.linkage
@@ -288,7 +302,7 @@ class CmakeConverter(PathUtils):
                 name = ''
                 break
         if name:
-            info("Target %s installed by cmd #%s to %s" % (name, cmd_id, ' '.join([self.relpath(f) for f in files])))
+            info("Target %s installed by cmd #%s to %s", name, cmd_id, self.lazy_relpath(files))
             install_groups = group_keys_by_vv(files, self.db.objects)
             for cmd_id, file_set in install_groups.items():
                 linkage = self.db.command_linkage(cmd_id) if cmd_id >= 0 else 'FILES'
@@ -299,7 +313,7 @@ class CmakeConverter(PathUtils):
             install_groups = group_keys_by_vv({dest: file}, self.db.objects)
             for cmd_id, file_set in install_groups.items():
                 name = destination if destination else dest
-                info("Target %s installed by cmd #%s to %s" % (name, cmd_id, ' '.join([self.relpath(f) for f in files])))
+                info("Target %s installed by cmd #%s to %s", name, cmd_id, self.lazy_relpath(files))
                 linkage = self.db.command_linkage(cmd_id) if cmd_id >= 0 else 'FILES'
                 generator = self.get_generator_for_sources({file, })
                 generator.output_cmake_install(name, command, {file, }, linkage)
@@ -318,35 +332,28 @@ class CmakeConverter(PathUtils):
         return name
 
     def get_generator_for_sources(self, sources):
-        dir_groups = {}
+        return self.get_cmake_generator(self.common_directory(sources))
+
+    def common_directory(self, sources):
+        """
+        The directory of sources if they are all in the same one, the root directory otherwise or without sources.
+        That directory is replaced by the root directory when it is outside of it,
+        or in the binary dir of a build out of source."""
+        common_dir = None
         for source in sources:
             directory = os.path.dirname(source)
-            dir_groups.setdefault(directory, 0)
-            dir_groups[directory] += 1
-        dir_counts = sorted(dir_groups.items(), key=lambda x: x[1])
-        half = len(sources) / 2
-        if dir_counts[0][1] > half:
-            common_dir = dir_counts[0][0]
-        else:
-            dir_groups.clear()
-            root_dir = self.root_dir + '/'
-            for directory, count in dir_counts:
-                if not (directory + '/').startswith(root_dir):
-                    dir_groups.setdefault(self.root_dir, 0)
-                    dir_groups[self.root_dir] += count
-                while (directory + '/').startswith(root_dir):
-                    dir_groups.setdefault(directory, 0)
-                    dir_groups[directory] += count
-                    directory = os.path.dirname(directory)
-            dir_counts = sorted(dir_groups.items(), key=lambda x: x[0].count('/'))
-            for directory, count in dir_counts:
-                if count > half: break
-            common_dir = directory
+            if common_dir is None:
+                common_dir = directory
+            elif directory != common_dir:
+                common_dir = self.root_dir
+                break
+        if common_dir is None:
+            common_dir = self.root_dir
         if not (common_dir+'/').startswith(self.root_dir + '/'):
             common_dir = self.root_dir
         elif not self.in_source_build and (common_dir+'/').startswith(self.binary_dir):
             common_dir = self.root_dir
-        return self.get_cmake_generator(common_dir)
+        return common_dir
 
     def get_cmake_generator(self, directory):
         if self.single_file:
@@ -360,7 +367,7 @@ class CmakeConverter(PathUtils):
         if generator is None:
             relative_binary_dir = relpath(directory, self.root_dir)
             binary_dir = resolve(relative_binary_dir, self.binary_dir)
-            generator = CmakeGenerator(name, directory, self.directory, binary_dir, self.single_file)
+            generator = CmakeGenerator(name, directory, self.directory, binary_dir, self.single_file, self.db)
             generators[name] = generator
         return generator
 
@@ -370,9 +377,8 @@ class CmakeConverter(PathUtils):
             for source in sources:
                 migrate_command(target, source, groups)
         for (dest_pattern, src_pattern), target_sources in groups.items():
-            info("cmd #%s output locale target\n\t%s"
-                 % (cmd_id, '\n\t'.join(
-                    ['%s <- %s' % (self.relpath(t), self.relpath(s)) for t, s in target_sources])))
+            info("cmd #%s output locale target\n\t%s", cmd_id, lazy_join(
+                target_sources, '\n\t', lambda x: '%s <- %s' % (self.relpath(x[0]), self.relpath(x[1]))))
             all_sources = set()
             for target, sources in target_sources: all_sources.add(sources)
             generator = self.get_generator_for_sources(all_sources)
@@ -382,9 +388,8 @@ class CmakeConverter(PathUtils):
     def output_library(self, cmd_id, command, files, linkage):
         generator = self.get_generator_for_sources(files)
         name = name_by_common_prefix(files, self.directory)
-        info("cmd #%s output %s library target %s with %s"
-             % (cmd_id, linkage or 'unlinked', name,
-                ' '.join([self.relpath(f) for f in files])))
+        info("cmd #%s output %s library target %s with %s",
+             cmd_id, linkage or 'unlinked', name, self.lazy_relpath(files))
         generator.output_linked_target(command, files, '', linkage, name, [])
 
 
@@ -1,41 +1,85 @@
 import os
-import logging
-
-import shlex
 import json
+import pickle
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from itertools import islice, zip_longest
 from .utils import *
 from .migration import migrate_install_commands
-from .command import Command
+from .command import Command, ParseCache
+from .reader import read_entries
+from .tokenizer import split_command
+from .denpendency import find_all_dependencies, DependencyJournal
+from .storage import MemoryIndex, BuildGraph, INDEX_FIELDS
 
 
 logger, info, debug, warn, error = get_loggers(__name__)
+PARSE_CHUNK_SIZE = 256
+# parse cache of the worker processes
+PARSE_CACHE = ParseCache()
+# bump it whenever the parse results or the indexes change their layout
+SNAPSHOT_VERSION = 3
+# the indexes saved in the snapshot
+SNAPSHOT_FIELDS = ('index', 'install_command', 'command')
+
+
+def parse_entries(entries, directory, cache=None):
+    """Parse a chunk of entries into (command, target, source) tuples, run in worker processes."""
+    if cache is None:
+        cache = PARSE_CACHE
+    results = []
+    for entry in entries:
+        if not entry: continue
+        source, arguments, cwd = CompilationDatabase.read_entry(entry, directory)
+        cmd, target = Command.parse(arguments, source, cwd, directory, cache)
+        results.append((cmd, target, source))
+    return results
+
+
+def entry_hash(entry):
+    return hashlib.blake2b(json.dumps(entry, sort_keys=True).encode('utf-8'), digest_size=16).digest()
 
 
 class CompilationDatabase(PathUtils):
-    def __init__(self, infile, filename, source_dir=None, build_dir=None):
+    def __init__(self, infile, filename, source_dir=None, build_dir=None, jobs=1, snapshot=None, index=None,
+                 input_format='auto', dep_jobs=1, dep_cache=None, dep_scanner=None, dep_journal=None, dep_timeout=None):
         filename = resolve(filename, os.getcwd())
         build_dir = os.path.dirname(filename) if build_dir is None else resolve(build_dir, os.getcwd())
         PathUtils.__init__(self, source_dir, source_dir)
         self.build_dir = build_dir
-        # targets: {cmd_id: {target: {source, ...}, ...}, ...}
-        self.targets = {}
-        # sources: {source: {target: cmd_id, ...}, ...}
-        self.sources = {}
-        # objects: {target: {source: cmd_id, ...}, ...}
-        self.objects = {}
-        # linkings: {target: {cmd_id: {object_file, ...}, ...}, ...}
-        self.linkings = {}
-        # qt_moc_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
-        self.qt_moc_bucket = {}
-        # qt_ui_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
-        self.qt_ui_bucket = {}
-        # qt_rc_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
-        self.qt_rc_bucket = {}
-        # installs: {cmd_id: {destination: {target, ...}, ...}, ...}
-        self.installs = {}
+        # targets, sources, objects, linkings, qt buckets and installs, see MemoryIndex for their layouts
+        self.index = BuildGraph() if index is None else index
         self.install_command = []
         self.command = []
         self.input = infile
+        self.input_format = input_format
+        self.jobs = jobs
+        self.dep_jobs = dep_jobs
+        # DependencyCache reused across runs, None to run the compiler for every object
+        self.dep_cache = dep_cache
+        # IncludeScanner finding the dependencies in process, None to run the compiler
+        self.dep_scanner = dep_scanner
+        # path of the journal a dependency scan resumes from, None to disable it
+        self.dep_journal = dep_journal
+        # seconds a dependency command may run per source, None for no limit
+        self.dep_timeout = dep_timeout
+        self.parse_cache = ParseCache()
+        # path of the snapshot reused by the next run, None to disable it
+        self.snapshot = snapshot
+        # producers: {generated_file: {source: cmd_id, ...}, ...} of the missing dependencies, None until built
+        self.producers = None
+        # generated_sources: {file, ...} created by SOURCE commands, None until built
+        self.generated_sources = None
+        # closures: {object: (compilations, sources, dependencies), ...}, see object_closure()
+        self.closures = {}
+        self.closing = set()
+
+    def __getattr__(self, name):
+        if name in INDEX_FIELDS:
+            return getattr(self.index, name)
+        raise AttributeError(name)
 
     def binary_dir(self):
         return self.build_dir if self.build_dir else self.directory
@@ -56,109 +100,335 @@ class CompilationDatabase(PathUtils):
         return self.command[cmd_id].cwd
 
     def is_generated(self, source):
-        if source in self.linkings:
-            command_sources = self.linkings[source]
+        if self.generated_sources is None:
+            self.build_dependency_index()
+        return source in self.generated_sources
+
+    def build_dependency_index(self):
+        """
+        Index, once all the entries are read, the commands producing the missing dependencies of the commands,
+        and the files generated by SOURCE commands."""
+        producers = {}
+        for command in self.command:
+            for depends in command.missing_depends.values():
+                for f in depends:
+                    if f in producers: continue
+                    source_map = self.objects.get(f)
+                    if source_map:
+                        producers[f] = source_map
+        generated_sources = set()
+        for target, command_sources in self.linkings.items():
             for cid in command_sources.keys():
                 if self.command_linkage(cid) == 'SOURCE':
-                    return True
+                    generated_sources.add(target)
+                    break
+        self.producers = producers
+        self.generated_sources = generated_sources
+        self.closures = {}
+        debug("Indexed %d generated dependencies and %d generated sources", len(producers), len(generated_sources))
+
+    def object_closure(self, target):
+        """
+        returns (compilations, sources, dependencies) reached from target through the sources it is made of
+        and their missing dependencies, generated ones included, computed once per target.
+        compilations: {cmd_id: {source: product, ...}, ...}, to be merged in order by merge_object_closure()"""
+        closure = self.closures.get(target)
+        if closure is not None:
+            return closure
+        if self.producers is None:
+            self.build_dependency_index()
+        if target in self.closing:
+            warn("Cyclic dependency on %s" % target)
+            return {}, frozenset(), frozenset()
+        self.closing.add(target)
+        try:
+            closure = self.closures[target] = self.compute_object_closure(target)
+        finally:
+            self.closing.discard(target)
+        return closure
 
-    def read(self, infile=None):
+    def compute_object_closure(self, target):
+        compilations = {}
+        sources = set()
+        dependencies = set()
+        for source, cmd_id in self.objects.get(target, {}).items():
+            command = self.command[cmd_id]
+            for f in command.missing_depends.get(target, ()):
+                sources.add(f)
+                dependencies.add(f)
+                compilations.setdefault(cmd_id, {})[f] = target
+                if f in self.producers:
+                    self.merge_object_closure(f, compilations, sources, dependencies)
+            if command.compiler in ('rcc', 'uic'): continue
+            sources.add(source)
+            if command.linkage == 'INSTALL': continue
+            compilations.setdefault(cmd_id, {})[source] = target
+            if source not in self.objects: continue
+            dependencies.add(source)
+            dependencies.update(self.object_closure(source)[2])
+        return compilations, frozenset(sources), frozenset(dependencies)
+
+    def merge_object_closure(self, target, compilations, sources, dependencies):
+        """Add the closure of target to compilations, sources and dependencies"""
+        target_compilations, target_sources, target_dependencies = self.object_closure(target)
+        for cmd_id, products in target_compilations.items():
+            compilations.setdefault(cmd_id, {}).update(products)
+        sources.update(target_sources)
+        dependencies.update(target_dependencies)
+
+    def read(self, infile=None, input_format=None):
         if infile is None:
             infile = self.input
-        database = json.load(infile)
+        entries = read_entries(infile, input_format if input_format else self.input_format)
+        if self.snapshot and isinstance(self.index, (MemoryIndex, BuildGraph)) \
+                and not self.command and not self.install_command:
+            self.read_incrementally(entries)
+        else:
+            self.index_entries(self.parse_entries(entries))
+        self.index.commit()
+        # indexes built on demand from all the entries read
+        self.producers = None
+        self.generated_sources = None
+        self.closures = {}
+        debug("Parse cache %s", self.parse_cache)
+
+    def index_entries(self, results, depends=()):
+        """
+        Index the (cmd, target, source) results in input order, then the missing dependencies of their objects.
+        depends: the missing dependencies already known of each result, None for the ones to find.
+        returns the missing dependencies of each result, None for the ones not an object"""
         cmd_dict = {}
         install_cmd_dict = {}
-        for entry in database:
-            if not entry: continue
-            source, arguments, cwd = CompilationDatabase.read_entry(entry, self.directory)
-            cmd, target = Command.parse(arguments, source, cwd, self.directory)
+        # the option tuples shared by the commands, dropped once they are indexed
+        interned = {}
+        objects = []
+        positions = []
+        count = 0
+        for result, known in zip_longest(results, depends):
+            cmd, target, source = result
             if cmd:
-                self.update_index(cmd, target, source, cmd_dict, install_cmd_dict)
+                cmd = self.update_index(cmd, target, source, cmd_dict, install_cmd_dict, interned)
+                if cmd.linkage == 'OBJECT':
+                    objects.append((cmd, source, target, known))
+                    positions.append(count)
+            count += 1
+        found = [None] * count
+        for i, missing_depends in zip(positions, self.update_object_dependencies(objects)):
+            found[i] = missing_depends
+        return found
+
+    def update_object_dependencies(self, objects):
+        """
+        Find the missing dependencies of the [(cmd, source, target, known), ...] objects, on dep_jobs threads,
+        but for the ones known, not None. returns the missing dependencies of each object"""
+        if not objects: return []
+        tasks = [(source, cmd) for cmd, source, target, known in objects if known is None]
+        results = iter(self.find_dependencies(tasks) if tasks else [])
+        depends = []
+        # feed them back in input order, as if found one after another
+        for cmd, source, target, known in objects:
+            missing_depends = next(results) if known is None else known
+            cmd.add_missing_depends(target, missing_depends, self.directory)
+            depends.append(missing_depends)
+        return depends
+
+    def find_dependencies(self, tasks):
+        """returns the missing dependencies of each (source, cmd) of tasks"""
+        debug("Find dependencies of %d objects with %d jobs", len(tasks), self.dep_jobs)
+        journal = DependencyJournal(self.dep_journal) if self.dep_journal else None
+        try:
+            results = find_all_dependencies(tasks, self.directory, self.dep_jobs, self.dep_cache, self.dep_scanner,
+                                            journal=journal, timeout=self.dep_timeout)
+        except BaseException:
+            if journal is not None:
+                journal.close()
+            raise
+        if journal is not None:
+            debug("Dependency journal %s", journal)
+            journal.complete()
+        if self.dep_scanner is not None:
+            debug("Include scanner %s", self.dep_scanner)
+        elif self.dep_cache is not None:
+            debug("Dependency cache %s", self.dep_cache)
+            self.dep_cache.evict()
+        return results
+
+    def read_incrementally(self, entries):
+        """
+        Parse only the entries not found in the snapshot of the previous run,
+        and replay the indexing of all entries in input order.
+        The missing dependencies of the objects of the entries found are reused, only the new ones are searched.
+        When every entry is found in the same order, the saved indexes are loaded as they are."""
+        snapshot = self.load_snapshot()
+        parsed = snapshot.get('parsed', {})
+        # depends: {key: missing dependencies of the object of the entry, ...}
+        depends = snapshot.get('depends', {})
+        hashes = []
+        new_entries = {}
+        for entry in entries:
+            if not entry: continue
+            key = entry_hash(entry)
+            hashes.append(key)
+            if key not in parsed:
+                new_entries.setdefault(key, entry)
+        if hashes == snapshot.get('hashes'):
+            info("Compilation database unchanged since %s", self.snapshot)
+            self.__dict__.update(pickle.loads(snapshot['state']))
+            return
+
+        for key, result in zip(new_entries.keys(), self.parse_entries(new_entries.values())):
+            # keep the parse result as it is before indexing changes the command
+            parsed[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        found = self.index_entries((pickle.loads(parsed[key]) for key in hashes),
+                                   [None if key in new_entries else depends.get(key) for key in hashes])
+        evicted = len(set(parsed.keys()).difference(hashes))
+        info("Snapshot %s: %d entries parsed, %d reused, %d evicted",
+             self.snapshot, len(new_entries), len(hashes) - len(new_entries), evicted)
+        parsed = dict((key, parsed[key]) for key in hashes)
+        depends = dict((key, missing_depends) for key, missing_depends in zip(hashes, found)
+                       if missing_depends is not None)
+        self.save_snapshot(hashes, parsed, depends)
 
-    def update_index(self, command, target, source, cmd_dict, install_cmd_dict):
+    def load_snapshot(self):
+        if not os.path.isfile(self.snapshot):
+            return {}
+        try:
+            with open(self.snapshot, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            warn("Ignore broken snapshot %s: %s" % (self.snapshot, e))
+            return {}
+        if snapshot.get('version') != SNAPSHOT_VERSION \
+                or snapshot.get('directory') != self.directory or snapshot.get('build_dir') != self.build_dir:
+            info("Ignore outdated snapshot %s", self.snapshot)
+            return {}
+        return snapshot
+
+    def save_snapshot(self, hashes, parsed, depends):
+        state = dict((name, getattr(self, name)) for name in SNAPSHOT_FIELDS)
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'directory': self.directory,
+            'build_dir': self.build_dir,
+            'hashes': hashes,
+            'parsed': parsed,
+            'depends': depends,
+            'state': pickle.dumps(state, pickle.HIGHEST_PROTOCOL),
+        }
+        temp_file = self.snapshot + '.tmp'
+        try:
+            with open(temp_file, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.snapshot)
+        except OSError as e:
+            warn("Failed to save snapshot %s: %s" % (self.snapshot, e))
+
+    def parse_entries(self, entries):
+        entries = iter(entries)
+        if self.jobs <= 1:
+            for chunk in iter(lambda: list(islice(entries, PARSE_CHUNK_SIZE)), []):
+                yield from parse_entries(chunk, self.directory, self.parse_cache)
+            return
+        # keep a bounded number of chunks in flight, and merge the results in input order,
+        # so command ids are assigned exactly as the serial path does.
+        pending = deque()
+        with multiprocessing.Pool(self.jobs) as pool:
+            for chunk in iter(lambda: list(islice(entries, PARSE_CHUNK_SIZE)), []):
+                pending.append(pool.apply_async(parse_entries, (chunk, self.directory)))
+                if len(pending) > self.jobs * 2:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+    def update_index(self, command, target, source, cmd_dict, install_cmd_dict, interned=None):
         extra_sources = sorted(command.missing_depends.get(target, set()))
         command.missing_depends.clear()
         if command.linkage == 'INSTALL':
-            command = self.update_install_index(command, target, source, install_cmd_dict)
+            command = self.update_install_index(command, target, source, install_cmd_dict, interned)
         else:
-            command = self.update_target_index(command, target, source, cmd_dict)
+            command = self.update_target_index(command, target, source, cmd_dict, interned)
         cmd_id = command.id
         for src in extra_sources:
             # self.update_target_index(cmd, target, src, cmd_dict)
-            self.objects.setdefault(target, {})[src] = cmd_id
-            self.sources.setdefault(src, {})[target] = cmd_id
+            self.index.add_object(target, src, cmd_id)
             if command.linkage not in ('OBJECT', 'LOCALE', None):
-                self.update_linking_index(target, cmd_id, src, self.linkings)
-        CompilationDatabase.update_command_after_indexing(command, source, target, self.directory)
+                self.update_linking_index(target, cmd_id, src)
+        return command
 
     @staticmethod
     def read_entry(entry, directory):
         cwd = entry.get('directory', directory)
         file_ = entry.get('file', '')
         if file_: file_ = resolve(file_, cwd)
-        arguments = shlex.split(entry.get('command', ''))
-        arguments = entry.get('arguments', arguments)
+        arguments = entry.get('arguments')
+        if arguments is None:
+            arguments = split_command(entry.get('command', ''))
         return file_, arguments, cwd
 
     @staticmethod
-    def update_command_after_indexing(cmd, source, target, root_dir):
-        if cmd.linkage == 'OBJECT':
-            cmd.update_object_command(source, target, root_dir)
-
-    @staticmethod
-    def update_command_index(cmd, cmd_dict, cmd_list, log=None):
-        frozen_cmd = freeze(cmd)
-        cmd_id = cmd_dict.get(frozen_cmd)
+    def update_command_index(cmd, cmd_dict, cmd_list, log=None, interned=None):
+        key = cmd.fingerprint()
+        cmd_id = cmd_dict.get(key)
         if cmd_id is None:
             cmd_id = len(cmd_list)
-            cmd_dict[frozen_cmd] = cmd_id
+            cmd_dict[key] = cmd_id
             cmd_list.append(cmd)
             cmd.id = cmd_id
+            cmd.compact(interned)
             if log:
-                log('New cmd #%s: %s' % (cmd_id, '\n'.join(["%-10s %s" % x for x in frozen_cmd])))
+                log('New cmd #%s: %s', cmd_id, Lazy(lambda: '\n'.join(["%-10s %s" % x for x in freeze(cmd)])))
         return cmd_list[cmd_id]
 
-    def update_install_index(self, cmd, target, source, cmd_dict):
-        cmd = self.update_command_index(cmd, cmd_dict, self.install_command)
-        debug("Install cmd #%s install %-27s => %s"
-              % (cmd.id, self.relpath(source), self.relpath(target)))
-        self.installs.setdefault(cmd.id, {})[target] = source
+    def update_install_index(self, cmd, target, source, cmd_dict, interned=None):
+        cmd = self.update_command_index(cmd, cmd_dict, self.install_command, interned=interned)
+        debug("Install cmd #%s install %-27s => %s", cmd.id, Lazy(self.relpath, source), Lazy(self.relpath, target))
+        self.index.add_install(cmd.id, target, source)
         return cmd
 
-    def update_target_index(self, cmd, target, source, cmd_dict):
-        cmd = self.update_command_index(cmd, cmd_dict, self.command, debug)
+    def update_target_index(self, cmd, target, source, cmd_dict, interned=None):
+        cmd = self.update_command_index(cmd, cmd_dict, self.command, debug, interned)
         cmd_id = cmd.id
-        debug("entry %-35s cmd #%s => %-10s %s"
-              % (self.relpath(source), cmd_id, cmd.linkage, self.relpath(target)))
-        self.sources.setdefault(source, {})[target] = cmd_id
-        self.objects.setdefault(target, {})[source] = cmd_id
-        self.targets.setdefault(cmd_id, {}).setdefault(target, set()).add(source)
+        debug("entry %-35s cmd #%s => %-10s %s",
+              Lazy(self.relpath, source), cmd_id, cmd.linkage, Lazy(self.relpath, target))
+        self.index.add_object(target, source, cmd_id)
+        self.index.add_target(cmd_id, target, source)
         if cmd.linkage == 'SOURCE':
             compiler = cmd.compiler
             if compiler == 'uic':
-                self.update_linking_index(target, cmd_id, source, self.qt_ui_bucket)
+                self.update_linking_index(target, cmd_id, source, 'qt_ui_bucket')
             elif compiler == 'moc':
-                self.update_linking_index(target, cmd_id, source, self.qt_moc_bucket)
+                self.update_linking_index(target, cmd_id, source, 'qt_moc_bucket')
             elif compiler == 'rcc':
-                self.update_linking_index(target, cmd_id, source, self.qt_rc_bucket)
+                self.update_linking_index(target, cmd_id, source, 'qt_rc_bucket')
             else:
                 self.update_linking_index(target, cmd_id, source)
         elif cmd.linkage not in ('OBJECT', 'LOCALE', None):
-            self.update_linking_index(target, cmd_id, source, self.linkings)
+            self.update_linking_index(target, cmd_id, source)
         return cmd
 
     def update_linking_index(self, target, cmd_id, file_, bucket=None):
-        debug("Add linked target %s from %s"
-              % (self.relpath(target), self.relpath(file_)))
-        self.linkings.setdefault(target, {}).setdefault(cmd_id, set()).add(file_)
+        debug("Add linked target %s from %s", Lazy(self.relpath, target), Lazy(self.relpath, file_))
+        self.index.add_linking('linkings', target, cmd_id, file_)
         if bucket is not None:
-            bucket.setdefault(target, {}).setdefault(cmd_id, set()).add(file_)
+            self.index.add_linking(bucket, target, cmd_id, file_)
+
+    def reduce_target(self, cmd_id, target, source):
+        left = self.index.remove_target_source(cmd_id, target, source)
+        if left is None:
+            target_sources = self.targets.get(cmd_id, {})
+            sources = target_sources.get(target, set())
+            info("file %s not in source list of target %s\n\t%s\n%s %s",
+                 source, target, lazy_join(sources, '\n\t'), cmd_id, '' if sources else target_sources)
+            return False
+        if not left:
+            debug("cmd #%s pop its targets %s", cmd_id, target)
+        return True
 
     def extract_migrated_commands(self):
         migratables = [(cmd_id, tuple(x.keys())[0], tuple(x.values())[0]) for cmd_id, x in
                        (filter(lambda x: len(x[1]) == 1, self.installs.items()))]
         for cmd_id, _, _ in migratables:
-            self.installs.pop(cmd_id)
+            self.index.pop_install(cmd_id)
         return migrate_install_commands(migratables, self.install_command, ('destination', 'id'))
 
 
@@ -1,34 +1,149 @@
 import os
-import subprocess
-from .utils import get_loggers, resolve, resolve_paths
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from .utils import get_loggers, Lazy, lazy_join, resolve, resolve_paths, stat_cache
+from .runner import run_command
 
-__all__ = ['find_dependencies', ]
+__all__ = ['find_dependencies', 'find_all_dependencies', 'DependencyCache', 'DependencyJournal', 'ClangScanDeps',
+           'DEP_CACHE_SIZE', 'DEP_BATCH_SIZE', 'DEP_TIMEOUT']
 logger, info, debug, warn, error = get_loggers(__name__)
+# max bytes kept by a DependencyCache before evicting its least recently used entries
+DEP_CACHE_SIZE = 256 << 20
+# line continuation in the output of -MM, indented with one or two spaces depending on the compiler
+LINE_CONTINUATION = re.compile(r' *\\\n *')
+# max number of sources passed to a single '<compiler> -MM -MG' process
+DEP_BATCH_SIZE = 64
+# seconds a dependency command may run before being killed, whatever the number of its sources,
+# those of a batch killed are then passed one by one
+DEP_TIMEOUT = 300
+# object file of the i-th entry of the compile database given to clang-scan-deps, naming its rule
+SCAN_DEPS_OBJECT = 'json2cmake-dep-%d.o'
+SCAN_DEPS_RULE = re.compile(r'^(?:.*/)?json2cmake-dep-(\d+)\.o:')
 
 
-def find_dependencies(source, command, root_dir):
+def find_dependencies(source, command, root_dir, cache=None, scanner=None):
     cwd = command.cwd
     if not cwd.endswith('/'):
         cwd += '/'
     source = resolve(source, cwd)
-    if not os.path.exists(source):
+    if not stat_cache.exists(source):
         return []
 
-    depend_file = get_depend_file_name(source, cwd)
-    if os.path.exists(depend_file):
-        output = open(depend_file).read().strip()
-    else:
+    if scanner is not None:
+        output = scanner.extract_dependencies(command, source, cwd)
+    elif cache is None:
         output = extract_dependencies(command, source, cwd)
-        open(depend_file, 'w').write(output)
+    else:
+        output = cache.extract_dependencies(command, source, cwd)
+    return parse_dependencies(output, cwd, root_dir)
+
+
+def parse_dependencies(output, cwd, root_dir):
     if not output:
         return []
 
-    output = output.replace('\\\n  ', '')
+    output = LINE_CONTINUATION.sub(' ', output)
     lines = output.split('\n')
     missing_depends = collect_dependencies(lines, cwd, root_dir)
     return resolve_paths(missing_depends, root_dir)
 
 
+def find_all_dependencies(tasks, root_dir, jobs=1, cache=None, scanner=None, batch_size=DEP_BATCH_SIZE,
+                          journal=None, timeout=None):
+    """
+    Find the missing dependencies of each (source, command) of tasks, and return them in the order of tasks.
+    The sources of the same command not found in journal nor cache are passed to one compiler process,
+    batch_size at most, and the batches run on a pool of jobs threads.
+    The output of each batch is appended to journal as soon as it completes, so that a rerun resumes from there.
+    A compiler process is killed after timeout seconds, whatever the number of its sources,
+    then its sources are passed one by one, so that only the ones hanging again are left without dependencies.
+    With an IncludeScanner, which runs no process, the tasks run one by one in the current thread.
+    With ClangScanDeps, the sources not found in cache are scanned by a single clang-scan-deps run first,
+    and only the ones it fails on, like the sources including missing headers, are passed to the compiler."""
+    if isinstance(scanner, ClangScanDeps):
+        bulk_scanner = scanner
+    elif scanner is not None:
+        return [find_dependencies(source, command, root_dir, cache, scanner) for source, command in tasks]
+    else:
+        bulk_scanner = None
+
+    def store(found, cwd):
+        """keep the [(cache_key, output), ...] found in cwd, but the ones timed out"""
+        found = [(key, output) for key, output in found if output is not None]
+        if cache is not None:
+            for key, output in found:
+                cache.put(key, output, cwd)
+        if journal is not None:
+            journal.record(found, cwd)
+
+    results = [[] for _ in tasks]
+    # groups: {id(command): (command, [(task_index, source, cache_key), ...]), ...}
+    groups = {}
+    for i, (source, command) in enumerate(tasks):
+        cwd = command.cwd if command.cwd.endswith('/') else command.cwd + '/'
+        source = resolve(source, cwd)
+        if not stat_cache.exists(source): continue
+        key = output = None
+        if journal is not None:
+            key = dependency_key(command, source, cwd)
+            output = journal.get(key)
+            if output is None and cache is not None:
+                output = cache.get(key)
+        elif cache is not None:
+            key, output = cache.lookup(command, source, cwd)
+        if output is not None:
+            results[i] = parse_dependencies(output, cwd, root_dir)
+            continue
+        groups.setdefault(id(command), (command, []))[1].append((i, source, key))
+    if bulk_scanner is not None and groups:
+        groups = scan_groups_in_bulk(bulk_scanner, groups, results, root_dir, store)
+    batches = []
+    for command, members in groups.values():
+        for start in range(0, len(members), batch_size):
+            batches.append((command, members[start:start + batch_size]))
+
+    def run(batch):
+        command, members = batch
+        cwd = command.cwd if command.cwd.endswith('/') else command.cwd + '/'
+        outputs = extract_batch_dependencies(command, [source for _, source, _ in members], cwd, timeout)
+        store([(key, output) for (_, _, key), output in zip(members, outputs)], cwd)
+        return [(i, parse_dependencies(output, cwd, root_dir)) for (i, _, _), output in zip(members, outputs)]
+
+    if jobs <= 1 or len(batches) <= 1:
+        batch_results = list(map(run, batches))
+    else:
+        with ThreadPool(min(jobs, len(batches))) as pool:
+            batch_results = pool.map(run, batches)
+    for found in batch_results:
+        for i, missing_depends in found:
+            results[i] = missing_depends
+    return results
+
+
+def scan_groups_in_bulk(scanner, groups, results, root_dir, store):
+    """Store the results of the sources of groups scanned by scanner, and return the groups of the others"""
+    members = [(command, member) for command, group in groups.values() for member in group]
+    rules = scanner.scan([(source, command) for command, (_, source, _) in members])
+    remaining = {}
+    for n, (command, member) in enumerate(members):
+        i, source, key = member
+        rule = rules.get(n)
+        if rule is None:
+            remaining.setdefault(id(command), (command, []))[1].append(member)
+            continue
+        cwd = command.cwd if command.cwd.endswith('/') else command.cwd + '/'
+        store([(key, rule)], cwd)
+        results[i] = parse_dependencies(rule, cwd, root_dir)
+    info("%s found the dependencies of %d sources, %d left to the compiler",
+         scanner.executable, len(rules), len(members) - len(rules))
+    return remaining
+
+
 def collect_dependencies(lines, cwd, directory):
     i = 0
     missing_depends = set()
@@ -37,36 +152,99 @@ def collect_dependencies(lines, cwd, directory):
         if line.find(': ') <= 0: continue
         depends = line.split(': ', 1)[1].split(' ')
         depend_list = [f if os.path.isabs(f) else cwd + f for f in depends]
-        debug('Files relative to %s in %s %s\n\t%s' % (i, len(lines), directory, list(
-            filter(lambda x: x.find(':') >= 0, depend_list))))
+        debug('Files relative to %s in %s %s\n\t%s', i, len(lines), directory,
+              Lazy(lambda files: [f for f in files if ':' in f], depend_list))
         depend_list = [os.path.relpath(f, directory) for f in depend_list]
         local_depends = list(filter(lambda x: not x.startswith('../'), depend_list))
         for f in local_depends:
-            if not os.path.exists(f):
+            if not stat_cache.exists(f):
                 missing_depends.add(f)
     return missing_depends
 
 
-def get_depend_file_name(file_, cwd):
-    depend_dir = os.path.join(cwd, '.deps')
-    if not os.path.exists(depend_dir):
-        os.mkdir(depend_dir)
-    basename = os.path.splitext(os.path.basename(file_))[0]
-    depend_file = os.path.join(cwd, '.deps', basename + '.Po')
-    return depend_file
+def depend_files(output, cwd):
+    """All the files listed in the output of '<compiler> -MM', resolved against cwd"""
+    files = []
+    for rule in output.replace('\\\n', ' ').split('\n'):
+        if rule.find(': ') <= 0: continue
+        files.extend(resolve(f, cwd) for f in rule.split(': ', 1)[1].split())
+    return files
 
 
-def extract_dependencies(command, source, cwd):
+def file_mtime(path):
+    return stat_cache.mtime(path)
+
+
+def make_entry(output, cwd):
+    """The output of '<compiler> -MM' in cwd, with the mtimes of the files it lists to tell when it is stale"""
+    return {
+        'output': output,
+        'depends': [(f, file_mtime(f)) for f in depend_files(output, cwd)],
+    }
+
+
+def is_fresh(entry):
+    """Whether the files listed in entry keep their mtimes, missing files staying missing"""
+    for depend, mtime in entry['depends']:
+        if file_mtime(depend) != mtime:
+            return False
+    return True
+
+
+def dependency_key(command, source, cwd):
+    """Key of the dependencies of source compiled by command in cwd, changing with the content of source"""
+    return DependencyCache.key(compose_denpend_command(command, source), cwd, source)
+
+
+def extract_dependencies(command, source, cwd, timeout=None):
     command_line = compose_denpend_command(command, source)
-    debug('check dependencies on %s with command:\n\t%s' % (cwd, ' '.join(command_line)))
-    process = subprocess.Popen(command_line, cwd=cwd, stdout=subprocess.PIPE)
-    output = process.communicate()[0].strip()
-    output = output.decode('utf-8')
+    output = run_depend_command(command_line, cwd, timeout)
+    if output is None:
+        warn("Dependency command of cmd #%s timed out on %s, left without dependencies" % (command.id, source))
     return output
 
 
-def compose_denpend_command(command, source):
-    command_line = [command.compiler, '-MM', '-MG', source]
+def extract_batch_dependencies(command, sources, cwd, timeout=None):
+    """
+    returns the '-MM -MG' output of each of sources, found with a single compiler process.
+    Falls back to a process per source if it timed out, or if the rules of its output do not match the sources,
+    None for the sources timed out on their own."""
+    if len(sources) == 1:
+        return [extract_dependencies(command, sources[0], cwd, timeout)]
+    output = run_depend_command(compose_denpend_command(command, sources), cwd, timeout)
+    if output is None:
+        warn("Dependency command of cmd #%s timed out in %s, find the dependencies of its %d sources one by one"
+             % (command.id, cwd, len(sources)))
+        return [extract_dependencies(command, source, cwd, timeout) for source in sources]
+    rules = split_rules(output)
+    if len(rules) == len(sources):
+        return rules
+    warn("Got %d rules for %d sources from cmd #%s in %s, find their dependencies one by one"
+         % (len(rules), len(sources), command.id, cwd))
+    return [extract_dependencies(command, source, cwd, timeout) for source in sources]
+
+
+def split_rules(output):
+    """Split the output of '<compiler> -MM' into one line per rule"""
+    return [line for line in LINE_CONTINUATION.sub(' ', output).split('\n') if line.find(': ') > 0]
+
+
+def run_depend_command(command_line, cwd, timeout=None):
+    """returns the output of command_line run in cwd, or None if it did not complete in timeout seconds"""
+    debug('check dependencies on %s with command:\n\t%s', cwd, lazy_join(command_line))
+    result = run_command(command_line, cwd, timeout)
+    if result.timed_out:
+        return None
+    if result.returncode:
+        debug("Failed to find dependencies in %s:\n%s", cwd, result.stderr)
+    return result.stdout.strip()
+
+
+def compose_denpend_command(command, sources):
+    if isinstance(sources, str):
+        sources = [sources]
+    command_line = [command.compiler, '-MM', '-MG']
+    command_line.extend(sources)
     command_line.extend(['-D' + p for p in command.definitions])
     command_line.extend(['-I' + p for p in command.includes])
     for p in command.system_includes:
@@ -76,3 +254,266 @@ def compose_denpend_command(command, source):
     if '-fPIC' in command.options:
         command_line.append('-fPIC')
     return command_line
+
+
+class DependencyCache(object):
+    """
+    Output of '<compiler> -MM -MG' kept in a directory shared by all projects,
+    keyed on a hash of the working directory, the dependency command line and the source content.
+    An entry stays valid while the files it lists keep their mtimes, missing files staying missing.
+    When the entries exceed max_size bytes, evict() removes the least recently used ones.
+    Their size is kept in the SIZE_FILE of directory, updated by evict() with the bytes put() added,
+    and the entries are only listed when the cache is full, or the file missing."""
+    SIZE_FILE = 'size'
+
+    def __init__(self, directory, max_size=DEP_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        # bytes added to the entries by put() since the last evict()
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s{directory=%s, hits=%s, misses=%s, stale=%s}" % (
+            self.__class__.__name__, self.directory, self.hits, self.misses, self.stale)
+
+    @staticmethod
+    def key(command_line, cwd, source):
+        digest = hashlib.blake2b(repr((cwd, command_line)).encode('utf-8'), digest_size=20)
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def extract_dependencies(self, command, source, cwd):
+        key, output = self.lookup(command, source, cwd)
+        if output is None:
+            output = extract_dependencies(command, source, cwd)
+            self.put(key, output, cwd)
+        return output
+
+    def lookup(self, command, source, cwd):
+        """returns the key of source compiled by command, and its cached output or None"""
+        key = dependency_key(command, source, cwd)
+        return key, self.get(key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.count('misses')
+            return None
+        if not is_fresh(entry):
+            self.count('stale')
+            return None
+        try:
+            # mark it as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        self.count('hits')
+        return entry['output']
+
+    def put(self, key, output, cwd):
+        entry = make_entry(output, cwd)
+        path = self.path(key)
+        temp_file = '%s.%s.tmp' % (path, threading.get_ident())
+        content = json.dumps(entry)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_file, 'w') as f:
+                f.write(content)
+            replaced = os.stat(path).st_size if os.path.exists(path) else 0
+            os.replace(temp_file, path)
+        except OSError as e:
+            warn("Failed to cache dependencies in %s: %s" % (path, e))
+            return
+        with self.lock:
+            self.added += len(content) - replaced
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def read_size(self):
+        """The size of the entries kept in SIZE_FILE, None if it is missing"""
+        try:
+            with open(os.path.join(self.directory, self.SIZE_FILE), 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def write_size(self, total):
+        path = os.path.join(self.directory, self.SIZE_FILE)
+        temp_file = '%s.%s.tmp' % (path, threading.get_ident())
+        try:
+            with open(temp_file, 'w') as f:
+                f.write('%d\n' % total)
+            os.replace(temp_file, path)
+        except OSError as e:
+            warn("Failed to save the size of dependency cache %s: %s" % (self.directory, e))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until they fit in max_size, returns the number removed.
+        Nothing is done when put() added nothing, and the entries are listed only when they exceed max_size."""
+        with self.lock:
+            added, self.added = self.added, 0
+        if not added:
+            return 0
+        total = self.read_size()
+        if total is not None and total + added <= self.max_size:
+            self.write_size(total + added)
+            return 0
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'): continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self.write_size(total)
+        if removed:
+            debug("Evicted %d entries from dependency cache %s", removed, self.directory)
+        return removed
+
+
+class DependencyJournal(object):
+    """
+    Progress of a dependency scan, appended to a JSON Lines file as each batch of sources completes,
+    and flushed to disk, so that a scan interrupted is resumed from the last completed source by the next run.
+    The file is removed by complete() once the scan is over."""
+    def __init__(self, filename):
+        self.filename = filename
+        # entries: {key: {'output': output, 'depends': [(file, mtime), ...]}, ...}
+        self.entries = {}
+        self.resumed = 0
+        self.lock = threading.Lock()
+        self.load()
+        self.file = open(filename, 'a')
+
+    def __repr__(self):
+        return "%s{filename=%s, entries=%s, resumed=%s}" % (
+            self.__class__.__name__, self.filename, len(self.entries), self.resumed)
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb+') as f:
+                data = f.read()
+                complete = data.rfind(b'\n') + 1
+                if complete < len(data):
+                    # drop the last line of an interrupted write, not to append the next records to it
+                    f.truncate(complete)
+        except OSError:
+            return
+        for line in data[:complete].decode('utf-8', 'replace').split('\n'):
+            if not line: continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.entries[entry.pop('key')] = entry
+        if self.entries:
+            info("Resume the dependency scan of %d sources from %s", len(self.entries), self.filename)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or not is_fresh(entry):
+            return None
+        with self.lock:
+            self.resumed += 1
+        return entry['output']
+
+    def record(self, found, cwd):
+        """Append the [(key, output), ...] found in cwd, and flush them to disk"""
+        if not found: return
+        lines = []
+        for key, output in found:
+            entry = make_entry(output, cwd)
+            entry['key'] = key
+            lines.append(json.dumps(entry) + '\n')
+        with self.lock:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def complete(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class ClangScanDeps(object):
+    """
+    Find the dependencies of many sources with a single run of clang-scan-deps,
+    which scans them in parallel from a temporary compile database.
+    It fails on the sources including missing headers, those are left to '<compiler> -MM -MG'."""
+    def __init__(self, executable='clang-scan-deps', jobs=None):
+        self.executable = executable
+        self.jobs = jobs
+
+    def __repr__(self):
+        return "%s{executable=%s, jobs=%s}" % (self.__class__.__name__, self.executable, self.jobs)
+
+    def scan(self, tasks):
+        """returns {index: rule, ...} for the (source, command) of tasks scanned successfully"""
+        executable = shutil.which(self.executable)
+        if not executable:
+            warn("%s not found, find the dependencies with the compiler" % self.executable)
+            return {}
+        entries = []
+        for i, (source, command) in enumerate(tasks):
+            arguments = [command.compiler, '-c', source, '-o', SCAN_DEPS_OBJECT % i]
+            arguments.extend(compose_denpend_command(command, [])[3:])
+            entries.append({'directory': command.cwd, 'file': source, 'arguments': arguments})
+        with tempfile.TemporaryDirectory(prefix='json2cmake-') as temp_dir:
+            database = os.path.join(temp_dir, 'compile_commands.json')
+            with open(database, 'w') as f:
+                json.dump(entries, f)
+            command_line = [executable, '-compilation-database=' + database, '-format=make']
+            if self.jobs:
+                command_line.extend(['-j', str(self.jobs)])
+            debug('scan dependencies of %d sources with command:\n\t%s', len(entries), lazy_join(command_line))
+            result = run_command(command_line)
+        if result.returncode:
+            debug("%s failed on some sources:\n%s", self.executable, result.stderr)
+        return self.split_output(result.stdout, len(entries))
+
+    @staticmethod
+    def split_output(output, count):
+        """returns {index: rule, ...} of the rules of SCAN_DEPS_OBJECT targets in output"""
+        rules = {}
+        for rule in split_rules(output):
+            m = SCAN_DEPS_RULE.match(rule)
+            if m is None: continue
+            i = int(m.group(1))
+            if i < count:
+                rules[i] = rule
+        return rules
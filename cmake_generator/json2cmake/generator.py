@@ -1,5 +1,6 @@
 import os
 import re
+import heapq
 import logging
 from io import StringIO
 from .utils import *
@@ -13,9 +14,13 @@ logger, info, debug, warn, error = get_loggers(__name__)
 
 class CmakeGenerator(PathUtils):
     used_names = {"": ""}
+    # set in the worker processes, where a target not named beforehand would get another name than in the others,
+    # use_target_name() raises KeyError on such a target instead, to render the generator in the main process
+    names_frozen = False
 
-    def __init__(self, name, cwd, root_dir, binary_dir, single_file=False):
+    def __init__(self, name, cwd, root_dir, binary_dir, single_file=False, db=None):
         PathUtils.__init__(self, cwd, root_dir)
+        self.db = db
         self.generated = False
         self.binary_dir = binary_dir
         self.name = name
@@ -29,6 +34,8 @@ class CmakeGenerator(PathUtils):
         self.other_installs = []
         self.common_configs = {}
         self.install_prefix = '/'
+        # the targets write_targets() outputs, planned by name_targets() before rendering in another process
+        self.planned_targets = None
 
     def relpath(self, path, root=None):
         return relpath(path, self.directory, root if root else self.root_dir)
@@ -61,19 +68,37 @@ class CmakeGenerator(PathUtils):
                 max_count = count
         return directory
 
+    def setup_directory(self):
+        """Move the generator to the directory of most of its sources, returns its directory"""
+        if self.generated: return self.directory
+        directory = self.guess_source_dir(self.directory, self.targets)
+        if self.directory != directory:
+            self.binary_dir = self.directory
+            self.directory = directory
+        return directory
+
     def setup_output(self, output=None):
         if self.generated: return self.directory
         directory = self.directory
         if output is None:
-            directory = self.guess_source_dir(directory, self.targets)
-            if self.directory != directory:
-                self.binary_dir = self.directory
-                self.directory = directory
+            directory = self.setup_directory()
             self.output = open(os.path.join(directory, 'CMakeLists.txt'), 'w')
         else:
             self.output = output
         return directory
 
+    def render(self):
+        """The content of the CMakeLists.txt written by write_to_file(), kept in memory"""
+        self.setup_output(StringIO())
+        self.write_to_file()
+        return self.output.getvalue()
+
+    def save(self, content):
+        """Write the content rendered by render(), possibly in another process, to the CMakeLists.txt"""
+        self.generated = True
+        with open(os.path.join(self.directory, 'CMakeLists.txt'), 'w') as output:
+            output.write(content)
+
     def write_to_file(self):
         if self.generated: return
         self.generated = True
@@ -96,7 +121,7 @@ class CmakeGenerator(PathUtils):
                 cpp_targets.append(target)
         for arg_name in args_with_common:
             arg_values = [getattr(t.command, arg_name) for t in cpp_targets]
-            self.common_configs[arg_name] = get_common_values(arg_values)
+            self.common_configs[arg_name] = OrderedSet(get_common_values(arg_values))
         return args_with_common
 
     def get_lib_replacement(self, libs):
@@ -123,16 +148,21 @@ class CmakeGenerator(PathUtils):
 
     @staticmethod
     def replace_list_content(members, replacement, not_uniq=False):
-        new_list = []
+        new_list = [] if not_uniq else OrderedSet()
         for member in list(members):
             member = replacement.get(member, member)
-            if not_uniq or member not in new_list:
+            if not_uniq:
                 new_list.append(member)
+            else:
+                new_list.add(member)
+        if isinstance(members, tuple):
+            return tuple(new_list)
         members.clear()
         if isinstance(members, set):
             members.update(new_list)
         else:
             members.extend(new_list)
+        return members
 
     def collect_package_imports(self):
         includes = set()
@@ -154,15 +184,16 @@ class CmakeGenerator(PathUtils):
     def replace_with_package_vars(self, lib_replacement, include_replacement):
         for target in self.targets.values():
             if not isinstance(target, CppTarget): continue
-            self.replace_list_content(target.libs, lib_replacement)
-            self.replace_list_content(target.command.includes, include_replacement)
-            self.replace_list_content(target.command.system_includes, include_replacement)
-            self.replace_list_content(target.command.iquote_includes, include_replacement)
+            target.libs = self.replace_list_content(target.libs, lib_replacement)
+            command = target.command
+            command.includes = self.replace_list_content(command.includes, include_replacement)
+            command.system_includes = self.replace_list_content(command.system_includes, include_replacement)
+            command.iquote_includes = self.replace_list_content(command.iquote_includes, include_replacement)
         include_args = ('includes', 'system_includes', 'iquote_includes')
         for arg_name in include_args:
             common_includes = self.common_configs.get(arg_name, None)
             if common_includes:
-                self.replace_list_content(common_includes, include_replacement)
+                self.common_configs[arg_name] = self.replace_list_content(common_includes, include_replacement)
 
     def write_common_configs(self):
         args_with_common = ('options', 'link_options', 'definitions',
@@ -180,19 +211,55 @@ class CmakeGenerator(PathUtils):
             target.bind(self)
             target.output_target()
 
-    def write_targets(self):
+    def sort_targets(self):
+        """
+        The targets in dependency order, each after the targets it depends on, then by key when independent.
+        Targets kept under several keys are listed once, the targets of a cycle after all the others."""
         targets = []
+        names = set()
         for _, target in sorted(self.targets.items()):
-            for t in targets:
-                if t.name() == target.name():
-                    target = None
-                    break
-                if target.target in t.depends:
-                    targets.insert(targets.index(t), target)
-                    target = None
-                    break
-            if target is not None:
-                targets.append(target)
+            name = target.name()
+            if name in names: continue
+            names.add(name)
+            targets.append(target)
+        positions = dict((target.target, i) for i, target in reversed(list(enumerate(targets))))
+        # dependents: [[position of a target depending on it, ...], ...]
+        dependents = [[] for _ in targets]
+        in_degrees = [0] * len(targets)
+        for i, target in enumerate(targets):
+            for depend in set(positions.get(path) for path in target.depends):
+                if depend is None or depend == i: continue
+                dependents[depend].append(i)
+                in_degrees[i] += 1
+        ready = [i for i, in_degree in enumerate(in_degrees) if not in_degree]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            i = heapq.heappop(ready)
+            ordered.append(targets[i])
+            for dependent in dependents[i]:
+                in_degrees[dependent] -= 1
+                if not in_degrees[dependent]:
+                    heapq.heappush(ready, dependent)
+        if len(ordered) < len(targets):
+            cyclic = [target for i, target in enumerate(targets) if in_degrees[i]]
+            warn("Cyclic dependencies between targets of %s: %s"
+                 % (self.directory, ' '.join(target.name() for target in cyclic)))
+            ordered.extend(cyclic)
+        return ordered
+
+    def name_targets(self):
+        """
+        Plan the targets of the generator, and name the targets they refer to in the order write_targets() names them,
+        so that they are all known before the generator is rendered in another process."""
+        self.planned_targets = self.plan_targets()
+        for target in self.planned_targets:
+            target.bind(self)
+            target.name_references()
+
+    def plan_targets(self):
+        """The targets in the order write_targets() outputs them, the independent ones of the same command merged"""
+        targets = self.sort_targets()
 
         merged_command = {}
         target_group_by_cmd = {}
@@ -203,20 +270,20 @@ class CmakeGenerator(PathUtils):
             else:
                 merged_command.setdefault(target.command.id, target.command)
                 target_group_by_cmd.setdefault(target.command.id, []).append(target)
+        planned = []
         for cmd_id, command in merged_command.items():
             target_group = target_group_by_cmd[cmd_id]
             if len(target_group) == 1:
-                merged_targets = target_group
+                planned.extend(target_group)
             else:
-                merged_targets = self.merge_targets(cmd_id, command, target_group)
-            for target in merged_targets:
-                target.bind(self)
-                target.output_target()
-        for target in targets_with_depends:
-            target.bind(self)
-            target.output_target()
-        migrated_targets = self.migrate_targets(self.other_installs)
-        for target in migrated_targets:
+                planned.extend(self.merge_targets(cmd_id, command, target_group))
+        planned.extend(targets_with_depends)
+        planned.extend(self.migrate_targets(self.other_installs))
+        return planned
+
+    def write_targets(self):
+        targets = self.planned_targets if self.planned_targets is not None else self.plan_targets()
+        for target in targets:
             target.bind(self)
             target.output_target()
 
@@ -227,9 +294,8 @@ class CmakeGenerator(PathUtils):
                 migrate_command(target.target, source, groups)
         wrappers = []
         for (dest_pattern, src_pattern), target_sources in groups.items():
-            info("cmd #%s output custom built source\n\t%s"
-                 % (cmd_id, '\n\t'.join(
-                ['%s <- %s' % (self.relpath(t), self.relpath(s)) for t, s in target_sources])))
+            info("cmd #%s output custom built source\n\t%s", cmd_id, lazy_join(
+                target_sources, '\n\t', lambda x: '%s <- %s' % (self.relpath(x[0]), self.relpath(x[1]))))
             wrapper = self.migrate_custom_targets(cmd_id, command, dest_pattern,
                                                   src_pattern, target_sources, "Sources")
             wrappers.append(wrapper)
@@ -301,7 +367,7 @@ class CmakeGenerator(PathUtils):
 
     def write_project_header(self):
         self.write('cmake_minimum_required(VERSION 2.8.8)\n')
-        info("write project %s in directory \t%s" % (self.name, self.directory))
+        info("write project %s in directory \t%s", self.name, self.directory)
         self.write('project({} LANGUAGES C CXX)\n\n'.format(self.name))
 
         for target in self.targets.values():
@@ -317,10 +383,7 @@ class CmakeGenerator(PathUtils):
         return "${CMAKE_CURRENT_SOURCE_DIR}/%s" % self.relpath(path)
 
     def get_include_path(self, include_path):
-        if include_path.startswith(self.root_dir + '/') \
-                or include_path == self.root_dir:
-            return os.path.relpath(include_path, self.directory)
-        return include_path
+        return relpath(include_path, self.directory, self.root_dir)
 
     def name_for_lib(self, path):
         rel_path = self.relpath(path)
@@ -338,9 +401,11 @@ class CmakeGenerator(PathUtils):
         used_name = self.used_names.get(path)
         if used_name:
             return used_name
+        if self.names_frozen:
+            raise KeyError('target %s for %s is not named before rendering %s' % (name, path, self.directory))
         used_path = self.used_names.get(name)
         if used_path is not None:
-            info('use_target_name %s with duplicate path: %s %s on %s' % (name, path, used_path, self.directory))
+            info('use_target_name %s with duplicate path: %s %s on %s', name, path, used_path, self.directory)
             name = self.unique_name(name)
         self.used_names[name] = path
         self.used_names[path] = name
@@ -359,13 +424,13 @@ class CmakeGenerator(PathUtils):
         return name
 
     def output_subdirectory(self, directory):
-        info("Project in %s add subdirectory %s"
-             % (relpath(self.directory, self.root_dir), relpath(directory, self.directory)))
+        info("Project in %s add subdirectory %s",
+             Lazy(relpath, self.directory, self.root_dir), Lazy(relpath, directory, self.directory))
         self.write("add_subdirectory(%s)\n" % self.relpath(directory))
 
     def output_linked_target(self, command, files, target, libtype, name, depends):
-        debug("Target %s output linked %s %s for %s"
-              % (name, libtype, self.relpath(target), self.joined_relpath(files)))
+        debug("Target %s output linked %s %s for %s",
+              name, libtype, Lazy(self.relpath, target), self.lazy_relpath(files))
         if not libtype or libtype == 'EXECUTABLE':
             name = self.use_target_name(name, target)
             linked_target = ExecutableTarget(command, target, files)
@@ -403,7 +468,7 @@ class CmakeGenerator(PathUtils):
         if not parts:
             return
         parts = [self.get_include_path(include) for include in parts]
-        info("Target %s includes %s %s" % (name, options, ' '.join(parts)))
+        info("Target %s includes %s %s", name, options, lazy_join(parts))
         self.write_command('target_include_directories', options, name, parts)
 
     def output_custom_command(self, target, command, sources):
@@ -429,7 +494,7 @@ class CmakeGenerator(PathUtils):
             #fields = [matcher.match(x[0]).groups()[0] for x in paths]
         else:
             fields.append("''")
-        info("%s created by cmd #%s to %s" % (kind, cmd_id, ' '.join(fields)))
+        info("%s created by cmd #%s to %s", kind, cmd_id, lazy_join(fields))
         dest = dest_pattern % {'0': '${X}'}
         source = src_pattern % {'0': '${X}'}
         custom_command = CustomCommandTarget(command, dest, [source, ])
@@ -450,7 +515,7 @@ class CmakeGenerator(PathUtils):
         for f in file_set:
             if f in self.targets:
                 self.targets[f].add_destination(destination)
-            elif linkage != 'EXECUTABLE' and os.path.isdir(f):
+            elif linkage != 'EXECUTABLE' and stat_cache.isdir(f):
                 directories.append(f)
             else:
                 files.append(f)
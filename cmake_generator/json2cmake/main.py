@@ -2,10 +2,14 @@
 import os
 import sys
 import argparse
-import subprocess
 import logging
-from cmake_generator.json2cmake.utils import get_loggers, resolve
+from cmake_generator.json2cmake.utils import get_loggers, resolve, path_cache_info, stat_cache
 from cmake_generator.json2cmake.database import CompilationDatabase
+from cmake_generator.json2cmake.storage import SqliteIndex
+from cmake_generator.json2cmake.reader import FORMATS, read_entries, write_json_lines
+from cmake_generator.json2cmake.denpendency import DependencyCache, ClangScanDeps, DEP_CACHE_SIZE, DEP_TIMEOUT
+from cmake_generator.json2cmake.scanner import IncludeScanner
+from cmake_generator.json2cmake.runner import run_command, get_runner
 from cmake_generator.json2cmake.converter import CmakeConverter
 
 logger, info, debug, warn, error = get_loggers(__name__)
@@ -18,14 +22,11 @@ def get_default_name(compilation_database):
     if not os.path.isfile(filename):
         return 'autogenerated'
     directory = os.path.dirname(filename)
-    try:
-        output = subprocess.Popen(
-            ['git', 'rev-parse', '--show-toplevel'],
-            cwd=directory, stdout=subprocess.PIPE).communicate()[0]
-        output = output.strip()
-        return os.path.basename(output).decode('utf-8')
-    except Exception:
+    result = run_command(['git', 'rev-parse', '--show-toplevel'], directory)
+    if result.returncode == 127:
         return 'autogenerated'
+    output = result.stdout.strip()
+    return os.path.basename(output)
 
 
 def main():
@@ -81,6 +82,82 @@ which may be difficult to get automatically captured using a ld logger.
     directory to run de build (default: parent directory of the compile_commands.json file)
             """
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help="""
+number of worker processes parsing the compilation database,
+and rendering the CMakeLists.txt files of the directories with -m (default: 1)
+        """
+    )
+    parser.add_argument(
+        '--dep-jobs', type=int, default=os.cpu_count() or 1,
+        help="""
+number of external processes run at the same time, like the compilers finding header dependencies
+(default: number of CPUs)
+        """
+    )
+    parser.add_argument(
+        '--dep-scanner', choices=('compiler', 'python', 'clang-scan-deps'), default='compiler',
+        help="""
+find header dependencies by running the compiler with -MM, by scanning the includes in python,
+which runs no process but follows all conditional blocks but '#if 0',
+or by a single run of clang-scan-deps, leaving the sources it fails on to the compiler (default: compiler)
+        """
+    )
+    parser.add_argument(
+        '--dep-cache', action='store',
+        default=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'json2cmake', 'deps'),
+        help="""
+directory caching the header dependencies of the sources, empty to disable it (default: %(default)s)
+        """
+    )
+    parser.add_argument(
+        '--dep-cache-size', type=int, default=DEP_CACHE_SIZE >> 20,
+        help="""
+max size in MiB of the dependency cache, the least recently used entries are evicted beyond it (default: %(default)s)
+        """
+    )
+    parser.add_argument(
+        '--dep-timeout', type=float, default=DEP_TIMEOUT,
+        help="""
+seconds a dependency command may run, for all its sources, before being killed, 0 for no limit.
+The sources of a command killed are passed one by one, each with the same limit
+(default: %(default)s)
+        """
+    )
+    parser.add_argument(
+        '--no-dep-journal', action='store_true', default=False, help="""
+do not record the progress of the dependency scan in <infile>.deps-journal, for an interrupted run to resume from
+        """
+    )
+    parser.add_argument(
+        '--stat-prewarm', action='store_true', default=False, help="""
+list the whole source tree once before converting, so that probing its files takes no more syscalls,
+faster on network file systems
+        """
+    )
+    parser.add_argument(
+        '--no-snapshot', action='store_true', default=False, help="""
+do not reuse nor save the parsed compilation database in <infile>.snapshot
+        """
+    )
+    parser.add_argument(
+        '--sqlite', action='store', default=None, help="""
+keep the indexes of the compilation database in this SQLite file instead of memory,
+for databases too large to fit in memory (disables the snapshot)
+        """
+    )
+    parser.add_argument(
+        '-f', '--format', choices=FORMATS, default='auto', help="""
+format of the compilation database, a JSON array (json) or one entry per line (jsonl),
+told by its first character in auto mode (default: auto)
+        """
+    )
+    parser.add_argument(
+        '--export-jsonl', type=argparse.FileType('w'), default=None, help="""
+write the compilation database to this file as JSON Lines, and exit without generating CMake files
+        """
+    )
     args = parser.parse_args()
     if args.debug:
         logging.basicConfig(format=FORMAT, level=logging.DEBUG)
@@ -89,6 +166,12 @@ which may be difficult to get automatically captured using a ld logger.
         logging.basicConfig(format=FORMAT, level=logging.INFO)
         logger.setLevel(logging.INFO)
 
+    if args.export_jsonl:
+        count = write_json_lines(read_entries(args.infile, args.format), args.export_jsonl)
+        args.export_jsonl.close()
+        info("Exported %d entries to %s", count, args.export_jsonl.name)
+        return
+
     if args.name is None:
         args.name = get_default_name(args.infile)
 
@@ -99,13 +182,41 @@ which may be difficult to get automatically captured using a ld logger.
     source_dir = os.path.dirname(outfile)
     build_dir = os.path.dirname(filename) if args.build_dir is None else args.build_dir
     build_dir = resolve(build_dir, cwd)
-    db = CompilationDatabase(args.infile, filename, source_dir, build_dir)
+    snapshot = None
+    index = None
+    if args.sqlite:
+        try:
+            index = SqliteIndex(resolve(args.sqlite, cwd))
+        except ValueError as e:
+            parser.error(str(e))
+    elif os.path.isfile(args.infile.name) and not args.no_snapshot:
+        snapshot = filename + '.snapshot'
+    get_runner().limit = max(args.dep_jobs, 1)
+    if args.stat_prewarm:
+        info("Listed %d directories of %s", stat_cache.prewarm(source_dir), source_dir)
+    dep_cache = DependencyCache(args.dep_cache, args.dep_cache_size << 20) if args.dep_cache else None
+    dep_scanner = None
+    if args.dep_scanner == 'python':
+        dep_scanner = IncludeScanner()
+    elif args.dep_scanner == 'clang-scan-deps':
+        dep_scanner = ClangScanDeps(jobs=args.dep_jobs)
+    dep_journal = None
+    if os.path.isfile(args.infile.name) and not args.no_dep_journal:
+        dep_journal = filename + '.deps-journal'
+    db = CompilationDatabase(args.infile, filename, source_dir, build_dir, args.jobs, snapshot, index, args.format,
+                             args.dep_jobs, dep_cache, dep_scanner, dep_journal, args.dep_timeout or None)
     db.read()
     if os.path.isfile(args.extra_infile):
-        db.read(open(args.extra_infile, 'r'))
+        db.read(open(args.extra_infile, 'r'), 'auto')
     single = not args.multiple_file
-    cmake_converter = CmakeConverter(db, args.name, db.directory, single)
+    cmake_converter = CmakeConverter(db, args.name, db.directory, single, args.jobs)
     cmake_converter.convert()
+    db.index.close()
+    for name, cache_info in sorted(path_cache_info().items()):
+        debug("Path cache %s: %s", name, cache_info)
+    info("Stat cache saved %d of %d file system probes", stat_cache.saved, stat_cache.calls)
+    debug("Stat cache: %s", stat_cache)
+    debug("Process runner: %s", get_runner())
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@ import os
 import re
 from diff_match_patch.diff_match_patch import diff_match_patch
 
-from .utils import get_loggers, freeze, DISALLOWED_CHARACTERS
+from .utils import get_loggers, lazy_join, stat_cache, DISALLOWED_CHARACTERS
 
 __all__ = ['get_diff_pattern', 'migrate_command', 'migrate_install_commands',
            'get_matched_parts', 'name_by_common_prefix',
@@ -87,8 +87,7 @@ def extend_diff_pattern(pattern, fields, strict=False):
 
 def migrate_command(target, source, groups, strict=False, max_group=1):
     if not groups:
-        info('Initialize empty group with source & target\n\t%s => %s'
-             % (target, source))
+        info('Initialize empty group with source & target\n\t%s => %s', target, source)
         groups[(target, '')] = [(target, source), ]
         return True
 
@@ -103,8 +102,8 @@ def migrate_command(target, source, groups, strict=False, max_group=1):
                 converted_target = dest % convert_dict
                 if converted_target == target:
                     target_files.append((target, source))
-                    debug(('Existed pattern\t%s\t%s\n\t' % (src_pattern, dest)) +
-                          ('matches source and target\t%s\t%s\n' % (source, target)))
+                    debug('Existed pattern\t%s\t%s\n\tmatches source and target\t%s\t%s\n',
+                          src_pattern, dest, source, target)
                     return True
 
     for (dest, src_pattern), target_files in groups.items():
@@ -113,12 +112,8 @@ def migrate_command(target, source, groups, strict=False, max_group=1):
         if not file_fields or len(file_fields) > max_group: continue
         dest_pattern, dest_fields = get_diff_pattern(dest, target, strict)
         if not dest_pattern: continue
-        debug('\n\t'.join([
-            'Found pattern %s with fields %s for' % (dest_pattern, dest_fields),
-            dest, target,
-            'src_pattern=\t' + src_pattern,
-            'file_pattern=\t' + file_pattern
-        ]))
+        debug('Found pattern %s with fields %s for\n\t%s\n\t%s\n\tsrc_pattern=\t%s\n\tfile_pattern=\t%s',
+              dest_pattern, dest_fields, dest, target, src_pattern, file_pattern)
 
         field_dict = {}
         pattern_ok = True
@@ -129,11 +124,11 @@ def migrate_command(target, source, groups, strict=False, max_group=1):
             field_dict[str(file_fields.index(field))] = field[1]
         if not pattern_ok: continue
 
-        info('migrating under %s\t%s\n''got\t%s\n\t%s\n''for\t%s\n\t%s\nand\t%s'
-             % (prev_pattern, field_dict,
-                dest_pattern, target,
-                file_pattern, source,
-                '\n\t'.join(["%s <- %s" % (t, f) for f, t in target_files[:3]])))
+        info('migrating under %s\t%s\n''got\t%s\n\t%s\n''for\t%s\n\t%s\nand\t%s',
+             prev_pattern, field_dict,
+             dest_pattern, target,
+             file_pattern, source,
+             lazy_join(target_files[:3], '\n\t', lambda x: "%s <- %s" % (x[1], x[0])))
         target_files.append((target, source))
         if src_pattern != file_pattern:
             if src_pattern:
@@ -141,15 +136,15 @@ def migrate_command(target, source, groups, strict=False, max_group=1):
                 for target, file_ in target_files:
                     if not matcher.match(file_):
                         return True
-                info('migrate_command when %s\n\t replace\t%s\n\t ===>\t%s\n targets:\n\t%s'
-                     % ((source, target),
-                        (dest, src_pattern),
-                        (dest_pattern, file_pattern),
-                        '\n\t'.join(["%s\t%s" % x for x in target_files])))
+                info('migrate_command when %s\n\t replace\t%s\n\t ===>\t%s\n targets:\n\t%s',
+                     (source, target),
+                     (dest, src_pattern),
+                     (dest_pattern, file_pattern),
+                     lazy_join(target_files, '\n\t', lambda x: "%s\t%s" % x))
             groups.pop((dest, src_pattern))
             groups[(dest_pattern, file_pattern)] = target_files
         return True
-    info('No matching pattern %s in groups' % target)
+    info('No matching pattern %s in groups', target)
     groups[(target, '')] = [(target, source), ]
     return True
 
@@ -162,7 +157,7 @@ def get_matched_parts(pattern, files):
         if match and match.groups():
             matched.append(match.groups()[0])
         else:
-            debug('Fail to match %s in %s' % (pattern, file_))
+            debug('Fail to match %s in %s', pattern, file_)
     return matched
 
 
@@ -185,16 +180,17 @@ def migrate_install_commands(migratables, install_command, diff_keys=()):
     for cmd_id, target, file_ in migratables:
         command = install_command[cmd_id].copy()
         for key in diff_keys: setattr(command, key, None)
-        frozen_command = freeze(command)
-        new_cmd_id = migrated_commands.get(frozen_command)
+        command.changed()
+        key = command.fingerprint()
+        new_cmd_id = migrated_commands.get(key)
         if new_cmd_id is None:
             new_cmd_id = cmd_id
-            migrated_commands[frozen_command] = new_cmd_id
+            migrated_commands[key] = new_cmd_id
             install_command[new_cmd_id] = command
             command.id = new_cmd_id
         dest_groups = groups.setdefault(new_cmd_id, {})
         migrate_command(target, file_, dest_groups)
-        debug('Install cmd #%d migrated into cmd #%d' % (cmd_id, new_cmd_id))
+        debug('Install cmd #%d migrated into cmd #%d', cmd_id, new_cmd_id)
     return groups
 
 def group_keys_by_vv(files, objects):
@@ -205,7 +201,7 @@ def group_keys_by_vv(files, objects):
     for key in files.values():
         vk2vv = objects.get(key)
         if vk2vv is None:
-            if not os.path.isfile(key):
+            if not stat_cache.isfile(key):
                 warn('No command to create installed file: ' + key)
             groups.setdefault(-1, set()).add(key)
             continue
@@ -215,15 +211,18 @@ def group_keys_by_vv(files, objects):
 
 
 def get_common_values(arg_values):
-    value_filter = None
+    first_values = None
+    filtered = False
     for values in arg_values:
         if values:
-            if value_filter is None:
-                value_filter = iter(values)
+            if first_values is None:
+                first_values = values
                 continue
-            value_filter = filter(lambda x: x in values, value_filter)
-    if value_filter is None:
-        common_values = []
-    else:
-        common_values = list(value_filter)
-    return common_values
+            filtered = True
+    if first_values is None:
+        return []
+    if not filtered:
+        return list(first_values)
+    # the chained lazy filters this replaces all read the loop variable when evaluated, the last values
+    last_values = frozenset(values)
+    return [x for x in first_values if x in last_values]
@@ -1,7 +1,7 @@
 import os
 import re
-import subprocess
 from .utils import get_loggers
+from .runner import run_command, run_commands
 from .collect_cmake_vars import *
 
 logger, info, debug, warn, error = get_loggers(__name__)
@@ -25,14 +25,15 @@ CMAKE_INCLUDE_DIRS = {}
 
 
 def get_pkg_config_info(pkg_config_vars_path):
-    pcs = subprocess.getoutput('pkg-config --list-all').splitlines(False)
-    pcs = list(map(lambda x: x.split(' ', 1)[0], pcs))
+    pcs = run_command(['pkg-config', '--list-all']).output.splitlines(False)
+    pcs = list(filter(None, map(lambda x: x.split(' ', 1)[0], pcs)))
+    # all the packages queried at the same time
+    outputs = run_commands([(['pkg-config', option, pc], {}) for pc in pcs for option in ('--libs', '--cflags')])
     lines = []
-    for pc in pcs:
-        if not pc: continue
+    for i, pc in enumerate(pcs):
         try:
             command = 'pkg-config --libs ' + pc
-            result = subprocess.getoutput(command).split(' ')
+            result = outputs[2 * i].output.split(' ')
             libs = []
             for lib in result:
                 if lib.startswith('-l'):
@@ -42,7 +43,7 @@ def get_pkg_config_info(pkg_config_vars_path):
 
             includes = []
             command = 'pkg-config --cflags ' + pc
-            result = subprocess.getoutput(command).split(' ')
+            result = outputs[2 * i + 1].output.split(' ')
             for cflag in result:
                 if cflag.startswith('-I'):
                     cflag = os.path.normpath(cflag[2:])
@@ -51,7 +52,7 @@ def get_pkg_config_info(pkg_config_vars_path):
         except:
             import traceback
             traceback.print_exc()
-            debug(command, result)
+            debug('%s: %s', command, result)
     pkg_config_vars_output = open(pkg_config_vars_path, 'w')
     pkg_config_vars_output.writelines(lines)
     pkg_config_vars_output.close()
@@ -73,7 +74,7 @@ def update_pkg_config_libs():
             for lib in result:
                 pkgs = PKG_CONFIG_LIB2PKGS.setdefault(lib, set())
                 pkgs.add(package)
-                debug('pkg-config --libs %s ==> %s' % (package, lib))
+                debug('pkg-config --libs %s ==> %s', package, lib)
 
         if name.endswith('_INCLUDE_DIRS'):
             package = name[:-13]
@@ -82,7 +83,7 @@ def update_pkg_config_libs():
             for include in result:
                 pkgs = PKG_CONFIG_INCLUDE2PKGS.setdefault(include, set())
                 pkgs.add(package)
-                debug('pkg-config --cflags %s ==> %s' % (package, include))
+                debug('pkg-config --cflags %s ==> %s', package, include)
 
 
 def extract_cmake_vars_to_index(cmake_vars_path):
@@ -165,8 +166,8 @@ def extract_include_mapping(include_index):
                     pass
                 elif len(name) < len(prev_name):
                     includes[d] = name
-            debug('%s => %s %s' % (d, pkg_name, name))
-        debug(pkg_name, "inc=>>", includes)
+            debug('%s => %s %s', d, pkg_name, name)
+        debug('%s inc=>> %s', pkg_name, includes)
         continue
     include2multipkg = dict(filter(lambda x: len(x[1]) > 1, include2pkg.items()))
     pkg2multiinclude = dict(filter(lambda x: len(x[1]) > 1, CMAKE_INCLUDE_DIRS.items()))
@@ -225,8 +226,8 @@ def extract_library_mapping(library_index):
                     pass
                 elif len(name) < len(prev_name):
                     libraries[path] = name
-            debug('%s => %s %s' % (path, pkg_name, name))
-        if path: debug(pkg_name, "lib=>>", libraries)
+            debug('%s => %s %s', path, pkg_name, name)
+        if path: debug('%s lib=>> %s', pkg_name, libraries)
         continue
     library2multipkg = dict(filter(lambda x: len(x[1]) > 1, library2pkg.items()))
     pkg2multilibrary = dict(filter(lambda x: len(x[1]) > 1, CMAKE_LIBRARIES.items()))
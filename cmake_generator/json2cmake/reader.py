@@ -0,0 +1,110 @@
+import json
+from itertools import chain
+from .utils import get_loggers
+
+__all__ = ['iter_entries', 'iter_json_lines', 'read_entries', 'write_json_lines', 'FORMATS', 'CHUNK_SIZE']
+logger, info, debug, warn, error = get_loggers(__name__)
+CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\n\r'
+# json: one JSON array of entries, jsonl: one entry per line, auto: told by the first character
+FORMATS = ('auto', 'json', 'jsonl')
+
+
+def read_entries(infile, input_format='auto', chunk_size=CHUNK_SIZE):
+    """
+    Yield the entries of a compilation database in the given format, see FORMATS.
+    An empty or blank input has no entries in the auto and jsonl formats, as a JSON Lines database."""
+    if input_format not in FORMATS:
+        raise ValueError('unknown compilation database format: %s' % input_format)
+    head = ''
+    if input_format == 'auto':
+        head = infile.read(chunk_size)
+        while head.strip(WHITESPACE) == '' and head:
+            chunk = infile.read(chunk_size)
+            if not chunk: break
+            head += chunk
+        if not head.strip(WHITESPACE):
+            # a blank input, an empty JSON Lines database
+            debug("Compilation database is empty")
+            return iter(())
+        input_format = 'jsonl' if head.lstrip(WHITESPACE)[:1] == '{' else 'json'
+        debug("Compilation database format: %s", input_format)
+    if input_format == 'jsonl':
+        return iter_json_lines(infile, head)
+    return iter_entries(infile, chunk_size, head)
+
+
+def iter_json_lines(infile, head=''):
+    """
+    Yield the entries of a JSON Lines compilation database, one entry per line.
+    head is the text already read from infile."""
+    if head:
+        # complete the last line of head, split on '\n' only, like infile, not on the other line boundaries
+        # of str.splitlines() like U+2028, which JSON strings may hold unescaped
+        lines = chain((head + infile.readline()).split('\n'), infile)
+    else:
+        lines = iter(infile)
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip(WHITESPACE)
+        if not line: continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError('invalid entry at line %d of compilation database: %s' % (lineno, e))
+
+
+def write_json_lines(entries, outfile):
+    """Write entries to outfile, one entry per line"""
+    count = 0
+    for entry in entries:
+        outfile.write(json.dumps(entry))
+        outfile.write('\n')
+        count += 1
+    return count
+
+
+def iter_entries(infile, chunk_size=CHUNK_SIZE, head=''):
+    """
+    Yield the entries of a compilation database one by one.
+    The file is read chunk by chunk, and each entry is decoded as soon as it is complete,
+    so neither the raw text nor the parsed list of the whole database is held in memory.
+    head is the text already read from infile."""
+    decoder = json.JSONDecoder()
+    buffer = head
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        if pos >= len(buffer):
+            buffer = infile.read(chunk_size)
+            pos = 0
+            if not buffer: break
+            continue
+        char = buffer[pos]
+        if not started:
+            if char != '[':
+                raise ValueError('compilation database is not a JSON array: %r' % buffer[pos:pos + 20])
+            started = True
+            pos += 1
+        elif char == ',':
+            pos += 1
+        elif char == ']':
+            return
+        else:
+            try:
+                entry, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof: raise
+                end = len(buffer)
+            if end >= len(buffer) and not eof:
+                # the entry may be cut by the chunk boundary, decode it again with more text
+                chunk = infile.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            pos = end
+            yield entry
+    raise ValueError('compilation database is not a complete JSON array')
@@ -0,0 +1,130 @@
+import os
+import signal
+import asyncio
+import threading
+from .utils import get_loggers, lazy_join
+
+__all__ = ['ProcessRunner', 'ProcessResult', 'get_runner', 'run_command', 'run_commands', 'PROCESS_LIMIT']
+logger, info, debug, warn, error = get_loggers(__name__)
+# max number of external processes run at the same time by the runner of the process
+PROCESS_LIMIT = os.cpu_count() or 1
+
+
+class ProcessResult(object):
+    """Outcome of a process run by ProcessRunner, returncode is None when it was killed on timeout"""
+    __slots__ = ('args', 'returncode', 'stdout', 'stderr', 'timed_out')
+
+    def __init__(self, args, returncode, stdout, stderr, timed_out=False):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return "%s{args=%s, returncode=%s, timed_out=%s}" % (
+            self.__class__.__name__, self.args, self.returncode, self.timed_out)
+
+    @property
+    def output(self):
+        """stdout without its trailing newline, like subprocess.getoutput()"""
+        return self.stdout[:-1] if self.stdout.endswith('\n') else self.stdout
+
+
+class ProcessRunner(object):
+    """
+    Run external processes from an asyncio event loop in a thread of its own,
+    at most limit of them at the same time, whichever thread submits them.
+    Each process runs in a session of its own, killed with the processes it started when it times out.
+    Outputs are decoded as utf-8, stderr is captured apart unless merged into stdout.
+    A process that can not be started exits with 127, like a command not found by the shell."""
+    def __init__(self, limit=PROCESS_LIMIT):
+        self.limit = limit
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='process-runner', daemon=True)
+        self.thread.start()
+        self.semaphore = None
+        self.semaphore_limit = None
+        self.started = 0
+        self.timeouts = 0
+
+    def __repr__(self):
+        return "%s{limit=%s, started=%s, timeouts=%s}" % (
+            self.__class__.__name__, self.limit, self.started, self.timeouts)
+
+    def submit(self, args, cwd=None, timeout=None, stdin=None, merge_stderr=False):
+        """Start running args, returns a concurrent.futures.Future of its ProcessResult"""
+        coroutine = self.execute(list(args), cwd, timeout, stdin, merge_stderr)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, args, cwd=None, timeout=None, stdin=None, merge_stderr=False):
+        """Run args and wait for its ProcessResult"""
+        return self.submit(args, cwd, timeout, stdin, merge_stderr).result()
+
+    def run_all(self, calls):
+        """Run the [(args, kwargs), ...] of calls concurrently, returns their ProcessResults in order"""
+        futures = [self.submit(args, **kwargs) for args, kwargs in calls]
+        return [future.result() for future in futures]
+
+    async def execute(self, args, cwd, timeout, stdin, merge_stderr):
+        if self.semaphore is None or self.semaphore_limit != self.limit:
+            # created in the loop, where the limit takes effect for the processes started afterwards
+            self.semaphore = asyncio.Semaphore(self.limit)
+            self.semaphore_limit = self.limit
+        async with self.semaphore:
+            debug('run in %s:\n\t%s', cwd, lazy_join(args))
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args, cwd=cwd, start_new_session=True,
+                    stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE)
+            except OSError as e:
+                warn("Failed to run %s: %s" % (args[0], e))
+                return ProcessResult(args, 127, '', str(e))
+            self.started += 1
+            data = stdin.encode('utf-8') if stdin is not None else None
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(data), timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await process.wait()
+                warn("Killed after %s seconds in %s:\n\t%s" % (timeout, cwd, ' '.join(args)))
+                return ProcessResult(args, None, '', '', True)
+        stderr = stderr.decode('utf-8', 'replace') if stderr else ''
+        if process.returncode and stderr:
+            debug('%s exited with %s:\n%s', args[0], process.returncode, stderr)
+        return ProcessResult(args, process.returncode, stdout.decode('utf-8', 'replace'), stderr)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+# the runner of the process, recreated in forked processes where its thread does not exist
+RUNNER = None
+RUNNER_LOCK = threading.Lock()
+
+
+def get_runner():
+    global RUNNER
+    with RUNNER_LOCK:
+        if RUNNER is None or RUNNER.pid != os.getpid():
+            RUNNER = ProcessRunner()
+        return RUNNER
+
+
+def run_command(args, cwd=None, timeout=None, stdin=None, merge_stderr=False):
+    """Run args with the runner of the process, returns its ProcessResult"""
+    return get_runner().run(args, cwd, timeout, stdin, merge_stderr)
+
+
+def run_commands(calls):
+    """Run the [(args, kwargs), ...] of calls concurrently with the runner of the process"""
+    return get_runner().run_all(calls)
@@ -0,0 +1,161 @@
+import os
+import re
+from .utils import get_loggers, lazy_join, resolve, stat_cache
+from .runner import run_command
+
+__all__ = ['IncludeScanner']
+logger, info, debug, warn, error = get_loggers(__name__)
+
+COMMENT = re.compile(r'/\*.*?\*/|//[^\n]*', re.S)
+DIRECTIVE = re.compile(r'^[ \t]*#[ \t]*(include_next|include|import|ifdef|ifndef|if|elif|else|endif|define)\b[ \t]*(.*)$',
+                       re.M)
+INCLUDE_NAME = re.compile(r'"([^"]+)"|<([^>]+)>')
+
+
+class IncludeScanner(object):
+    """
+    Find the dependencies of sources like '<compiler> -MM -MG' does, without running the compiler.
+    Quoted includes are searched in the directory of the including file, then in the iquote, -I and system dirs,
+    angle includes in the -I and system dirs only.
+    Headers found in system dirs are left out, and the files not found are listed as they are spelled.
+    Conditional blocks are followed whatever their condition but '#if 0' and '#elif 0',
+    except that a missing angle include inside a conditional block is taken as a platform specific header, and ignored.
+    The includes of each header and the resolved include paths are shared by all the sources scanned."""
+    def __init__(self):
+        # directives: {path: ((quoted, name, conditional), ...), ...}
+        self.directives = {}
+        # resolved: {(quoted, name, directory, search_dirs): (path, is_system) or None, ...}
+        self.resolved = {}
+        # system_dirs: {(compiler, language): (directory, ...), ...}
+        self.system_dirs = {}
+        self.scanned = 0
+
+    def __repr__(self):
+        return "%s{scanned=%s, headers=%s, resolved=%s}" % (
+            self.__class__.__name__, self.scanned, len(self.directives), len(self.resolved))
+
+    def extract_dependencies(self, command, source, cwd):
+        """returns the dependencies of source compiled by command, in the format of '<compiler> -MM -MG'"""
+        language = 'c' if source.endswith('.c') and '++' not in command.compiler else 'c++'
+        system_dirs = self.get_system_dirs(command.compiler, language)
+        includes = tuple(resolve(p, cwd) for p in command.includes)
+        quote_dirs = tuple(resolve(p, cwd) for p in command.iquote_includes) + includes
+        system_dirs = tuple(resolve(p, cwd) for p in command.system_includes) + system_dirs
+        search_dirs = (quote_dirs, includes, system_dirs)
+        depends = [source]
+        visited = {source}
+        pending = [source]
+        while pending:
+            path = pending.pop()
+            directory = os.path.dirname(path)
+            for quoted, name, conditional in self.get_directives(path):
+                found = self.resolve_include(quoted, name, directory, search_dirs)
+                if found is None:
+                    if quoted or not conditional:
+                        if name not in visited:
+                            visited.add(name)
+                            depends.append(name)
+                    continue
+                found, is_system = found
+                if is_system or found in visited: continue
+                visited.add(found)
+                depends.append(found)
+                pending.append(found)
+        self.scanned += 1
+        target = os.path.splitext(os.path.basename(source))[0] + '.o'
+        return '%s: %s' % (target, ' '.join(depends))
+
+    def get_directives(self, path):
+        directives = self.directives.get(path)
+        if directives is None:
+            directives = self.directives[path] = self.parse_directives(path)
+        return directives
+
+    @staticmethod
+    def parse_directives(path):
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return ()
+        directives = []
+        # conditions: [skipped, ...] of the open conditional blocks
+        conditions = []
+        guard = None
+        guard_depth = 0
+        for i, m in enumerate(DIRECTIVE.finditer(COMMENT.sub('', text))):
+            keyword, argument = m.groups()
+            if keyword.startswith('if'):
+                if i == 0 and keyword == 'ifndef':
+                    guard = argument.strip()
+                skipped = (conditions and conditions[-1]) or (keyword == 'if' and argument.strip() == '0')
+                conditions.append(skipped)
+            elif keyword in ('elif', 'else'):
+                if conditions:
+                    outer_skipped = len(conditions) > 1 and conditions[-2]
+                    conditions[-1] = outer_skipped or (keyword == 'elif' and argument.strip() == '0')
+            elif keyword == 'endif':
+                if conditions:
+                    conditions.pop()
+            elif keyword == 'define':
+                if i == 1 and guard and argument.split()[:1] == [guard]:
+                    # include guard, not a real condition
+                    guard_depth = 1
+            elif not (conditions and conditions[-1]):
+                name = INCLUDE_NAME.match(argument)
+                if name is None: continue
+                quoted = name.group(1) is not None
+                directives.append((quoted, name.group(1) or name.group(2), len(conditions) > guard_depth))
+        return tuple(directives)
+
+    def resolve_include(self, quoted, name, directory, search_dirs):
+        quote_dirs, includes, system_dirs = search_dirs
+        key = (quoted, name, directory if quoted else None, search_dirs)
+        if key in self.resolved:
+            return self.resolved[key]
+        found = None
+        if os.path.isabs(name):
+            if stat_cache.isfile(name):
+                found = (os.path.normpath(name), False)
+        else:
+            dirs = ((directory, ) + quote_dirs) if quoted else includes
+            for d in dirs:
+                path = os.path.join(d, name)
+                if stat_cache.isfile(path):
+                    found = (os.path.normpath(path), False)
+                    break
+            else:
+                for d in system_dirs:
+                    path = os.path.join(d, name)
+                    if stat_cache.isfile(path):
+                        found = (os.path.normpath(path), True)
+                        break
+        self.resolved[key] = found
+        return found
+
+    def get_system_dirs(self, compiler, language):
+        key = (compiler, language)
+        system_dirs = self.system_dirs.get(key)
+        if system_dirs is None:
+            system_dirs = self.system_dirs[key] = self.query_system_dirs(compiler, language)
+        return system_dirs
+
+    @staticmethod
+    def query_system_dirs(compiler, language):
+        """The default include dirs of compiler, as listed by '<compiler> -E -v'"""
+        result = run_command([compiler, '-x', language, '-E', '-v', '-'])
+        if result.returncode == 127:
+            warn("Failed to get the system include dirs of %s: %s" % (compiler, result.stderr))
+            return ()
+        output = result.stderr
+        dirs = []
+        listing = False
+        for line in output.split('\n'):
+            if line.startswith('#include <...> search starts here:'):
+                listing = True
+            elif line.startswith('End of search list.'):
+                break
+            elif listing:
+                dirs.append(os.path.normpath(line.strip().split(' (')[0]))
+        debug("System include dirs of %s for %s: %s", compiler, language, lazy_join(dirs))
+        return tuple(dirs)
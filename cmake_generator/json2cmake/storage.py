@@ -0,0 +1,430 @@
+import os
+import re
+import sqlite3
+from urllib.request import pathname2url
+from array import array
+from collections.abc import Mapping
+from .utils import get_loggers
+
+__all__ = ['MemoryIndex', 'BuildGraph', 'SqliteIndex', 'INDEX_FIELDS', 'BUCKETS']
+logger, info, debug, warn, error = get_loggers(__name__)
+INDEX_FIELDS = ('targets', 'sources', 'objects', 'linkings', 'qt_moc_bucket', 'qt_ui_bucket', 'qt_rc_bucket',
+                'installs')
+# indexes of linked targets, 'linkings' holds all of them, the others only the ones created by qt tools
+BUCKETS = ('linkings', 'qt_moc_bucket', 'qt_ui_bucket', 'qt_rc_bucket')
+
+
+class MemoryIndex(object):
+    """Indexes of a compilation database kept in nested dicts"""
+    def __init__(self):
+        # targets: {cmd_id: {target: {source, ...}, ...}, ...}
+        self.targets = {}
+        # sources: {source: {target: cmd_id, ...}, ...}
+        self.sources = {}
+        # objects: {target: {source: cmd_id, ...}, ...}
+        self.objects = {}
+        # linkings: {target: {cmd_id: {object_file, ...}, ...}, ...}
+        self.linkings = {}
+        # qt_moc_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
+        self.qt_moc_bucket = {}
+        # qt_ui_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
+        self.qt_ui_bucket = {}
+        # qt_rc_bucket: {target: {cmd_id: {object_file, ...}, ...}, ...}
+        self.qt_rc_bucket = {}
+        # installs: {cmd_id: {target: source, ...}, ...}
+        self.installs = {}
+
+    def add_target(self, cmd_id, target, source):
+        self.targets.setdefault(cmd_id, {}).setdefault(target, set()).add(source)
+
+    def add_object(self, target, source, cmd_id):
+        self.objects.setdefault(target, {})[source] = cmd_id
+        self.sources.setdefault(source, {})[target] = cmd_id
+
+    def add_linking(self, bucket, target, cmd_id, file_):
+        getattr(self, bucket).setdefault(target, {}).setdefault(cmd_id, set()).add(file_)
+
+    def add_install(self, cmd_id, target, source):
+        self.installs.setdefault(cmd_id, {})[target] = source
+
+    def remove_target_source(self, cmd_id, target, source):
+        """
+        Remove source from the sources of target, and target itself when no source left.
+        returns the number of sources left, or None if source is not one of them"""
+        target_sources = self.targets.get(cmd_id, {})
+        sources = target_sources.get(target, set())
+        if source not in sources:
+            return None
+        sources.remove(source)
+        if not sources:
+            target_sources.pop(target)
+        return len(sources)
+
+    def pop_install(self, cmd_id):
+        return self.installs.pop(cmd_id)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class EdgeMap(object):
+    """
+    Edges {key: [(a, b), ...], ...} between the ints of a BuildGraph, the pairs of each key in a flat array,
+    the keys ordered by their first edge.
+    With unique, an edge replaces the edge of its key with the same a, otherwise an edge already there is ignored.
+    Keys with many edges get a dict of their positions while edges are added, dropped by seal()."""
+    __slots__ = ('unique', 'order', 'edges', 'count', 'positions')
+    INDEXED_DEGREE = 16
+
+    def __init__(self, unique=False):
+        self.unique = unique
+        self.order = array('i')
+        # edges: [array('i', [a, b, ...]) or None, ...] indexed by key
+        self.edges = []
+        self.count = 0
+        # positions: {key: {a or (a, b): position, ...}, ...} of the keys with many edges
+        self.positions = {}
+
+    def __getstate__(self):
+        return self.unique, self.order, self.edges, self.count
+
+    def __setstate__(self, state):
+        self.unique, self.order, self.edges, self.count = state
+        self.positions = {}
+
+    def get(self, key):
+        return self.edges[key] if 0 <= key < len(self.edges) else None
+
+    def find(self, key, pairs, a, b):
+        """position of the edge (a, b) of key, of (a, _) with unique, or None"""
+        if len(pairs) <= 2 * self.INDEXED_DEGREE:
+            for i in range(0, len(pairs), 2):
+                if pairs[i] == a and (self.unique or pairs[i + 1] == b):
+                    return i
+            return None
+        positions = self.positions.get(key)
+        if positions is None:
+            positions = self.positions[key] = {}
+            for i in range(len(pairs) - 2, -1, -2):
+                positions[pairs[i] if self.unique else (pairs[i], pairs[i + 1])] = i
+        return positions.get(a if self.unique else (a, b))
+
+    def add(self, key, a, b):
+        edges = self.edges
+        if key >= len(edges):
+            edges.extend([None] * (key + 1 - len(edges)))
+        pairs = edges[key]
+        if pairs is None:
+            edges[key] = array('i', (a, b))
+            self.order.append(key)
+            self.count += 1
+            return
+        i = self.find(key, pairs, a, b)
+        if i is None:
+            positions = self.positions.get(key)
+            if positions is not None:
+                positions[a if self.unique else (a, b)] = len(pairs)
+            pairs.append(a)
+            pairs.append(b)
+        elif self.unique:
+            pairs[i + 1] = b
+
+    def remove(self, key, a, b):
+        """Remove the edge (a, b) of key, returns whether it was there"""
+        pairs = self.get(key)
+        i = None if pairs is None else self.find(key, pairs, a, b)
+        if i is None:
+            return False
+        del pairs[i:i + 2]
+        self.positions.pop(key, None)
+        return True
+
+    def pop(self, key):
+        """Remove key and its edges, returns them"""
+        pairs = self.get(key)
+        if pairs is None:
+            raise KeyError(key)
+        self.edges[key] = None
+        self.order.remove(key)
+        self.positions.pop(key, None)
+        self.count -= 1
+        return pairs
+
+    def seal(self):
+        self.positions.clear()
+
+
+class BuildGraph(object):
+    """
+    Indexes of a compilation database as a build graph, with files as nodes numbered in order of appearance,
+    commands by their cmd_id, and the edges between them in the flat int arrays of EdgeMaps.
+    The nested dicts of MemoryIndex are derived on demand, as read-only mappings of the same layout."""
+    def __init__(self):
+        # paths: [path, ...] indexed by node id
+        self.paths = []
+        # ids: {path: node id, ...}
+        self.ids = {}
+        # produced: {target: [(source, cmd_id), ...], ...}
+        self.produced = EdgeMap(True)
+        # consumed: {source: [(target, cmd_id), ...], ...}
+        self.consumed = EdgeMap(True)
+        # built: {target: [(cmd_id, source), ...], ...}, the edges left by reduce_target()
+        self.built = EdgeMap()
+        # command_targets: {cmd_id: [(target, 0), ...], ...}
+        self.command_targets = EdgeMap()
+        # linked: {bucket: {target: [(cmd_id, file), ...], ...}, ...}
+        self.linked = dict((bucket, EdgeMap()) for bucket in BUCKETS)
+        # installed: {cmd_id: [(target, source), ...], ...}
+        self.installed = EdgeMap(True)
+        self.create_views()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in INDEX_FIELDS:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_views()
+
+    def create_views(self):
+        self.targets = GraphView(self, self.command_targets, False, self.target_sources)
+        self.sources = GraphView(self, self.consumed, True, self.pairs_to_dict)
+        self.objects = GraphView(self, self.produced, True, self.pairs_to_dict)
+        for bucket in BUCKETS:
+            setattr(self, bucket, GraphView(self, self.linked[bucket], True, self.pairs_to_sets))
+        self.installs = GraphView(self, self.installed, False, self.paths_to_dict)
+
+    def node(self, path):
+        node = self.ids.get(path)
+        if node is None:
+            node = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return node
+
+    def pairs_to_dict(self, pairs, key=None):
+        paths = self.paths
+        return dict((paths[pairs[i]], pairs[i + 1]) for i in range(0, len(pairs), 2))
+
+    def pairs_to_sets(self, pairs, key=None):
+        item = {}
+        paths = self.paths
+        for i in range(0, len(pairs), 2):
+            item.setdefault(pairs[i], set()).add(paths[pairs[i + 1]])
+        return item
+
+    def paths_to_dict(self, pairs, key=None):
+        paths = self.paths
+        return dict((paths[pairs[i]], paths[pairs[i + 1]]) for i in range(0, len(pairs), 2))
+
+    def target_sources(self, pairs, cmd_id):
+        item = {}
+        paths = self.paths
+        for i in range(0, len(pairs), 2):
+            target = pairs[i]
+            built = self.built.get(target)
+            sources = set(paths[built[j + 1]] for j in range(0, len(built), 2) if built[j] == cmd_id)
+            if sources:
+                item[paths[target]] = sources
+        return item
+
+    def add_target(self, cmd_id, target, source):
+        target = self.node(target)
+        self.command_targets.add(cmd_id, target, 0)
+        self.built.add(target, cmd_id, self.node(source))
+
+    def add_object(self, target, source, cmd_id):
+        target = self.node(target)
+        source = self.node(source)
+        self.produced.add(target, source, cmd_id)
+        self.consumed.add(source, target, cmd_id)
+
+    def add_linking(self, bucket, target, cmd_id, file_):
+        self.linked[bucket].add(self.node(target), cmd_id, self.node(file_))
+
+    def add_install(self, cmd_id, target, source):
+        self.installed.add(cmd_id, self.node(target), self.node(source))
+
+    def remove_target_source(self, cmd_id, target, source):
+        target_id = self.ids.get(target)
+        source_id = self.ids.get(source)
+        if target_id is None or source_id is None or not self.built.remove(target_id, cmd_id, source_id):
+            return None
+        built = self.built.get(target_id)
+        left = sum(1 for i in range(0, len(built), 2) if built[i] == cmd_id)
+        if not left:
+            # added again, it is listed last, as the dicts of MemoryIndex do
+            self.command_targets.remove(cmd_id, target_id, 0)
+        return left
+
+    def pop_install(self, cmd_id):
+        return self.paths_to_dict(self.installed.pop(cmd_id))
+
+    def commit(self):
+        for edge_map in (self.produced, self.consumed, self.built, self.command_targets, self.installed):
+            edge_map.seal()
+        for edge_map in self.linked.values():
+            edge_map.seal()
+
+    def close(self):
+        pass
+
+
+class GraphView(Mapping):
+    """
+    Read-only view of an EdgeMap of a BuildGraph as a nested dict, keyed by path if by_path, else by cmd_id.
+    The item of a key is made of its edges by convert(pairs, key)."""
+    def __init__(self, graph, edge_map, by_path, convert):
+        self.graph = graph
+        self.edge_map = edge_map
+        self.by_path = by_path
+        self.convert = convert
+
+    def key_id(self, key):
+        if self.by_path:
+            return self.graph.ids.get(key, -1)
+        return key if isinstance(key, int) else -1
+
+    def __getitem__(self, key):
+        pairs = self.edge_map.get(self.key_id(key))
+        if pairs is None:
+            raise KeyError(key)
+        return self.convert(pairs, key)
+
+    def __contains__(self, key):
+        return self.edge_map.get(self.key_id(key)) is not None
+
+    def __iter__(self):
+        if self.by_path:
+            paths = self.graph.paths
+            return (paths[key] for key in self.edge_map.order)
+        return iter(self.edge_map.order.tolist())
+
+    def __len__(self):
+        return self.edge_map.count
+
+
+class NestedView(Mapping):
+    """
+    Read-only view of a table as a nested dict {key: {sub_key: value, ...}, ...},
+    or {key: {sub_key: {value, ...}, ...}, ...} for multiple values.
+    Keys and sub keys are ordered by their first insertion, as in the dicts of MemoryIndex."""
+    def __init__(self, conn, table, key, sub_key, value, multiple=False, bucket=None):
+        self.conn = conn
+        self.multiple = multiple
+        where = 'WHERE bucket=? ' if bucket else ''
+        self.args = (bucket, ) if bucket else ()
+        self.keys_query = 'SELECT %s FROM %s %sGROUP BY %s ORDER BY MIN(rowid)' % (key, table, where, key)
+        self.count_query = 'SELECT COUNT(DISTINCT %s) FROM %s %s' % (key, table, where)
+        where = '%s%s=?' % ('WHERE bucket=? AND ' if bucket else 'WHERE ', key)
+        self.item_query = 'SELECT %s, %s FROM %s %s ORDER BY rowid' % (sub_key, value, table, where)
+        self.contains_query = 'SELECT 1 FROM %s %s LIMIT 1' % (table, where)
+
+    def __getitem__(self, key):
+        item = {}
+        for sub_key, value in self.conn.execute(self.item_query, self.args + (key, )):
+            if self.multiple:
+                item.setdefault(sub_key, set()).add(value)
+            else:
+                item[sub_key] = value
+        if not item:
+            raise KeyError(key)
+        return item
+
+    def __contains__(self, key):
+        return self.conn.execute(self.contains_query, self.args + (key, )).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.conn.execute(self.keys_query, self.args):
+            yield row[0]
+
+    def __len__(self):
+        return self.conn.execute(self.count_query, self.args).fetchone()[0]
+
+
+class SqliteIndex(object):
+    """
+    Indexes of a compilation database kept in a SQLite file,
+    exposed as read-only mappings with the same layout as the dicts of MemoryIndex.
+    The file is a scratch one, recreated on each run, which refuses to replace a file that is not such an index."""
+    SCHEMA = '''
+CREATE TABLE targets (cmd_id INTEGER, target TEXT, source TEXT, UNIQUE (cmd_id, target, source));
+CREATE TABLE objects (target TEXT, source TEXT, cmd_id INTEGER, UNIQUE (target, source));
+CREATE INDEX objects_source ON objects (source);
+CREATE INDEX objects_cmd_id ON objects (cmd_id);
+CREATE TABLE linkings (bucket TEXT, target TEXT, cmd_id INTEGER, file TEXT, UNIQUE (bucket, target, cmd_id, file));
+CREATE TABLE installs (cmd_id INTEGER, target TEXT, source TEXT, UNIQUE (cmd_id, target));
+'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            if not self.is_index(filename):
+                raise ValueError('%s exists and is not an index of a compilation database, not replacing it'
+                                 % filename)
+            os.remove(filename)
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('PRAGMA temp_store=FILE')
+        self.conn.executescript(self.SCHEMA)
+        self.targets = NestedView(self.conn, 'targets', 'cmd_id', 'target', 'source', True)
+        self.sources = NestedView(self.conn, 'objects', 'source', 'target', 'cmd_id')
+        self.objects = NestedView(self.conn, 'objects', 'target', 'source', 'cmd_id')
+        for bucket in BUCKETS:
+            setattr(self, bucket, NestedView(self.conn, 'linkings', 'target', 'cmd_id', 'file', True, bucket))
+        self.installs = NestedView(self.conn, 'installs', 'cmd_id', 'target', 'source')
+        debug("Keep compilation database indexes in %s", filename)
+
+    @classmethod
+    def is_index(cls, filename):
+        """Whether filename is a SQLite file with the tables of the SCHEMA, and nothing else"""
+        tables = set(re.findall(r'^CREATE TABLE (\w+)', cls.SCHEMA, re.M))
+        try:
+            conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(filename), uri=True)
+            try:
+                names = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+        return set(name for name, in names) == tables
+
+    def add_target(self, cmd_id, target, source):
+        self.conn.execute('INSERT OR IGNORE INTO targets VALUES (?, ?, ?)', (cmd_id, target, source))
+
+    def add_object(self, target, source, cmd_id):
+        self.conn.execute('INSERT INTO objects VALUES (?, ?, ?) '
+                          'ON CONFLICT (target, source) DO UPDATE SET cmd_id=excluded.cmd_id',
+                          (target, source, cmd_id))
+
+    def add_linking(self, bucket, target, cmd_id, file_):
+        self.conn.execute('INSERT OR IGNORE INTO linkings VALUES (?, ?, ?, ?)', (bucket, target, cmd_id, file_))
+
+    def add_install(self, cmd_id, target, source):
+        self.conn.execute('INSERT INTO installs VALUES (?, ?, ?) '
+                          'ON CONFLICT (cmd_id, target) DO UPDATE SET source=excluded.source',
+                          (cmd_id, target, source))
+
+    def remove_target_source(self, cmd_id, target, source):
+        cursor = self.conn.execute('DELETE FROM targets WHERE cmd_id=? AND target=? AND source=?',
+                                   (cmd_id, target, source))
+        if not cursor.rowcount:
+            return None
+        return self.conn.execute('SELECT COUNT(*) FROM targets WHERE cmd_id=? AND target=?',
+                                 (cmd_id, target)).fetchone()[0]
+
+    def pop_install(self, cmd_id):
+        install = self.installs[cmd_id]
+        self.conn.execute('DELETE FROM installs WHERE cmd_id=?', (cmd_id, ))
+        return install
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
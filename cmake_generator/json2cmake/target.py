@@ -1,7 +1,8 @@
 import os
 from os.path import basename, dirname, splitext, commonpath, isabs, isfile, exists
 import traceback
-from .utils import PathUtils, relpath, resolve, get_loggers, basestring, cmake_resolve_binary, cmake_resolve_source
+from .utils import PathUtils, CompactObject, OrderedSet, relpath, resolve, get_loggers, lazy_join, basestring, \
+    cmake_resolve_binary, cmake_resolve_source
 
 __all__ = ['CmakeTarget', 'CppTarget', 'ExecutableTarget', 'LibraryTarget', 'LocaleTarget', 'InstallTarget',
            'OutputWithIndent', 'CustomCommandTarget', 'WrappedTarget', 'ForeachTargetWrapper',
@@ -65,7 +66,11 @@ class OutputWithIndent(object):
         self.writeln(self.indent + 'set_property(%s %s PROPERTY %s %s)' % (target_type, targets, property_name, values))
 
 
-class CmakeTarget(object):
+class CmakeTarget(CompactObject):
+    __slots__ = ('generated', 'command', 'common_configs', 'target', 'sources', 'name_',
+                 'parent', 'generator', 'output', 'indent', 'depends', 'destinations', 'output_name',
+                 'libs', 'compiler', 'include_binary_dir', 'referenced_libs')
+
     def __init__(self, command, target, sources, name=None):
         self.generated = False
         self.command = command
@@ -81,7 +86,7 @@ class CmakeTarget(object):
         self.destinations = set()
         self.output_name = None
         if command:
-            self.libs = list(command.libs)
+            self.libs = tuple(command.libs)
             self.compiler = command.compiler
             self.include_binary_dir = command.include_binary_dir
             self.referenced_libs = command.referenced_libs.copy()
@@ -176,6 +181,15 @@ class CmakeTarget(object):
         self.output.write_command(command, options, name, sources)
         self.output.finish()
 
+    def name_references(self, pattern_replace={}):
+        """Name the targets output_target() refers to by name_as_target(), without writing anything"""
+
+    def name_install_files(self, files):
+        """Name the files as install_files() does"""
+        if len(files) > 1 and not self.name():
+            return self.generator.name_as_target(commonpath(files))[0]
+        return self.name()
+
     def write_command(self, command, options, name, parts):
         return self.output.write_command(command, options, name, parts)
 
@@ -184,10 +198,7 @@ class CmakeTarget(object):
             files = [files, ]
         sources = [self.generator.relpath(s) for s in files]
         if len(sources) > 1:
-            if not self.name():
-                common_part = commonpath(files)
-                name, _ = self.generator.name_as_target(common_part)
-                self.set_name(name)
+            self.set_name(self.name_install_files(files))
             var_name = "%s_%s" % (self.name().upper(), install_type)
             self.output.write_command('set', var_name, '', sources)
             sources = ["${%s}" % var_name, ]
@@ -205,6 +216,8 @@ class CmakeTarget(object):
 
 
 class CppTarget(CmakeTarget):
+    __slots__ = ()
+
     def __init__(self, command, target, sources=None):
         super(CppTarget, self).__init__(command, target, sources)
 
@@ -250,10 +263,19 @@ class CppTarget(CmakeTarget):
             self.install_files('TARGETS', destination, self.name())
         self.output.finish()
 
+    def name_references(self, pattern_replace={}):
+        for lib in self.referenced_libs:
+            if lib in self.generator.db.linkings:
+                self.generator.name_as_target(lib)
+        for path in self.depends:
+            self.generator.name_as_target(path)
+
     def get_unique_config(self, name, common_configs=None):
         configs = self.get_values(name)
         if common_configs is None:
-            common_configs = self.generator.common_configs.get(name, [])
+            common_configs = self.generator.common_configs.get(name, ())
+        if not isinstance(common_configs, (set, frozenset, OrderedSet)):
+            common_configs = frozenset(common_configs)
         unique_configs = list(filter(lambda x: x not in common_configs, configs))
         return unique_configs
 
@@ -302,13 +324,13 @@ class CppTarget(CmakeTarget):
 
     def output_compile_args(self, arg_type, name, parts):
         if not parts: return
-        info("Target %s output compile %-11s: %s" % (name, arg_type, ' '.join(parts)))
+        info("Target %s output compile %-11s: %s", name, arg_type, lazy_join(parts))
         self.write_command('target_compile_' + arg_type, 'PRIVATE', name, parts)
 
     def output_includes(self, options, name, parts):
         if not parts: return
         parts = list(map(self.generator.get_include_path, parts))
-        info("Target %s includes %s %s" % (name, options, ' '.join(parts)))
+        info("Target %s includes %s %s", name, options, lazy_join(parts))
         self.write_command('target_include_directories', options, name, parts)
 
     def output_target_libs(self, name):
@@ -324,7 +346,7 @@ class CppTarget(CmakeTarget):
                 if lib not in libs:
                     libs.append(lib)
         if libs:
-            debug("Target %s using referenced libs %s" % (name, ' '.join(libs)))
+            debug("Target %s using referenced libs %s", name, lazy_join(libs))
         for lib in self.libs:
             if lib not in libs:
                 libs.append(lib)
@@ -338,12 +360,14 @@ class CppTarget(CmakeTarget):
             return f
         elif linkage == 'SOURCE':
             refer = cmake_resolve_binary(f, self.generator.directory, self.generator.root_dir)
-            debug("refer generated source %s" % refer)
+            debug("refer generated source %s", refer)
             return refer
         return None
 
 
 class ExecutableTarget(CppTarget):
+    __slots__ = ()
+
     def __init__(self, command, target, sources=None):
         super(ExecutableTarget, self).__init__(command, target, sources)
 
@@ -352,6 +376,8 @@ class ExecutableTarget(CppTarget):
 
 
 class LibraryTarget(CppTarget):
+    __slots__ = ('libtype', )
+
     def __init__(self, command, target, sources=None, libtype='STATIC'):
         super(self.__class__, self).__init__(command, target, sources)
         self.libtype = libtype
@@ -370,11 +396,15 @@ class LibraryTarget(CppTarget):
 
 
 class LocaleTarget(CmakeTarget):
+    __slots__ = ()
+
     def __init__(self, command, target, sources=None):
         super(self.__class__, self).__init__(command, target, sources)
 
 
 class CustomCommandTarget(CmakeTarget):
+    __slots__ = ()
+
     CUSTOM_TARGET_OUTPUT_CONFIG = {
         'glib-genmarshal': '--output ',
         'dbus-binding-tool': '--output=',
@@ -423,6 +453,8 @@ class CustomCommandTarget(CmakeTarget):
 
 
 class UserVarDefinition(CmakeTarget):
+    __slots__ = ()
+
     def __init__(self, name, sources):
         super(UserVarDefinition, self).__init__(None, name, sources)
 
@@ -442,6 +474,8 @@ class UserVarDefinition(CmakeTarget):
 
 
 class QtWrapDefinition(UserVarDefinition):
+    __slots__ = ('kind', )
+
     def __init__(self, kind, name, sources):
         super(QtWrapDefinition, self).__init__(name, sources)
         self.kind = kind
@@ -451,6 +485,8 @@ class QtWrapDefinition(UserVarDefinition):
 
 
 class PkgCheckModulesDefinition(UserVarDefinition):
+    __slots__ = ('lib', )
+
     def __init__(self, name, lib):
         super(PkgCheckModulesDefinition, self).__init__(name, [])
         self.lib = lib
@@ -466,6 +502,8 @@ class PkgCheckModulesDefinition(UserVarDefinition):
 
 
 class FindPackageDefinition(UserVarDefinition):
+    __slots__ = ('mode', )
+
     def __init__(self, name, mode, module):
         super(FindPackageDefinition, self).__init__(name, [])
         self.mode = mode
@@ -485,6 +523,8 @@ class FindPackageDefinition(UserVarDefinition):
 
 
 class InstallTarget(CmakeTarget):
+    __slots__ = ('install_type', )
+
     def __init__(self, command, target, sources, linkage='FILES'):
         super(InstallTarget, self).__init__(command, target, sources)
         if linkage == 'EXECUTABLE':
@@ -505,8 +545,16 @@ class InstallTarget(CmakeTarget):
         if not self.indent:
             self.output.finish()
 
+    def name_references(self, pattern_replace={}):
+        for _ in self.get_destinations():
+            # named once, by the first destination
+            self.name_install_files([s % pattern_replace for s in self.get_sources()])
+            break
+
 
 class WrappedTarget(CmakeTarget):
+    __slots__ = ('children', )
+
     def __init__(self, command, target, sources=None):
         super(WrappedTarget, self).__init__(command, target, sources)
         self.children = []
@@ -517,6 +565,8 @@ class WrappedTarget(CmakeTarget):
 
 
 class ForeachTargetWrapper(WrappedTarget):
+    __slots__ = ()
+
     def __init__(self, command, target, sources):
         super(ForeachTargetWrapper, self).__init__(command, target, sources)
 
@@ -548,3 +598,9 @@ class ForeachTargetWrapper(WrappedTarget):
             child.output_target(pattern_replace)
         self.write_command('endforeach', '', self.name(), [])
         self.output.finish()
+
+    def name_references(self, pattern_replace={}):
+        pattern_replace = pattern_replace.copy()
+        pattern_replace.update({str(self.indent): '${%s}' % self.name()})
+        for child in self.children:
+            child.name_references(pattern_replace)
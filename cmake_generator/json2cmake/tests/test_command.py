@@ -2,7 +2,7 @@ import os
 from io import StringIO
 import unittest
 from .utils import *
-from ..utils import freeze, resolve, resolve_paths, relpath
+from ..utils import freeze, fingerprint, resolve, resolve_paths, relpath
 from ..command import *
 
 command_line_cxx = [
@@ -174,6 +174,88 @@ class TestCommand(unittest.TestCase):
         self.assertEqual(str(command), str(expected_command))
         self.assertEqual(freeze(command), freeze(expected_command))
 
+    def test_command_parse_cache(self):
+        """test command parse reusing cached results of the same flags"""
+        cwd = "/git/gdb"
+        root_dir = "/git"
+        cache = ParseCache()
+        command_lines = [
+            (command_line_cxx, 'dictionary.c', 'dictionary.o'),
+            ("/usr/bin/g++ -Wall -I../include -DA=1 -c -o {0} {1} -MT {0} -MF .deps/x.Po", 'a.c', 'a.o'),
+            ("/usr/bin/g++ -Wall -I../include -DA=1 -c -o {0} {1} -MT {0} -MF .deps/x.Po", 'b.cc', 'b.o'),
+            ("/usr/bin/g++ -Wall -I../include -DA=1 -c -o {0} {1} -MT {0} -MF .deps/x.Po", 'sub/c.c', 'sub/c.o'),
+            ("/usr/bin/gcc -shared -Wl,-soname=./libx.so {1} -o {0}", 'x.o', 'libx.so'),
+            ("/usr/bin/gcc -shared -Wl,-soname=./libx.so {1} -o {0}", 'y.o', 'liby.so'),
+            ("/usr/bin/gcc -include -o {0} -c {1}", 'e.c', 'e.o'),
+            ("/usr/bin/gcc -include -o {0} -c {1}", 'f.c', 'f.o'),
+            ("/usr/bin/gcc -D {1} -o {0} -c", 'g.c', 'g.o'),
+            ("/usr/bin/gcc -D {1} -o {0} -c", 'h.c', 'h.o'),
+        ]
+        for command_line, source, output in command_lines:
+            if isinstance(command_line, str):
+                command_line = command_line.format(output, source)
+            source = resolve(source, cwd)
+            expected_command, expected_target = Command.parse(command_line, source, cwd, root_dir)
+            command, target = Command.parse(command_line, source, cwd, root_dir, cache)
+            self.assertEqual(target, expected_target)
+            self.assertEqual(freeze(command), freeze(expected_command))
+            self.assertEqual(command.fingerprint(), expected_command.fingerprint())
+            expected_command.compact()
+            command.compact()
+            self.assertEqual(str(command), str(expected_command))
+        # the link commands are not cached
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(cache.hits, 4)
+        self.assertEqual(len(cache.commands), 4)
+        self.assertEqual(list(cache.commands.values()).count(False), 1)
+
+        # the least recently used commands are dropped
+        cache = ParseCache(max_size=2)
+        for i in (1, 6, 2, 8):
+            command_line, source, output = command_lines[i]
+            Command.parse(command_line.format(output, source), resolve(source, cwd), cwd, root_dir, cache)
+        self.assertEqual((cache.misses, cache.hits), (3, 1))
+        self.assertEqual([key[3][0] for key in cache.commands], ['-Wall', '-D'])
+
+    def test_command_compact(self):
+        """test compacted commands share option tuples, and migrate() makes them lists again"""
+        cwd = "/git/gdb"
+        source = "/git/gdb/dictionary.c"
+        command, _ = parse_command(command_line_cxx, source, cwd)
+        other, _ = parse_command(command_line_cxx, source, cwd)
+        fingerprint = command.fingerprint()
+        # the table of the shared tuples is held by the caller, not by the process
+        interned = {}
+        command.compact(interned)
+        other.compact(interned)
+        self.assertIs(command.options, other.options)
+        self.assertIs(interned[command.options], command.options)
+        self.assertIsInstance(command.includes, tuple)
+        self.assertFalse(hasattr(command, '__weakref__'))
+        self.assertEqual(command.fingerprint(), fingerprint)
+        command.migrate({'includes': ['/usr/include/x']})
+        self.assertIsInstance(command.includes, list)
+        self.assertEqual(command.includes[-1], '/usr/include/x')
+        self.assertIsInstance(other.includes, tuple)
+        self.assertNotEqual(command.fingerprint(), fingerprint)
+
+    def test_command_fingerprint(self):
+        """test command fingerprint equal for commands equal in freeze"""
+        cwd = "/git/gdb"
+        source = "/git/gdb/dictionary.c"
+        command, _ = parse_command(command_line_cxx, source, cwd)
+        other, _ = parse_command(' '.join(command_line_cxx), source, cwd)
+        self.assertEqual(command.fingerprint(), other.fingerprint())
+        other.missing_depends = {'/git/gdb/dictionary.o': {'/git/gdb/a.h', '/git/gdb/b.h'}}
+        self.assertNotEqual(command.fingerprint(), fingerprint(other))
+        other.missing_depends = {}
+        self.assertEqual(command.fingerprint(), fingerprint(other))
+        copied = command.copy()
+        fingerprint_copied = copied.fingerprint()
+        copied.migrate({'options': ['-Wextra']})
+        self.assertNotEqual(fingerprint_copied, copied.fingerprint())
+        self.assertEqual(fingerprint(copied), fingerprint(copied.copy()))
+
 
 if __name__ == '__main__':
     unittest.main()
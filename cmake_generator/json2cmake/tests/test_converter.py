@@ -1,9 +1,15 @@
 import unittest
 import os
+import json
+import shutil
+import tempfile
 from io import StringIO
+from unittest import mock
 from .utils import *
 from ..utils import *
 from ..converter import *
+from ..generator import CmakeGenerator
+from ..scanner import IncludeScanner
 from ..database import *
 
 
@@ -50,6 +56,108 @@ class TestCmakeConverter(unittest.TestCase):
         converter.convert()
         self.assertEqual(True, True)
 
+    def test_common_directory(self):
+        db = CompilationDatabase(StringIO(), '/git/gdb/build/compile_commands.json', '/git/gdb')
+        converter = CmakeConverter(db, 'gdb', '/git/gdb')
+
+        def majority_directory(sources):
+            # the directory counts climbed up to the root, as common_directory() used to compute them
+            dir_groups = {}
+            for source in sources:
+                directory = os.path.dirname(source)
+                dir_groups[directory] = dir_groups.get(directory, 0) + 1
+            dir_counts = sorted(dir_groups.items(), key=lambda x: x[1])
+            half = len(sources) / 2
+            if dir_counts[0][1] > half:
+                common_dir = dir_counts[0][0]
+            else:
+                dir_groups.clear()
+                for directory, count in dir_counts:
+                    if not (directory + '/').startswith('/git/gdb/'):
+                        dir_groups['/git/gdb'] = dir_groups.get('/git/gdb', 0) + count
+                    while (directory + '/').startswith('/git/gdb/'):
+                        dir_groups[directory] = dir_groups.get(directory, 0) + count
+                        directory = os.path.dirname(directory)
+                for directory, count in sorted(dir_groups.items(), key=lambda x: x[0].count('/')):
+                    if count > half: break
+                common_dir = directory
+            if not (common_dir + '/').startswith('/git/gdb/') or (common_dir + '/').startswith('/git/gdb/build'):
+                common_dir = '/git/gdb'
+            return common_dir
+
+        directories = ['/git/gdb', '/git/gdb/gdbserver', '/git/gdb/gdbserver/config', '/git/gdb/build',
+                       '/git/gdb/build/gdbserver', '/usr/include', '/git/gdb-other']
+        for i in range(len(directories)):
+            for j in range(len(directories)):
+                for counts in ((1, 0), (3, 1), (1, 3), (2, 2)):
+                    sources = ['%s/file%d.c' % (directories[i], n) for n in range(counts[0])]
+                    sources += ['%s/other%d.c' % (directories[j], n) for n in range(counts[1])]
+                    self.assertEqual(converter.common_directory(sources), majority_directory(sources))
+        self.assertEqual(converter.common_directory([]), '/git/gdb')
+
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is needed to find the system include dirs')
+    def test_converter_jobs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            entries = []
+            for d in ('app', 'lib', 'tools/one', 'tools/two'):
+                directory = os.path.join(temp_dir, d)
+                os.makedirs(directory)
+                for i in range(2):
+                    with open(os.path.join(directory, 'file%d.c' % i), 'w') as f:
+                        f.write('int f%d;\n' % i)
+                    entries.append({'directory': directory, 'file': 'file%d.c' % i,
+                                    'command': '/usr/bin/gcc -I%s -DNAME=%d -c -o file%d.o file%d.c'
+                                               % (temp_dir, len(d), i, i)})
+                # one entry per input of the linking and install commands
+                if d == 'lib':
+                    inputs = ['file0.o', 'file1.o']
+                    command = '/usr/bin/ar cru libutil.a file0.o file1.o'
+                    # several files installed to a directory, named by their common directory
+                    include_dir = os.path.join(temp_dir, 'dist/include/util')
+                    os.makedirs(include_dir)
+                    for f in ('file0.c', 'file1.c'):
+                        entries.append({'directory': directory, 'file': f, 'command':
+                                        '/usr/bin/install -c -m 644 file0.c file1.c %s' % include_dir})
+                else:
+                    # linked with the library of another directory
+                    lib = '../%slib/libutil.a' % ('../' * d.count('/'))
+                    inputs = ['file0.o', 'file1.o', lib]
+                    command = '/usr/bin/gcc -o %s file0.o file1.o %s' % (os.path.basename(d), lib)
+                for f in inputs:
+                    entries.append({'directory': directory, 'file': f, 'command': command})
+            text = json.dumps(entries)
+            outputs = []
+            for jobs, named in ((1, True), (3, True), (3, False)):
+                CmakeConverter.generators.clear()
+                CmakeGenerator.used_names.clear()
+                CmakeGenerator.used_names[''] = ''
+                db = CompilationDatabase(StringIO(text), temp_dir + '/compile_commands.json', temp_dir,
+                                         dep_scanner=IncludeScanner())
+                db.read()
+                # the targets not named beforehand, the generators referring to them are rendered by this process
+                name_targets = CmakeGenerator.name_targets if named else lambda generator: None
+                with mock.patch.object(CmakeGenerator, 'name_targets', name_targets):
+                    CmakeConverter(db, 'app', temp_dir, False, jobs).convert()
+                for generator in CmakeConverter.generators.values():
+                    if generator.output is not None:
+                        generator.output.close()
+                contents = {}
+                for directory, _, files in os.walk(temp_dir):
+                    if 'CMakeLists.txt' in files:
+                        path = os.path.join(directory, 'CMakeLists.txt')
+                        with open(path) as f:
+                            contents[os.path.relpath(path, temp_dir)] = f.read()
+                        os.remove(path)
+                outputs.append(contents)
+            CmakeConverter.generators.clear()
+            serial, parallel, unnamed = outputs
+            self.assertEqual(len(serial), 5)
+            self.assertIn('target_link_libraries(app PRIVATE', serial['app/CMakeLists.txt'])
+            self.assertIn('install(FILES ${LIB_FILES}', serial['lib/CMakeLists.txt'])
+            self.assertIn('add_subdirectory(tools/two)', serial['CMakeLists.txt'])
+            self.assertEqual(parallel, serial)
+            self.assertEqual(unnamed, serial)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,14 @@
+import json
 import unittest
 import os
+import shutil
+import tempfile
 from io import StringIO
 from .utils import *
 from ..utils import *
 from ..database import *
+from ..storage import *
+from ..scanner import IncludeScanner
 
 
 class TestCompilationDatabase(unittest.TestCase):
@@ -40,6 +45,207 @@ class TestCompilationDatabase(unittest.TestCase):
         self.assertEqual(len(db.command), 1)
         self.assertEqual(db.install_command, [])
 
+    def test_db_parse_jobs(self):
+        entries = []
+        for i in range(600):
+            entries.append('''{
+        "directory": "/git/gdb",
+        "command": "/usr/bin/gcc -g -O2 -I. -DID=%d -c -o file%d.o file%d.c",
+        "file": "file%d.c"
+    }''' % (i % 7, i, i, i))
+        entries.append('''{
+        "directory": "/git/gdb",
+        "arguments": ["/usr/bin/ar", "cru", "libfile.a", %s],
+        "file": "file0.o"
+    }''' % ', '.join('"file%d.o"' % i for i in range(600)))
+        text = '[%s]' % ',\n'.join(entries)
+        serial = CompilationDatabase(StringIO(text), '/git/gdb/compile_commands.json', '/git/gdb')
+        serial.read()
+        parallel = CompilationDatabase(StringIO(text), '/git/gdb/compile_commands.json', '/git/gdb', jobs=3)
+        parallel.read()
+        self.assertEqual(len(serial.command), 8)
+        self.assertEqual(parallel.targets, serial.targets)
+        self.assertEqual(parallel.sources, serial.sources)
+        self.assertEqual(parallel.objects, serial.objects)
+        self.assertEqual(parallel.linkings, serial.linkings)
+        self.assertEqual([repr(c) for c in parallel.command], [repr(c) for c in serial.command])
+
+
+    def test_db_object_closure(self):
+        entries = [
+            ('form.ui', ['/usr/bin/uic', 'form.ui', '-o', 'ui_form.h']),
+            ('window.h', ['/usr/bin/moc', 'window.h', '-o', 'moc_window.cpp']),
+            ('main.cpp', ['/usr/bin/g++', '-c', '-o', 'main.o', 'main.cpp']),
+            ('window.cpp', ['/usr/bin/g++', '-c', '-o', 'window.o', 'window.cpp']),
+            ('moc_window.cpp', ['/usr/bin/g++', '-c', '-o', 'moc_window.o', 'moc_window.cpp']),
+            ('main.o', ['/usr/bin/g++', '-o', 'app', 'main.o', 'window.o', 'moc_window.o']),
+        ]
+        infile = StringIO(json.dumps([{'directory': '/git/app', 'arguments': arguments, 'file': f}
+                                      for f, arguments in entries]))
+        db = CompilationDatabase(infile, '/git/app/compile_commands.json', '/git/app')
+        db.read()
+        # the generated header shared by two objects, as found by the dependency scan
+        for target in ('/git/app/main.o', '/git/app/window.o'):
+            db.command[2].add_missing_depends(target, ['/git/app/ui_form.h'], '/git/app')
+
+        def collect_depends(target, compilations, source_files, dependencies):
+            # the recursive walk object_closure() replaces
+            for source, cmd_id in db.objects.get(target, {}).items():
+                command = db.command[cmd_id]
+                for f in command.missing_depends.get(target, set()):
+                    source_files.add(f)
+                    dependencies.add(f)
+                    compilations.setdefault(cmd_id, {})[f] = target
+                    collect_depends(f, compilations, source_files, dependencies)
+                if command.compiler in ('rcc', 'uic'): continue
+                source_files.add(source)
+                if db.command_linkage(cmd_id) == 'INSTALL': continue
+                compilations.setdefault(cmd_id, {})[source] = target
+                if source not in db.objects: continue
+                dependencies.add(source)
+                collect_depends(source, {}, set(), dependencies)
+
+        expected = ({}, set(), set())
+        merged = ({}, set(), set())
+        for target in ('/git/app/main.o', '/git/app/window.o', '/git/app/moc_window.o'):
+            collect_depends(target, *expected)
+            db.merge_object_closure(target, *merged)
+            self.assertEqual([list(products.items()) for products in merged[0].values()],
+                             [list(products.items()) for products in expected[0].values()])
+            self.assertEqual(merged, expected)
+        self.assertEqual(db.producers, {'/git/app/ui_form.h': {'/git/app/form.ui': 0}})
+        self.assertIn('/git/app/ui_form.h', merged[2])
+        self.assertIn('/git/app/moc_window.cpp', merged[2])
+        self.assertTrue(db.is_generated('/git/app/moc_window.cpp'))
+        self.assertFalse(db.is_generated('/git/app/main.cpp'))
+        self.assertIs(db.object_closure('/git/app/main.o'), db.object_closure('/git/app/main.o'))
+
+    def test_db_snapshot(self):
+        entries = []
+        for i in range(20):
+            entries.append('''{
+        "directory": "/git/gdb",
+        "command": "/usr/bin/gcc -g -O2 -I. -DID=%d -c -o file%d.o file%d.c",
+        "file": "file%d.c"
+    }''' % (i % 3, i, i, i))
+        text = '[%s]' % ',\n'.join(entries)
+        changed = '[%s]' % ',\n'.join(entries[5:] + [entries[0].replace('-O2', '-O0')])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot = os.path.join(temp_dir, 'compile_commands.json.snapshot')
+            for content, snapshot_exists in ((text, False), (text, True), (changed, True)):
+                expected = CompilationDatabase(StringIO(content), '/git/gdb/compile_commands.json', '/git/gdb')
+                expected.read()
+                self.assertEqual(os.path.isfile(snapshot), snapshot_exists)
+                db = CompilationDatabase(StringIO(content), '/git/gdb/compile_commands.json', '/git/gdb',
+                                         snapshot=snapshot)
+                db.read()
+                if content == text and snapshot_exists:
+                    self.assertEqual(db.parse_cache.misses + db.parse_cache.hits, 0)
+                self.assertTrue(os.path.isfile(snapshot))
+                self.assertEqual(db.targets, expected.targets)
+                self.assertEqual(db.sources, expected.sources)
+                self.assertEqual(db.objects, expected.objects)
+                self.assertEqual([repr(c) for c in db.command], [repr(c) for c in expected.command])
+            self.assertEqual(len(db.command), 4)
+            self.assertNotIn('/git/gdb/file1.o', db.objects)
+
+    def test_db_snapshot_dependencies(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            entries = []
+            for i in range(5):
+                with open(os.path.join(temp_dir, 'file%d.c' % i), 'w') as f:
+                    f.write('#include "gen%d.h"\n' % i)
+                entries.append({'directory': temp_dir, 'file': 'file%d.c' % i,
+                                'command': '/usr/bin/gcc -I. -c -o file%d.o file%d.c' % (i, i)})
+            text = json.dumps(entries)
+            entries[0]['command'] = entries[0]['command'].replace('-I.', '-I. -O2')
+            changed = json.dumps(entries)
+            snapshot = os.path.join(temp_dir, 'compile_commands.json.snapshot')
+            for content, scanned in ((text, 5), (changed, 1)):
+                expected = CompilationDatabase(StringIO(content), temp_dir + '/compile_commands.json', temp_dir,
+                                               dep_scanner=IncludeScanner())
+                expected.read()
+                scanner = IncludeScanner()
+                db = CompilationDatabase(StringIO(content), temp_dir + '/compile_commands.json', temp_dir,
+                                         snapshot=snapshot, dep_scanner=scanner)
+                db.read()
+                # only the objects of the entries not in the snapshot are searched
+                self.assertEqual(scanner.scanned, scanned)
+                self.assertEqual([c.missing_depends for c in db.command],
+                                 [c.missing_depends for c in expected.command])
+            self.assertIn(temp_dir + '/gen0.h', db.command[-1].missing_depends[temp_dir + '/file0.o'])
+
+    def test_db_sqlite_index(self):
+        entries = []
+        for i in range(30):
+            entries.append('''{
+        "directory": "/git/gdb",
+        "command": "/usr/bin/gcc -g -O2 -I. -DID=%d -c -o file%d.o file%d.c",
+        "file": "file%d.c"
+    }''' % (i % 3, i, i, i))
+        entries.append('''{
+        "directory": "/git/gdb",
+        "arguments": ["/usr/bin/ar", "cru", "libfile.a", "file0.o", "file1.o", "file2.o"],
+        "file": "file0.o"
+    }''')
+        entries.append('''{
+        "directory": "/git/gdb",
+        "arguments": ["/usr/bin/install", "-c", "-m", "644", "file0.c", "/usr/local/share/gdb/file0.c"],
+        "file": "file0.c"
+    }''')
+        text = '[%s]' % ',\n'.join(entries)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = SqliteIndex(os.path.join(temp_dir, 'index.sqlite'))
+            db = CompilationDatabase(StringIO(text), '/git/gdb/compile_commands.json', '/git/gdb', index=index)
+            db.read()
+            expected = CompilationDatabase(StringIO(text), '/git/gdb/compile_commands.json', '/git/gdb')
+            expected.read()
+            for name in INDEX_FIELDS:
+                self.assertEqual(dict(getattr(db, name).items()), getattr(expected, name))
+                self.assertEqual(list(getattr(db, name).keys()), list(getattr(expected, name).keys()))
+            self.assertIn('/git/gdb/libfile.a', db.linkings)
+            self.assertEqual(db.target_linkage('/git/gdb/libfile.a'), 'STATIC')
+            self.assertEqual(len(db.installs), 1)
+            for database in (db, expected):
+                self.assertTrue(database.reduce_target(0, '/git/gdb/file0.o', '/git/gdb/file0.c'))
+                self.assertFalse(database.reduce_target(0, '/git/gdb/file0.o', '/git/gdb/file0.c'))
+            self.assertEqual(dict(db.targets.items()), expected.targets)
+            self.assertEqual(db.extract_migrated_commands().keys(), expected.extract_migrated_commands().keys())
+            self.assertEqual(len(db.installs), 0)
+            index.close()
+            # an index of a previous run is replaced, any other file is kept
+            SqliteIndex(os.path.join(temp_dir, 'index.sqlite')).close()
+            other = os.path.join(temp_dir, 'compile_commands.json')
+            with open(other, 'w') as f:
+                f.write(text)
+            self.assertRaises(ValueError, SqliteIndex, other)
+            with open(other) as f:
+                self.assertEqual(f.read(), text)
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is needed to find dependencies')
+    def test_db_dependency_jobs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            entries = []
+            for i in range(8):
+                with open(os.path.join(temp_dir, 'file%d.c' % i), 'w') as f:
+                    f.write('#include "gen%d.h"\n#include "common.h"\nint f%d;\n' % (i % 3, i))
+                entries.append({'directory': temp_dir, 'file': 'file%d.c' % i,
+                                'command': '/usr/bin/gcc -I. -DID=%d -c -o file%d.o file%d.c' % (i % 2, i, i)})
+            text = json.dumps(entries)
+            databases = []
+            for dep_jobs in (1, 4):
+                db = CompilationDatabase(StringIO(text), temp_dir + '/compile_commands.json', temp_dir,
+                                         dep_jobs=dep_jobs)
+                db.read()
+                databases.append(db)
+            serial, parallel = databases
+            self.assertEqual(len(serial.command), 2)
+            missing_depends = serial.command[0].missing_depends[temp_dir + '/file0.o']
+            self.assertIn(temp_dir + '/gen0.h', missing_depends)
+            self.assertIn(temp_dir + '/common.h', missing_depends)
+            self.assertEqual([c.missing_depends for c in parallel.command],
+                             [c.missing_depends for c in serial.command])
+            self.assertTrue(parallel.command[1].include_binary_dir)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import unittest
+from .utils import *
+from ..denpendency import *
+from ..denpendency import extract_batch_dependencies, extract_dependencies, parse_dependencies, split_rules
+from ..utils import stat_cache
+
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is needed to find dependencies')
+class TestDependencyCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # collect_dependencies() checks the files relative to the current directory, the root of the project
+        self.cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        stat_cache.clear()
+        self.cache = DependencyCache(os.path.join(self.temp_dir, 'cache'))
+        for directory in ('a', 'b'):
+            os.mkdir(os.path.join(self.temp_dir, directory))
+            self.write(directory + '/util.c', '#include "util.h"\n#include "gen_%s.h"\n' % directory)
+            self.write(directory + '/util.h', 'int util;\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, path, content):
+        with open(os.path.join(self.temp_dir, path), 'w') as f:
+            f.write(content)
+
+    def cache_size(self):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.cache.directory) for name in names if name.endswith('.json'))
+
+    def find(self, directory, **kwargs):
+        cwd = os.path.join(self.temp_dir, directory)
+        command = create_command('gcc', cwd=cwd, **kwargs)
+        return find_dependencies('util.c', command, self.temp_dir, self.cache)
+
+    def test_dependency_cache(self):
+        self.assertEqual(self.find('a'), [os.path.join(self.temp_dir, 'a/gen_a.h')])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(self.find('a'), [os.path.join(self.temp_dir, 'a/gen_a.h')])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # same basename in another directory, or with other flags
+        self.assertEqual(self.find('b'), [os.path.join(self.temp_dir, 'b/gen_b.h')])
+        self.find('a', definitions=['X=1'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+        # a header created or changed invalidates the entry
+        gen_a = os.path.join(self.temp_dir, 'a/gen_a.h')
+        self.write('a/gen_a.h', 'int gen;\n')
+        # a new run, the stat cache assumes no file changes during a run
+        stat_cache.clear()
+        self.assertNotIn(gen_a, self.find('a'))
+        self.assertEqual(self.cache.stale, 1)
+        self.assertNotIn(gen_a, self.find('a'))
+        self.assertEqual(self.cache.hits, 2)
+        os.utime(os.path.join(self.temp_dir, 'a/util.h'), ns=(0, 0))
+        stat_cache.clear()
+        self.find('a')
+        self.assertEqual(self.cache.stale, 2)
+
+    def test_dependency_cache_evict(self):
+        self.find('a')
+        self.find('b')
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(self.cache.read_size(), self.cache_size())
+        self.cache.max_size = 1
+        # nothing added since, the entries are not listed
+        self.assertEqual(self.cache.evict(), 0)
+        self.find('a', definitions=['X=1'])
+        self.assertEqual(self.cache.evict(), 3)
+        self.assertEqual(self.cache.read_size(), 0)
+        self.find('a')
+        self.assertEqual(self.cache.misses, 4)
+        # a cache without its size file is listed once
+        os.remove(os.path.join(self.cache.directory, DependencyCache.SIZE_FILE))
+        self.cache.max_size = DEP_CACHE_SIZE
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(self.cache.read_size(), self.cache_size())
+        self.assertGreater(self.cache.read_size(), 0)
+
+
+    def test_find_all_dependencies(self):
+        for i in range(5):
+            self.write('a/file%d.c' % i, '#include "util.h"\n#include "gen%d.h"\n' % i)
+        cwd = os.path.join(self.temp_dir, 'a')
+        command = create_command('gcc', cwd=cwd, definitions=['X=1'])
+        other = create_command('gcc', cwd=os.path.join(self.temp_dir, 'b'))
+        sources = ['file%d.c' % i for i in range(5)] + ['util.c']
+        self.assertEqual(extract_batch_dependencies(command, [cwd + '/' + s for s in sources], cwd),
+                         [extract_dependencies(command, cwd + '/' + s, cwd) for s in sources])
+
+        tasks = [(s, command) for s in sources] + [('util.c', other), ('missing.c', command)]
+        expected = [find_dependencies(source, cmd, self.temp_dir) for source, cmd in tasks]
+        self.assertEqual(expected[0], [cwd + '/gen0.h'])
+        self.assertEqual(expected[-1], [])
+        for jobs, batch_size in ((1, 64), (3, 2)):
+            self.assertEqual(find_all_dependencies(tasks, self.temp_dir, jobs, batch_size=batch_size), expected)
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, 2, self.cache), expected)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 7))
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, 2, self.cache), expected)
+        self.assertEqual((self.cache.hits, self.cache.misses), (7, 7))
+
+    def test_dependency_journal(self):
+        command = create_command('gcc', cwd=os.path.join(self.temp_dir, 'a'))
+        tasks = [('util.c', command), ('util.c', create_command('gcc', cwd=os.path.join(self.temp_dir, 'b')))]
+        expected = [find_dependencies(source, cmd, self.temp_dir) for source, cmd in tasks]
+        filename = os.path.join(self.temp_dir, 'compile_commands.json.deps-journal')
+        journal = DependencyJournal(filename)
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, journal=journal), expected)
+        journal.close()
+        # an interrupted run, resumed without running the compiler
+        with open(filename, 'a') as f:
+            f.write('{"key": "trunc')
+        journal = DependencyJournal(filename)
+        self.assertEqual(len(journal.entries), 2)
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, journal=journal), expected)
+        self.assertEqual(journal.resumed, 2)
+        journal.complete()
+        self.assertFalse(os.path.exists(filename))
+
+    def test_dependency_journal_truncated(self):
+        filename = os.path.join(self.temp_dir, 'compile_commands.json.deps-journal')
+        with open(filename, 'w') as f:
+            f.write('{"key": "k1", "output": "", "depends": []}\n{"key": "k2", "outp')
+        journal = DependencyJournal(filename)
+        self.assertEqual(list(journal.entries.keys()), ['k1'])
+        journal.record([('k3', '')], self.temp_dir)
+        journal.close()
+        journal = DependencyJournal(filename)
+        self.assertEqual(list(journal.entries.keys()), ['k1', 'k3'])
+        journal.complete()
+
+    def test_dependency_timeout(self):
+        compiler = os.path.join(self.temp_dir, 'cc')
+        self.write('cc', '#!/bin/sh\nsleep 10\n')
+        os.chmod(compiler, 0o755)
+        command = create_command(compiler, cwd=os.path.join(self.temp_dir, 'a'))
+        tasks = [('util.c', command)]
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, cache=self.cache, timeout=0.2), [[]])
+        # not cached, to be found by the next run
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertIsNone(self.cache.lookup(command, os.path.join(command.cwd, 'util.c'), command.cwd + '/')[1])
+
+    def test_dependency_batch_timeout(self):
+        compiler = os.path.join(self.temp_dir, 'cc')
+        # gcc, but hanging on hang.c
+        self.write('cc', '#!/bin/sh\necho run >> %s/runs\n'
+                         'case "$*" in *hang.c*) sleep 10;; esac\nexec gcc "$@"\n' % self.temp_dir)
+        os.chmod(compiler, 0o755)
+        self.write('a/hang.c', '#include "util.h"\n')
+        command = create_command(compiler, cwd=os.path.join(self.temp_dir, 'a'))
+        tasks = [('util.c', command), ('hang.c', command)]
+        # the sources of the batch timed out are run one by one, only the hanging one is left without dependencies
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, timeout=1),
+                         [[os.path.join(self.temp_dir, 'a/gen_a.h')], []])
+        with open(os.path.join(self.temp_dir, 'runs')) as f:
+            self.assertEqual(f.read(), 'run\n' * 3)
+
+    def test_clang_scan_deps(self):
+        self.write('a/file.c', '#include "util.h"\n')
+        command = create_command('gcc', cwd=os.path.join(self.temp_dir, 'a'))
+        tasks = [('util.c', command), ('file.c', command)]
+        expected = [find_dependencies(source, cmd, self.temp_dir) for source, cmd in tasks]
+        # without the tool, all the sources are left to the compiler
+        scanner = ClangScanDeps('json2cmake-no-such-scan-deps')
+        self.assertEqual(scanner.scan(tasks), {})
+        self.assertEqual(find_all_dependencies(tasks, self.temp_dir, scanner=scanner), expected)
+        if shutil.which('clang-scan-deps'):
+            self.assertEqual(find_all_dependencies(tasks, self.temp_dir, scanner=ClangScanDeps(jobs=2)), expected)
+
+    def test_dependency_line_continuation(self):
+        # output of gcc -MM -MG, continued lines indented with one space
+        output = ('src.o: src.c include/some_long_directory_name/first_header.h \\\n'
+                  ' include/some_long_directory_name/second_header.h \\\n'
+                  ' generated_missing_header.h')
+        self.assertEqual(split_rules(output), ['src.o: src.c include/some_long_directory_name/first_header.h '
+                                               'include/some_long_directory_name/second_header.h '
+                                               'generated_missing_header.h'])
+        self.assertEqual(sorted(parse_dependencies(output, '/git/proj/', '/git/proj')), [
+            '/git/proj/generated_missing_header.h',
+            '/git/proj/include/some_long_directory_name/first_header.h',
+            '/git/proj/include/some_long_directory_name/second_header.h',
+            '/git/proj/src.c'])
+        # the same from the compiler, its rule long enough to be continued
+        directory = 'a/some_long_directory_name'
+        os.mkdir(os.path.join(self.temp_dir, directory))
+        self.write(directory + '/first_header.h', '')
+        self.write(directory + '/second_header.h', '')
+        self.write('a/src.c', '#include "some_long_directory_name/first_header.h"\n'
+                              '#include "some_long_directory_name/second_header.h"\n'
+                              '#include "generated_missing_header.h"\n')
+        cwd = os.path.join(self.temp_dir, 'a')
+        command = create_command('gcc', cwd=cwd)
+        output = extract_dependencies(command, cwd + '/src.c', cwd)
+        self.assertIn('\\\n', output)
+        self.assertEqual(find_dependencies('src.c', command, self.temp_dir), [cwd + '/generated_missing_header.h'])
+
+    def test_clang_scan_deps_output(self):
+        output = ('json2cmake-dep-1.o: /src/b.c \\\n  /src/b.h\n'
+                  '/build/json2cmake-dep-0.o: /src/a.c /usr/include/stdio.h\n'
+                  'json2cmake-dep-7.o: /src/c.c\n')
+        self.assertEqual(ClangScanDeps.split_output(output, 2), {
+            0: '/build/json2cmake-dep-0.o: /src/a.c /usr/include/stdio.h',
+            1: 'json2cmake-dep-1.o: /src/b.c /src/b.h'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -82,5 +82,36 @@ add_dependencies(doit libdoit)
         self.assertEqual(self.output.getvalue(), output_text)
 
 
+    def test_sort_targets(self):
+        generator = CmakeGenerator('gdbserver', '/git/gdb/gdbserver', '/git/gdb', '/git/gdb/cmake-build-debug')
+        # each library depends on the next one, sorted after it by name and path
+        chain = ['a', 'b', 'c', 'd']
+        for i, name in enumerate(chain):
+            depends = ['/git/gdb/gdbserver/lib%s.a' % chain[i + 1]] if i + 1 < len(chain) else []
+            generator.output_linked_target(self.cxx_command, ['%s.c' % name], '/git/gdb/gdbserver/lib%s.a' % name,
+                                           'STATIC', name, depends)
+        generator.output_linked_target(self.cxx_command, ['main.cpp'], '/git/gdb/gdbserver/doit', 'EXECUTABLE',
+                                       'doit', ['/git/gdb/gdbserver/liba.a'])
+        generator.output_linked_target(self.cxx_command, ['z.c'], '/git/gdb/gdbserver/libz.a', 'STATIC', 'z', [])
+        names = [target.name() for target in generator.sort_targets()]
+        self.assertEqual(names, ['d', 'c', 'b', 'a', 'doit', 'z'])
+
+        for name, depend in (('x', 'y'), ('y', 'x')):
+            generator.output_linked_target(self.cxx_command, ['%s.c' % name], '/git/gdb/gdbserver/lib%s.a' % name,
+                                           'STATIC', name, ['/git/gdb/gdbserver/lib%s.a' % depend])
+        with self.assertLogs('cmake_generator.json2cmake.generator', 'WARNING') as logs:
+            names = [target.name() for target in generator.sort_targets()]
+        self.assertEqual(names, ['d', 'c', 'b', 'a', 'doit', 'z', 'x', 'y'])
+        self.assertIn('Cyclic dependencies between targets of /git/gdb/gdbserver: x y', logs.output[0])
+
+    def test_get_include_path(self):
+        generator = CmakeGenerator('gdbserver', '/git/gdb/gdbserver', '/git/gdb', '/git/gdb/cmake-build-debug')
+        self.assertEqual(generator.get_include_path('/git/gdb/include'), '../include')
+        self.assertEqual(generator.get_include_path('/git/gdb'), '..')
+        self.assertEqual(generator.get_include_path('/git/gdbserver'), '/git/gdbserver')
+        hits = path_cache_info()['relpath'].hits
+        self.assertEqual(generator.get_include_path('/git/gdb/include'), '../include')
+        self.assertEqual(path_cache_info()['relpath'].hits, hits + 1)
+
 if __name__ == '__main__':
     unittest.main()
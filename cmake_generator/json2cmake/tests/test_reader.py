@@ -0,0 +1,86 @@
+import json
+import unittest
+from io import StringIO
+from ..reader import *
+
+entries = [
+    {
+        "directory": "/git/gdb",
+        "command": "/usr/bin/g++ -g -O2 -I. -Iconfig -DTUI=1 -DNAME=\\\"[gdb], {x}\\\" -c -o ada-lang.o ada-lang.c",
+        "file": "ada-lang.c"
+    },
+    {},
+    {
+        "directory": "/git/gdb",
+        "arguments": ["/usr/bin/ar", "cru", "libgdb.a", "ada-lang.o"],
+        "file": "ada-lang.o"
+    },
+]
+
+
+class TestReader(unittest.TestCase):
+    def test_iter_entries(self):
+        text = json.dumps(entries, indent=4)
+        self.assertEqual(list(iter_entries(StringIO(text))), entries)
+        self.assertEqual(list(iter_entries(StringIO('  [ ]\n'))), [])
+
+    def test_iter_entries_in_small_chunks(self):
+        text = json.dumps(entries, indent='\t')
+        for chunk_size in (1, 2, 3, 7, 64):
+            self.assertEqual(list(iter_entries(StringIO(text), chunk_size)), entries)
+
+    def test_iter_entries_streaming(self):
+        text = json.dumps(entries)
+        infile = StringIO(text)
+        reader = iter_entries(infile, 16)
+        self.assertEqual(next(reader), entries[0])
+        self.assertLess(infile.tell(), len(text))
+
+    def test_iter_entries_invalid(self):
+        with self.assertRaises(ValueError):
+            list(iter_entries(StringIO('')))
+        with self.assertRaises(ValueError):
+            list(iter_entries(StringIO('{"file": "a.c"}')))
+        with self.assertRaises(ValueError):
+            list(iter_entries(StringIO('[{"file": "a.c"}, {"file": '), 4))
+        with self.assertRaises(ValueError):
+            list(iter_entries(StringIO('[{"file": "a.c"}'), 4))
+
+
+    def test_iter_json_lines(self):
+        text = '\n'.join(json.dumps(entry) for entry in entries) + '\n\n'
+        self.assertEqual(list(iter_json_lines(StringIO(text))), entries)
+        with self.assertRaises(ValueError):
+            list(iter_json_lines(StringIO('{"file": "a.c"}\n{"file": ')))
+
+    def test_read_entries(self):
+        lines = '\n'.join(json.dumps(entry) for entry in entries)
+        array = json.dumps(entries, indent=4)
+        for chunk_size in (1, 5, 64, CHUNK_SIZE):
+            self.assertEqual(list(read_entries(StringIO(lines), 'auto', chunk_size)), entries)
+            self.assertEqual(list(read_entries(StringIO('\n  ' + array), 'auto', chunk_size)), entries)
+        self.assertEqual(list(read_entries(StringIO(lines), 'jsonl')), entries)
+        self.assertEqual(list(read_entries(StringIO(array), 'json')), entries)
+        with self.assertRaises(ValueError):
+            list(read_entries(StringIO(lines), 'json'))
+        # an empty JSON Lines database, but not an empty JSON array
+        for text in ('', ' \n\n'):
+            self.assertEqual(list(read_entries(StringIO(text), 'auto', 1)), [])
+            self.assertEqual(list(read_entries(StringIO(text), 'jsonl')), [])
+            with self.assertRaises(ValueError):
+                list(read_entries(StringIO(text), 'json'))
+        # line boundaries of str.splitlines() that json.dumps(ensure_ascii=False) leaves unescaped in strings
+        separators = [{'directory': '/git/gdb', 'file': 'a\u2028b\u2029c\x85d.c'}]
+        text = '\n'.join(json.dumps(entry, ensure_ascii=False) for entry in separators + entries)
+        for chunk_size in (4, CHUNK_SIZE):
+            self.assertEqual(list(read_entries(StringIO(text), 'auto', chunk_size)), separators + entries)
+        self.assertEqual(list(read_entries(StringIO(text), 'jsonl')), separators + entries)
+
+    def test_write_json_lines(self):
+        output = StringIO()
+        self.assertEqual(write_json_lines(iter_entries(StringIO(json.dumps(entries))), output), len(entries))
+        self.assertEqual(output.getvalue().count('\n'), len(entries))
+        self.assertEqual(list(read_entries(StringIO(output.getvalue()))), entries)
+
+if __name__ == '__main__':
+    unittest.main()
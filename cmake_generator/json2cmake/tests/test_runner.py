@@ -0,0 +1,42 @@
+import time
+import unittest
+from ..runner import ProcessRunner
+
+
+class TestProcessRunner(unittest.TestCase):
+    def setUp(self):
+        self.runner = ProcessRunner(limit=4)
+
+    def tearDown(self):
+        self.runner.close()
+
+    def test_run(self):
+        result = self.runner.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual((result.returncode, result.stdout, result.stderr), (3, 'out\n', 'err\n'))
+        self.assertEqual(result.output, 'out')
+        result = self.runner.run(['sh', '-c', 'echo out; echo err >&2'], merge_stderr=True)
+        self.assertEqual(result.stdout, 'out\nerr\n')
+        self.assertEqual(self.runner.run(['cat'], stdin='in').stdout, 'in')
+        self.assertEqual(self.runner.run(['pwd'], cwd='/').output, '/')
+        result = self.runner.run(['json2cmake-no-such-command'])
+        self.assertEqual(result.returncode, 127)
+
+    def test_run_all(self):
+        start = time.time()
+        results = self.runner.run_all([(['sh', '-c', 'sleep 0.3; echo %d' % i], {}) for i in range(4)])
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([r.output for r in results], ['0', '1', '2', '3'])
+        self.assertEqual(self.runner.started, 4)
+
+    def test_timeout(self):
+        start = time.time()
+        # the sleep started by sh is killed along with it
+        result = self.runner.run(['sh', '-c', 'sleep 10; echo done'], timeout=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(result.timed_out)
+        self.assertIsNone(result.returncode)
+        self.assertEqual(self.runner.timeouts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from .utils import *
+from ..denpendency import find_dependencies
+from ..scanner import *
+
+files = {
+    'src/main.c': '''#include "config.h"
+#include "ui_main.h"
+#include <stdio.h>
+#include "util/util.h"
+/* #include "commented.h" */
+#if 0
+#include "disabled.h"
+#else
+#include "enabled.h"
+#endif
+#ifdef _WIN32
+#include <windows.h>
+#endif
+''',
+    'src/config.h': '#ifndef CONFIG_H\n#define CONFIG_H\n#include <version.h>\n#endif\n',
+    'include/version.h': '#include "gen_version.h"\n',
+    'src/util/util.h': '#pragma once\n#include "helper.h"\n#include "moc_util.cpp"\n',
+    'src/util/helper.h': '#include "util.h"\n',
+    'src/enabled.h': '',
+    'iquote/ui_other.h': '',
+    'src/other.cpp': '#include "ui_other.h"\n#include <string>\n#include "util/util.h"\n',
+}
+
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is needed to compare the dependencies')
+class TestIncludeScanner(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # collect_dependencies() checks the files relative to the current directory, the root of the project
+        self.cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        for path, content in files.items():
+            path = os.path.join(self.temp_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def test_include_scanner(self):
+        scanner = IncludeScanner()
+        cwd = os.path.join(self.temp_dir, 'src')
+        for compiler, source in (('gcc', 'main.c'), ('g++', 'other.cpp'), ('gcc', 'util/util.h')):
+            command = create_command(compiler, cwd=cwd, includes=[self.temp_dir + '/include'],
+                                     iquote_includes=[self.temp_dir + '/iquote'])
+            expected = find_dependencies(source, command, self.temp_dir)
+            self.assertEqual(sorted(find_dependencies(source, command, self.temp_dir, scanner=scanner)),
+                             sorted(expected))
+        self.assertEqual(sorted(expected), [cwd + '/moc_util.cpp'])
+        self.assertEqual(scanner.scanned, 3)
+        self.assertEqual(scanner.directives[cwd + '/config.h'], ((False, 'version.h', False), ))
+
+    def test_parse_directives(self):
+        path = os.path.join(self.temp_dir, 'src/branches.h')
+        with open(path, 'w') as f:
+            f.write('#ifdef A\n#include "a.h"\n#elif 0\n#include "b.h"\n#elif B\n#include "c.h"\n'
+                    '#else\n#include "d.h"\n#endif\n#if 0\n#elif 1\n#include "e.h"\n#endif\n')
+        self.assertEqual([name for _, name, _ in IncludeScanner.parse_directives(path)],
+                         ['a.h', 'c.h', 'd.h', 'e.h'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import pickle
+import random
+import unittest
+from ..storage import *
+
+
+def ordered(index):
+    """The indexes as nested lists, to compare their orders too"""
+    def nested(value):
+        if isinstance(value, dict):
+            return [(k, nested(v)) for k, v in value.items()]
+        if isinstance(value, set):
+            return sorted(value)
+        return value
+    return [(name, nested(dict(getattr(index, name).items()))) for name in INDEX_FIELDS]
+
+
+class TestBuildGraph(unittest.TestCase):
+    def test_build_graph(self):
+        rand = random.Random(7)
+        memory = MemoryIndex()
+        graph = BuildGraph()
+        files = ['/git/gdb/file%d.%s' % (i, ext) for i in range(60) for ext in ('c', 'o')]
+        added = []
+        for step in range(3000):
+            op = rand.random()
+            cmd_id = rand.randrange(6)
+            target, source = rand.choice(files), rand.choice(files)
+            if op < 0.3:
+                args = (cmd_id, target, source)
+                added.append(args)
+                for index in (memory, graph):
+                    index.add_target(*args)
+            elif op < 0.6:
+                for index in (memory, graph):
+                    index.add_object(target, source, cmd_id)
+            elif op < 0.8:
+                # a target linked from many files, beyond the degree of the position index
+                target = files[1] if op < 0.7 else target
+                bucket = rand.choice(BUCKETS)
+                for index in (memory, graph):
+                    index.add_linking(bucket, target, cmd_id, source)
+            elif op < 0.9:
+                for index in (memory, graph):
+                    index.add_install(cmd_id, target, source)
+            elif op < 0.97 and added:
+                args = rand.choice(added) if op < 0.95 else (cmd_id, target, source)
+                self.assertEqual(graph.remove_target_source(*args), memory.remove_target_source(*args))
+            elif cmd_id in memory.installs:
+                self.assertEqual(graph.pop_install(cmd_id), memory.pop_install(cmd_id))
+            if step % 500 == 0:
+                graph.commit()
+        self.assertEqual(ordered(graph), ordered(memory))
+        for name in INDEX_FIELDS:
+            self.assertEqual(getattr(graph, name), getattr(memory, name))
+            self.assertEqual(len(getattr(graph, name)), len(getattr(memory, name)))
+        self.assertNotIn('/git/gdb/missing.o', graph.objects)
+        self.assertNotIn(99, graph.targets)
+        self.assertEqual(graph.objects.get('/git/gdb/missing.o', {}), {})
+        self.assertEqual(ordered(pickle.loads(pickle.dumps(graph))), ordered(memory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import shlex
+import unittest
+from ..tokenizer import *
+
+command_lines = [
+    '/usr/bin/gcc -g -O2 -c -o a.o a.c',
+    '/usr/bin/g++ -DLOCALEDIR="\\"/usr/local/share/locale\\"" -DHAVE_CONFIG_H -c -o b.o b.cc',
+    "/usr/bin/gcc -DNAME='\"[gdb], {x}\"' -I'/opt/my include' -c x.c",
+    'gcc a""b "" \'\' c\\ d "e\\\\f\\$g"',
+    'gcc\t-c\n  -o x.o\rx.c ',
+    'gcc -DX=a\x0cb',
+    '',
+]
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_split_command(self):
+        for command_line in command_lines:
+            self.assertEqual(split_command(command_line), shlex.split(command_line))
+
+    def test_split_command_invalid(self):
+        for command_line in ('gcc "-DX=1', "gcc '-DX=1", 'gcc -c \\'):
+            with self.assertRaises(ValueError):
+                split_command(command_line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import pickle
+import logging
+import shutil
+import tempfile
+import unittest
+from ..utils import StatCache, OrderedSet, Lazy, lazy_join
+
+
+class TestStatCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, 'src/include'))
+        os.makedirs(os.path.join(self.temp_dir, '.git'))
+        with open(os.path.join(self.temp_dir, 'src/include/a.h'), 'w') as f:
+            f.write('int a;\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_stat_cache(self):
+        cache = StatCache()
+        header = os.path.join(self.temp_dir, 'src/include/a.h')
+        missing = os.path.join(self.temp_dir, 'src/include/missing.h')
+        for i in range(3):
+            self.assertTrue(cache.isfile(header))
+            self.assertTrue(cache.isdir(os.path.dirname(header)))
+            self.assertFalse(cache.exists(missing))
+        self.assertEqual(cache.mtime(header), os.stat(header).st_mtime_ns)
+        self.assertIsNone(cache.mtime(missing))
+        self.assertEqual((cache.calls, cache.syscalls, cache.saved), (11, 3, 8))
+
+    def test_stat_cache_prewarm(self):
+        cache = StatCache()
+        # the hidden .git is not listed
+        self.assertEqual(cache.prewarm(self.temp_dir), 3)
+        self.assertTrue(cache.isfile(os.path.join(self.temp_dir, 'src/include/a.h')))
+        self.assertTrue(cache.isdir(os.path.join(self.temp_dir, '.git')))
+        self.assertFalse(cache.exists(os.path.join(self.temp_dir, 'src/include/missing.h')))
+        self.assertEqual((cache.calls, cache.syscalls), (3, 3))
+        self.assertFalse(cache.exists(os.path.join(self.temp_dir, '.git/HEAD')))
+        self.assertEqual(cache.syscalls, 4)
+        cache.clear()
+        self.assertEqual((cache.calls, cache.syscalls, len(cache.listed)), (0, 0, 0))
+
+
+class TestOrderedSet(unittest.TestCase):
+    def test_ordered_set(self):
+        values = OrderedSet(['b', 'a', 'b'])
+        self.assertEqual(values, ['b', 'a', 'b'])
+        self.assertIn('a', values)
+        self.assertNotIn('c', values)
+        values.add('a')
+        values.add('c')
+        values.update(['d', 'b', 'd'])
+        self.assertEqual(values, ['b', 'a', 'b', 'c', 'd'])
+        values.remove('b')
+        self.assertIn('b', values)
+        del values[values.index('b')]
+        self.assertNotIn('b', values)
+        values.append('b')
+        values += ['e']
+        self.assertEqual(values, ['a', 'c', 'd', 'b', 'e'])
+        self.assertEqual(repr(values), repr(['a', 'c', 'd', 'b', 'e']))
+        copied = pickle.loads(pickle.dumps(values))
+        self.assertIsInstance(copied, OrderedSet)
+        self.assertEqual(copied, values)
+        self.assertIn('e', copied)
+        duplicate = values.copy()
+        duplicate.add('f')
+        self.assertIn('f', duplicate)
+        self.assertNotIn('f', values)
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy(self):
+        calls = []
+
+        def describe(value):
+            calls.append(value)
+            return 'value %s' % value
+
+        log = logging.getLogger('json2cmake-test-lazy')
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        with self.assertLogs(log, logging.INFO) as logs:
+            log.debug('%s', Lazy(describe, 1))
+            log.info('%s', Lazy(describe, 2))
+            log.info('%s: %s', 'files', lazy_join(['a', 'b'], ', ', str.upper))
+        self.assertEqual(calls, [2])
+        self.assertEqual(logs.output, ['INFO:json2cmake-test-lazy:value 2', 'INFO:json2cmake-test-lazy:files: A, B'])
+        self.assertEqual('%-8s|' % lazy_join([1, 2]), '1 2     |')
+
+
+if __name__ == '__main__':
+    unittest.main()
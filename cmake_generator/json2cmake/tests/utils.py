@@ -9,7 +9,8 @@ CWD = os.getcwd()
 
 def create_command(compiler, **kwargs):
     command = Command(compiler, CWD)
-    command.__dict__.update(kwargs)
+    for name, value in kwargs.items():
+        setattr(command, name, value)
     return command
 
 
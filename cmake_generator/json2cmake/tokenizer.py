@@ -0,0 +1,48 @@
+import re
+import shlex
+
+__all__ = ['split_command']
+
+# quotes and escapes, or whitespace which str.split() and shlex.split() disagree on
+SPECIAL_CHARACTERS = re.compile(r'''['"\\]|[^\S \t\r\n]''')
+WORD_PART = re.compile(r'''([^ \t\r\n'"\\]+)|'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([ \t\r\n]+)''', re.S)
+DOUBLE_QUOTED_ESCAPE = re.compile(r'\\([\\"])')
+
+
+def split_command(command_line):
+    """
+    Split a command line into words, the same as shlex.split().
+    Handles the quoting of ldlogger (single and double quotes, backslash escapes) with regular expressions,
+    and falls back to shlex.split() for anything else, like unterminated quotes."""
+    if not SPECIAL_CHARACTERS.search(command_line):
+        return command_line.split()
+    words = []
+    parts = []
+    in_word = False
+    pos = 0
+    end = len(command_line)
+    match = WORD_PART.match
+    while pos < end:
+        m = match(command_line, pos)
+        if m is None:
+            return shlex.split(command_line)
+        pos = m.end()
+        plain, single_quoted, double_quoted, escaped, spaces = m.groups()
+        if spaces is not None:
+            if in_word:
+                words.append(''.join(parts))
+                parts = []
+                in_word = False
+            continue
+        in_word = True
+        if plain is not None:
+            parts.append(plain)
+        elif single_quoted is not None:
+            parts.append(single_quoted)
+        elif double_quoted is not None:
+            parts.append(DOUBLE_QUOTED_ESCAPE.sub(r'\1', double_quoted))
+        else:
+            parts.append(escaped)
+    if in_word:
+        words.append(''.join(parts))
+    return words
@@ -1,9 +1,16 @@
 import os
 import re
+import sys
+import stat
+import hashlib
 import logging
+import threading
+from functools import lru_cache
 
-__all__ = ['get_loggers', 'basestring', 'PathUtils', 'freeze', 'DISALLOWED_CHARACTERS',
-           'resolve', 'resolve_paths', 'relpath', 'cmake_resolve_binary']
+__all__ = ['get_loggers', 'Lazy', 'lazy_join', 'basestring', 'PathUtils', 'CompactObject',
+           'freeze', 'canonical', 'fingerprint', 'intern_string', 'intern_tuple', 'DISALLOWED_CHARACTERS',
+           'resolve', 'resolve_paths', 'relpath', 'path_cache_info', 'cmake_resolve_binary',
+           'StatCache', 'stat_cache', 'OrderedSet']
 
 if not hasattr(__builtins__, 'basestring'):
     basestring = str
@@ -13,8 +20,43 @@ def get_loggers(module_name):
     return log, log.info, log.debug, log.warning, log.error
 
 
+class Lazy(object):
+    """
+    Log argument computed by func(*args) when the message is formatted,
+    so nothing is computed for the messages below the level of the logger.
+    e.g. debug("sources %s", Lazy(' '.join, sources))"""
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def join_items(items, delimiter=' ', convert=str):
+    return delimiter.join(map(convert, items))
+
+
+def lazy_join(items, delimiter=' ', convert=str):
+    """Lazy log argument of the items converted by convert, joined with delimiter"""
+    return Lazy(join_items, items, delimiter, convert)
+
+
 logger, info, debug, warn, error = get_loggers(__name__)
 DISALLOWED_CHARACTERS = re.compile("[^A-Za-z0-9_.+\\-]")
+# max number of results kept by each of resolve() and relpath()
+PATH_CACHE_SIZE = 1 << 16
+intern_string = sys.intern
+
+
+def intern_tuple(members, interned):
+    """
+    Return the tuple equal to members shared through interned, {members: members, ...}, with its strings interned.
+    The tables are kept by their callers, for the time they share tuples, not to hold them for the whole process."""
+    members = tuple([intern_string(m) if isinstance(m, str) else m for m in members])
+    return interned.setdefault(members, members)
 
 
 def freeze(obj):
@@ -27,10 +69,29 @@ def freeze(obj):
     if isinstance(obj, tuple):
         return tuple([freeze(x) for x in obj])
     if hasattr(obj, '__dict__'):
-        return freeze(sorted(filter(lambda it: it[1], obj.__dict__.items())))
+        return freeze(sorted(filter(lambda it: it[1] and it[0][:1] != '_', obj.__dict__.items())))
+    return obj
+
+
+def canonical(obj):
+    """Like freeze(), but with sets as sorted tuples, so its repr does not depend on hash randomization"""
+    if isinstance(obj, dict):
+        return tuple([(k, canonical(v)) for k, v in sorted(obj.items(), key=lambda i: i[0])])
+    if isinstance(obj, (list, tuple)):
+        return tuple([canonical(x) for x in obj])
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted([canonical(x) for x in obj], key=repr))
+    if hasattr(obj, '__dict__'):
+        return canonical(dict(filter(lambda it: it[1] and it[0][:1] != '_', obj.__dict__.items())))
     return obj
 
 
+def fingerprint(obj):
+    """Stable digest of obj, equal for objects equal in freeze()"""
+    return hashlib.blake2b(repr(canonical(obj)).encode('utf-8'), digest_size=16).digest()
+
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
 def resolve(path, cwd):
     if not os.path.isabs(path):
         path = os.path.join(cwd, path)
@@ -41,6 +102,7 @@ def resolve_paths(paths, cwd):
     return [resolve(path, cwd) for path in paths]
 
 
+@lru_cache(maxsize=PATH_CACHE_SIZE)
 def relpath(path, base, root=None):
     if not root:
         root = base
@@ -51,6 +113,124 @@ def relpath(path, base, root=None):
     return path
 
 
+def path_cache_info():
+    """Hit/miss counters of the resolve() and relpath() caches"""
+    return {'resolve': resolve.cache_info(), 'relpath': relpath.cache_info()}
+
+
+class StatCache(object):
+    """
+    Results of the file system probes of a run, so that each path is stat'ed once at most.
+    prewarm() lists a directory tree with os.scandir(), after which the type of any path in it,
+    and the absence of any path in a listed directory, are known without a syscall.
+    The files are not expected to change during the run."""
+    def __init__(self):
+        # stats: {path: os.stat_result or None, ...}
+        self.stats = {}
+        # kinds: {path: 'd' or 'f' or '', ...} of the entries of the listed directories
+        self.kinds = {}
+        self.listed = set()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.syscalls = 0
+
+    def __repr__(self):
+        return "%s{calls=%s, syscalls=%s, saved=%s, paths=%s, listed=%s}" % (
+            self.__class__.__name__, self.calls, self.syscalls, self.saved, len(self.stats) + len(self.kinds),
+            len(self.listed))
+
+    @property
+    def saved(self):
+        return self.calls - self.syscalls
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
+            self.kinds.clear()
+            self.listed.clear()
+            self.calls = self.syscalls = 0
+
+    def prewarm(self, directory):
+        """List the tree of directory, but its hidden sub directories, returns the number of directories listed"""
+        pending = [os.path.abspath(directory)]
+        count = 0
+        while pending:
+            path = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            kinds = {}
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        kinds[entry.path] = 'd'
+                        if not entry.name.startswith('.'):
+                            pending.append(entry.path)
+                    else:
+                        kinds[entry.path] = 'f' if entry.is_file() else ''
+                except OSError:
+                    kinds[entry.path] = ''
+            with self.lock:
+                self.kinds.update(kinds)
+                self.listed.add(path)
+                self.syscalls += 1
+            count += 1
+        return count
+
+    def stat(self, path):
+        """os.stat() of path, or None if it does not exist"""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.calls += 1
+        try:
+            return self.stats[path]
+        except KeyError:
+            pass
+        if path not in self.kinds and os.path.dirname(path) in self.listed:
+            result = None
+        else:
+            with self.lock:
+                self.syscalls += 1
+            try:
+                result = os.stat(path)
+            except (OSError, ValueError):
+                result = None
+        self.stats[path] = result
+        return result
+
+    def kind(self, path):
+        """'d' for a directory, 'f' for a regular file, '' for anything else, None if path does not exist"""
+        path = os.path.abspath(path)
+        kind = self.kinds.get(path)
+        if kind is not None:
+            with self.lock:
+                self.calls += 1
+            return kind
+        result = self.stat(path)
+        if result is None:
+            return None
+        return 'd' if stat.S_ISDIR(result.st_mode) else 'f' if stat.S_ISREG(result.st_mode) else ''
+
+    def exists(self, path):
+        return self.kind(path) is not None
+
+    def isfile(self, path):
+        return self.kind(path) == 'f'
+
+    def isdir(self, path):
+        return self.kind(path) == 'd'
+
+    def mtime(self, path):
+        """st_mtime_ns of path, or None if it does not exist"""
+        result = self.stat(path)
+        return None if result is None else result.st_mtime_ns
+
+
+# the stat cache of the run, shared by all the file system probes
+stat_cache = StatCache()
+
+
 def cmake_resolve_source(path, base):
     return "${CMAKE_CURRENT_SOURCE_DIR}/%s" % relpath(path, base)
 
@@ -59,6 +239,103 @@ def cmake_resolve_binary(path, base):
     return "${CMAKE_CURRENT_BINARY_DIR}/%s" % relpath(path, base)
 
 
+class OrderedSet(list):
+    """
+    List with a shadow set of its members, for membership tests in O(1).
+    It behaves as a list in every other way, duplicates included, add() appends only the items not in it yet.
+    Compares, prints and is frozen as the list of its items."""
+    __slots__ = ('members', )
+
+    def __init__(self, items=()):
+        list.__init__(self, items)
+        self.members = set(self)
+
+    def __reduce__(self):
+        return self.__class__, (list(self), )
+
+    def __contains__(self, item):
+        return item in self.members
+
+    def copy(self):
+        return self.__class__(self)
+
+    def add(self, item):
+        if item not in self.members:
+            self.members.add(item)
+            list.append(self, item)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def append(self, item):
+        self.members.add(item)
+        list.append(self, item)
+
+    def extend(self, items):
+        items = list(items)
+        self.members.update(items)
+        list.extend(self, items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        self.members.add(item)
+        list.insert(self, index, item)
+
+    def clear(self):
+        self.members.clear()
+        list.clear(self)
+
+    def reset_members(self):
+        self.members = set(self)
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.reset_members()
+
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        self.reset_members()
+        return item
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self.reset_members()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.reset_members()
+
+
+class CompactObject(object):
+    """
+    Base of classes keeping their attributes in __slots__.
+    __dict__ returns a new dict of the assigned public attributes,
+    as used by freeze(), repr() and Command.migrate()."""
+    __slots__ = ()
+    slot_names = {}
+
+    @property
+    def __dict__(self):
+        cls = self.__class__
+        names = CompactObject.slot_names.get(cls)
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                names.extend(n for n in getattr(klass, '__slots__', ()) if n[:1] != '_')
+            names = CompactObject.slot_names[cls] = tuple(names)
+        values = {}
+        for name in names:
+            try:
+                values[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return values
+
+
 class PathUtils(object):
     def __init__(self, directory, root_dir):
         self.directory = str(directory).rstrip('/')
@@ -76,6 +353,10 @@ class PathUtils(object):
     def joined_relpath(self, files, delimiter=' '):
         return delimiter.join(map(self.relpath, files))
 
+    def lazy_relpath(self, files, delimiter=' '):
+        """Lazy log argument of joined_relpath(files, delimiter)"""
+        return Lazy(self.joined_relpath, files, delimiter)
+
     @staticmethod
     def name_for_target(path):
         basename = os.path.basename(path)
@@ -86,7 +367,7 @@ class PathUtils(object):
 
     @staticmethod
     def isdir(path):
-        return os.path.isdir(path) or path.endswith('/') or os.path.splitext(path)[1] == ''
+        return stat_cache.isdir(path) or path.endswith('/') or os.path.splitext(path)[1] == ''
 
 
 if __name__ == '__main__':